@@ -1,54 +1,160 @@
+import asyncio
+import base64
+import binascii
+import functools
+import os
 import sqlite3
-from fastapi import FastAPI, HTTPException, WebSocket
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from contextlib import asynccontextmanager
+from typing import List, Optional
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request, WebSocket
+from fastapi.responses import FileResponse, JSONResponse, Response
 from pydantic import BaseModel
-from passlib.context import CryptContext
 import logging
 
+from blob_store import BlobStore
 from connection_manager import ConnectionManager
+from conversations import CONVERSATIONS_SQL, MARK_READ_SQL
 from websocket_handler import WebSocketHandler
+from file_transfer import FileTransferManager
+from groups import GROUP_HISTORY_SQL, MAX_GROUP_MEMBERS, USER_GROUPS_SQL, GroupDirectory
+from key_cache import KEY_TTL, PublicKeyCache
+from logging_config import configure_logging
+from message_writer import MESSAGE_JSON_SQL, MessageWriter
+from metrics import CONTENT_TYPE, LoopLagMonitor, MetricsMiddleware, registry
+from migrations import migrate
+from presence import Presence
+from retention import RETENTION_ACTIONS, RetentionJob
+from routing import BrokerRouter, LocalRouter
+from serialization import FastJSONResponse, dumps, loads
+from session_tokens import AUTH_SUBPROTOCOL, SessionTokens, token_from_subprotocols
+from static_assets import STATIC_BUILD_DIR, StaticAssets, ensure_built
+from password_hasher import PasswordHasher
+from storage import Database
+from user_search import UserSearch
 
-# Setup logging
-logging.basicConfig(level=logging.DEBUG)
+# Setup logging: levels and format come from LOG_LEVEL, LOG_LEVELS and LOG_FORMAT
+configure_logging()
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
-
-# Mount static files
-app.mount("/static", StaticFiles(directory="static"), name="static")
-
-# Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
-# SQLite database setup
-def init_db():
-    conn = sqlite3.connect("users.db")
-    c = conn.cursor()
-    # Users table
-    c.execute('''CREATE TABLE IF NOT EXISTS users 
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT, 
-                  username TEXT UNIQUE NOT NULL, 
-                  email TEXT UNIQUE NOT NULL, 
-                  password_hash TEXT NOT NULL, 
-                  public_key TEXT NOT NULL)''')
-    # Messages table
-    c.execute('''CREATE TABLE IF NOT EXISTS messages 
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT, 
-                  sender TEXT NOT NULL, 
-                  recipient TEXT NOT NULL, 
-                  encrypted_content TEXT NOT NULL, 
-                  iv TEXT NOT NULL, 
-                  encrypted_aes_key TEXT NOT NULL, 
-                  timestamp TEXT NOT NULL, 
-                  status TEXT NOT NULL DEFAULT 'sent',
-                  file_attachment TEXT,
-                  FOREIGN KEY (sender) REFERENCES users(username), 
-                  FOREIGN KEY (recipient) REFERENCES users(username))''')
-    conn.commit()
-    conn.close()
-
-init_db()
+# Pooled storage shared by the REST endpoints and WebSocket handlers
+db = Database("users.db")
+
+# Group-commits message inserts and status updates from every WebSocket
+writer = MessageWriter(db)
+
+# Content-addressed storage for encrypted attachment payloads
+blob_store = BlobStore()
+
+# Group membership, cached per worker
+groups = GroupDirectory(db)
+
+# Chunked, resumable storage for encrypted attachment uploads; group uploads are readable by every member
+transfers = FileTransferManager(blob_store, groups=groups)
+
+# Archives or purges messages past their retention period, in small batches
+retention = RetentionJob(db, blob_store)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Schema changes are applied once, before anything touches the database
+    await db.run(migrate)
+    await writer.start()
+    await manager.start()
+    loop_lag.start()
+    retention.start()
+    transfers.start()
+    externalize_task = asyncio.create_task(externalize_attachments())
+    yield
+    externalize_task.cancel()
+    transfers.stop()
+    retention.stop()
+    loop_lag.stop()
+    await manager.stop()
+    await writer.stop()
+    db.close()
+    hasher.close()
+
+app = FastAPI(lifespan=lifespan, default_response_class=FastJSONResponse)
+
+# Times every REST request by route for /metrics
+app.add_middleware(MetricsMiddleware)
+
+# Static files, served from their hashed and precompressed build (rebuilt here if the sources changed)
+static_assets = StaticAssets(STATIC_BUILD_DIR, ensure_built())
+app.mount("/static", static_assets, name="static")
+
+# Password hashing runs on a bounded worker pool, off the event loop
+hasher = PasswordHasher()
+
+# Legacy inline attachments are moved into the blob store this many rows at a time
+EXTERNALIZE_BATCH_SIZE = 50
+# Pause between batches so the migration never competes with live traffic (seconds)
+EXTERNALIZE_PAUSE = 0.5
+
+def _save_attachment_refs(conn, updates):
+    with conn:
+        conn.executemany("UPDATE messages SET file_attachment = ?, attachment_blob = ? WHERE id = ?", updates)
+
+async def externalize_attachments():
+    """Move attachment payloads still stored inside message rows into the blob store."""
+    loop = asyncio.get_running_loop()
+    last_id = 0
+    moved = 0
+    while True:
+        rows = await db.fetchall("""
+            SELECT id, file_attachment FROM messages
+            WHERE file_attachment IS NOT NULL AND attachment_blob IS NULL AND id > ?
+            ORDER BY id LIMIT ?
+        """, (last_id, EXTERNALIZE_BATCH_SIZE))
+        if not rows:
+            break
+        updates = []
+        for message_id, raw_attachment in rows:
+            last_id = message_id
+            try:
+                file_attachment = loads(raw_attachment)
+                if file_attachment.get("encryptedData"):
+                    payload = await loop.run_in_executor(
+                        None, functools.partial(base64.b64decode, file_attachment.pop("encryptedData"), validate=True)
+                    )
+                    blob_id, size = await blob_store.put_bytes(payload)
+                elif file_attachment.get("transferId"):
+                    transfer = await transfers.get(file_attachment["transferId"])
+                    if not transfer or not transfer.complete:
+                        continue
+                    blob_id = await transfers.store_blob(transfer)
+                    size = transfer.size
+                else:
+                    continue
+            except (ValueError, TypeError, AttributeError, binascii.Error, OSError) as e:
+                logger.error(f"Could not move attachment of message {message_id} to the blob store: {str(e)}")
+                continue
+            file_attachment["blobId"] = blob_id
+            file_attachment["encryptedSize"] = size
+            updates.append((dumps(file_attachment), blob_id, message_id))
+        if updates:
+            await db.run(_save_attachment_refs, updates)
+            moved += len(updates)
+        await asyncio.sleep(EXTERNALIZE_PAUSE)
+    if moved:
+        logger.info(f"Moved {moved} inline attachments to the blob store")
+
+# Message history paging
+DEFAULT_HISTORY_PAGE_SIZE = 50
+MAX_HISTORY_PAGE_SIZE = 200
+
+def _encode_cursor(message_id: int, timestamp: str) -> str:
+    raw = f"{message_id}:{timestamp}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def _decode_cursor(cursor: str):
+    """Decode an opaque history cursor into its (timestamp, id) keyset position."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        message_id, timestamp = base64.urlsafe_b64decode(padded).decode().split(":", 1)
+        return timestamp, int(message_id)
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError(f"Invalid cursor: {cursor}")
 
 # Pydantic models
 class SignupData(BaseModel):
@@ -61,146 +167,507 @@ class LoginData(BaseModel):
     username: str
     password: str
 
+class PublicKeysRequest(BaseModel):
+    usernames: List[str]
+
+class ConversationRead(BaseModel):
+    peer: str
+    # Read up to and including this message; the latest one when omitted
+    up_to_id: Optional[int] = None
+
+class GroupCreate(BaseModel):
+    name: str
+    # The creator is always a member and need not be listed
+    members: List[str]
+
+class RetentionPolicy(BaseModel):
+    # No peer sets the user's default; max_age_days None keeps messages forever
+    peer: str = ""
+    max_age_days: Optional[int] = None
+    action: str = "archive"
+
+# Indexed user search with a cache for hot queries from the search box
+user_search = UserSearch(db)
+
+# Public keys are read far more often than they change
+key_cache = PublicKeyCache()
+PUBLIC_KEY_CACHE_CONTROL = f"private, max-age={KEY_TTL}"
+MAX_PUBLIC_KEYS_PER_REQUEST = 200
+
+# Only show users the presence of people they have exchanged messages with
+PRESENCE_SCOPED_TO_CONTACTS = False
+
+async def load_contacts(username: str):
+    rows = await db.fetchall("""
+        SELECT recipient FROM messages WHERE sender = ?
+        UNION
+        SELECT sender FROM messages WHERE recipient = ?
+    """, (username, username))
+    return {row[0] for row in rows}
+
+def spill_to_offline(meta: dict):
+    # A relayed message that never reached the recipient goes back to 'sent' for later delivery
+    if meta.get("group"):
+        writer.requeue_group(meta["id"], [meta["recipient"]])
+    else:
+        writer.requeue(meta["id"])
+
+# When running several workers, point them all at one routing broker (python routing.py <socket>)
+ROUTING_BROKER_SOCKET = os.environ.get("ROUTING_BROKER_SOCKET")
+
+# Signed session tokens issued at login; checking one needs neither the database nor bcrypt
+sessions = SessionTokens()
+
 # Connection manager for WebSockets
-manager = ConnectionManager()
+manager = ConnectionManager(
+    Presence(load_contacts if PRESENCE_SCOPED_TO_CONTACTS else None),
+    on_spill=spill_to_offline,
+    router=BrokerRouter(ROUTING_BROKER_SOCKET) if ROUTING_BROKER_SOCKET else LocalRouter(),
+    on_session_revoked=sessions.revoke,
+)
+
+def _bearer_token(authorization: Optional[str]) -> Optional[str]:
+    if authorization and authorization[:7].lower() == "bearer ":
+        return authorization[7:].strip()
+    return None
+
+def current_user(authorization: Optional[str] = Header(None)) -> str:
+    """The user a request's ``Authorization: Bearer`` session token belongs to."""
+    username = sessions.verify(_bearer_token(authorization))
+    if username is None:
+        raise HTTPException(status_code=401, detail="Invalid or expired session",
+                            headers={"WWW-Authenticate": "Bearer"})
+    return username
+
+def _require_self(username: str, user: str):
+    if username != user:
+        raise HTTPException(status_code=403, detail="Not allowed for this user")
+
+# Event loop responsiveness, probed in the background
+loop_lag = LoopLagMonitor()
+
+def _register_metrics():
+    """Expose the counters the components already keep about themselves on /metrics."""
+    def outbound_depths():
+        depths = [stats["depth"] for user_sessions in manager.queue_stats().values()
+                  for stats in user_sessions.values()]
+        return {("total",): sum(depths), ("max",): max(depths, default=0)}
+
+    registry.callback("chat_active_connections", "WebSockets connected to this worker.",
+                      lambda: {(): manager.connection_count()})
+    registry.callback("chat_connected_users", "Users with at least one WebSocket on this worker.",
+                      lambda: {(): len(manager.active_connections)})
+    registry.callback("chat_reaped_connections_total", "WebSockets closed for missing heartbeats.",
+                      lambda: {(): manager.reaped})
+    registry.callback("chat_online_clients", "Clients online across all workers.",
+                      lambda: {(): len(manager.router.online())})
+    registry.callback("chat_outbound_queue_depth", "Frames waiting in outbound queues.",
+                      outbound_depths, labels=("stat",))
+    registry.callback("chat_event_loop_lag_last_seconds", "Most recent event loop lag probe.",
+                      lambda: {(): loop_lag.last_lag})
+    registry.callback("chat_password_hash_in_flight", "bcrypt operations waiting for or holding a worker.",
+                      lambda: {("waiting",): hasher.waiting, ("running",): hasher.running}, labels=("state",))
+    registry.callback("chat_password_hash_total", "Completed bcrypt operations.",
+                      lambda: {(): hasher.completed}, metric_type="counter")
+    registry.callback("chat_password_hash_seconds_total", "Seconds bcrypt operations spent queued and running.",
+                      lambda: {("wait",): hasher.total_wait_seconds, ("run",): hasher.total_run_seconds},
+                      labels=("phase",), metric_type="counter")
+    registry.callback("chat_db_calls_total", "Database calls made off the event loop.",
+                      lambda: {(): db.calls}, metric_type="counter")
+    registry.callback("chat_db_call_seconds_total", "Seconds spent awaiting database calls, queueing included.",
+                      lambda: {(): db.call_seconds}, metric_type="counter")
+    registry.callback("chat_db_connections", "Pooled database connections.",
+                      lambda: {("open",): db.stats()["open_connections"], ("idle",): db.stats()["idle_connections"]},
+                      labels=("state",))
+    registry.callback("chat_write_queue_depth", "Message writes waiting for the next group commit.",
+                      lambda: {(): writer.stats()["queued"]})
+    registry.callback("chat_write_batches_total", "Group commits of message writes.",
+                      lambda: {(): writer.batches}, metric_type="counter")
+    registry.callback("chat_write_operations_total", "Message writes committed.",
+                      lambda: {(): writer.operations}, metric_type="counter")
+    registry.callback("chat_write_commit_seconds_total", "Seconds spent committing message write batches.",
+                      lambda: {(): writer.commit_seconds}, metric_type="counter")
+    registry.callback("chat_retention_messages_total", "Messages expired by the retention job.",
+                      lambda: {("archive",): retention.archived, ("purge",): retention.purged},
+                      labels=("action",), metric_type="counter")
+    registry.callback("chat_retention_vacuumed_pages_total", "Database pages returned to the filesystem.",
+                      lambda: {(): retention.pages_vacuumed}, metric_type="counter")
+
+_register_metrics()
 
 @app.get("/")
-async def get():
-    return FileResponse("static/index.html")
+async def get(request: Request):
+    return await static_assets.get_response("index.html", request.scope)
 
 @app.post("/signup")
 async def signup(data: SignupData):
-    conn = sqlite3.connect("users.db")
-    c = conn.cursor()
-    try:
-        c.execute("SELECT username, email FROM users WHERE username = ? OR email = ?", 
-                 (data.username, data.email))
-        existing = c.fetchone()
-        if existing:
-            if existing[0] == data.username:
-                raise HTTPException(status_code=400, detail="Username already taken")
-            if existing[1] == data.email:
-                raise HTTPException(status_code=400, detail="Email already registered")
-
-        password_hash = pwd_context.hash(data.password)
-        c.execute("INSERT INTO users (username, email, password_hash, public_key) VALUES (?, ?, ?, ?)",
-                 (data.username, data.email, password_hash, data.public_key))
-        conn.commit()
+    try:
+        existing = await db.fetchone("SELECT username, email FROM users WHERE username = ? OR email = ?",
+                                     (data.username, data.email))
+    except Exception as e:
+        logger.error(f"Signup error: {str(e)}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+    if existing:
+        if existing[0] == data.username:
+            raise HTTPException(status_code=400, detail="Username already taken")
+        if existing[1] == data.email:
+            raise HTTPException(status_code=400, detail="Email already registered")
+
+    try:
+        password_hash = await hasher.hash(data.password)
+        await db.execute("INSERT INTO users (username, email, password_hash, public_key) VALUES (?, ?, ?, ?)",
+                         (data.username, data.email, password_hash, data.public_key))
+        # Signup is where a user's key is written, so drop anything cached under that name
+        key_cache.invalidate(data.username)
+        user_search.invalidate()
         return {"message": "User registered successfully"}
     except sqlite3.IntegrityError:
         raise HTTPException(status_code=400, detail="Database error during signup")
     except Exception as e:
         logger.error(f"Signup error: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal server error")
-    finally:
-        conn.close()
 
 @app.post("/login")
 async def login(data: LoginData):
-    conn = sqlite3.connect("users.db")
-    c = conn.cursor()
-    try:
-        c.execute("SELECT password_hash FROM users WHERE username = ?", (data.username,))
-        result = c.fetchone()
-        if not result or not pwd_context.verify(data.password, result[0]):
-            raise HTTPException(status_code=401, detail="Invalid username or password")
-        return {"message": "Login successful", "username": data.username}
+    try:
+        result = await db.fetchone("SELECT password_hash FROM users WHERE username = ?", (data.username,))
+        verified = bool(result) and await hasher.verify(data.password, result[0])
     except Exception as e:
         logger.error(f"Login error: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal server error")
-    finally:
-        conn.close()
+    if not verified:
+        raise HTTPException(status_code=401, detail="Invalid username or password")
+    token, expires_at = sessions.issue(data.username)
+    return {"message": "Login successful", "username": data.username, "token": token, "expires_at": expires_at}
 
 @app.get("/get_public_key/{username}")
-async def get_public_key(username: str):
-    conn = sqlite3.connect("users.db")
-    c = conn.cursor()
-    try:
-        c.execute("SELECT public_key FROM users WHERE username = ?", (username,))
-        result = c.fetchone()
+async def get_public_key(username: str, if_none_match: Optional[str] = Header(None),
+                         user: str = Depends(current_user)):
+    cached = key_cache.get(username)
+    if cached:
+        public_key, etag = cached
+    else:
+        try:
+            result = await db.fetchone("SELECT public_key FROM users WHERE username = ?", (username,))
+        except Exception as e:
+            logger.error(f"Get public key error: {str(e)}")
+            raise HTTPException(status_code=500, detail="Internal server error")
         if not result:
             raise HTTPException(status_code=404, detail="User not found")
-        return {"public_key": result[0]}
+        public_key = result[0]
+        etag = key_cache.put(username, public_key)
+
+    headers = {"ETag": etag, "Cache-Control": PUBLIC_KEY_CACHE_CONTROL}
+    if if_none_match and etag in (tag.strip() for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers=headers)
+    return JSONResponse({"public_key": public_key}, headers=headers)
+
+@app.post("/public_keys")
+async def get_public_keys(data: PublicKeysRequest, user: str = Depends(current_user)):
+    """Look up the public keys of many users in one round trip."""
+    usernames = list(dict.fromkeys(data.usernames))
+    if len(usernames) > MAX_PUBLIC_KEYS_PER_REQUEST:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_PUBLIC_KEYS_PER_REQUEST} usernames per request")
+
+    public_keys, missing = key_cache.get_many(usernames)
+    if missing:
+        placeholders = ", ".join("?" * len(missing))
+        try:
+            rows = await db.fetchall(f"SELECT username, public_key FROM users WHERE username IN ({placeholders})",
+                                     missing)
+        except Exception as e:
+            logger.error(f"Get public keys error: {str(e)}")
+            raise HTTPException(status_code=500, detail="Internal server error")
+        for username, public_key in rows:
+            key_cache.put(username, public_key)
+            public_keys[username] = public_key
+    return {
+        "public_keys": public_keys,
+        "missing": [username for username in usernames if username not in public_keys]
+    }
+
+@app.get("/messages/{username}")
+async def get_messages(username: str,
+                       limit: int = Query(DEFAULT_HISTORY_PAGE_SIZE, ge=1, le=MAX_HISTORY_PAGE_SIZE),
+                       before: Optional[str] = None,
+                       after: Optional[str] = None,
+                       peer: Optional[str] = None,
+                       user: str = Depends(current_user)):
+    """Return one page of a user's history in ascending order.
+
+    Without a cursor the newest page is returned. ``before`` pages towards
+    older messages and ``after`` towards newer ones; ``peer`` restricts the
+    page to a single conversation.
+    """
+    _require_self(username, user)
+    if before and after:
+        raise HTTPException(status_code=400, detail="Use either before or after, not both")
+    try:
+        position = _decode_cursor(before or after) if (before or after) else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    # Pages are read newest-first unless walking forwards from an "after" cursor
+    newest_first = after is None
+    order = "DESC" if newest_first else "ASC"
+    keyset = ""
+    if position:
+        keyset = f" AND (timestamp, id) {'<' if newest_first else '>'} (?, ?)"
+
+    # One branch per side of the conversation so each can walk its own index
+    if peer:
+        branches = [("sender = ? AND recipient = ?", (username, peer))]
+        if peer != username:
+            branches.append(("sender = ? AND recipient = ?", (peer, username)))
+    else:
+        branches = [("sender = ?", (username,)),
+                    ("recipient = ? AND sender != ?", (username, username))]
+
+    selects = []
+    params = []
+    for where, where_params in branches:
+        selects.append(f"""
+            SELECT * FROM (
+                SELECT id, timestamp, {MESSAGE_JSON_SQL} AS message
+                FROM messages
+                WHERE {where}{keyset}
+                ORDER BY timestamp {order}, id {order}
+                LIMIT ?
+            )""")
+        params.extend(where_params)
+        if position:
+            params.extend(position)
+        params.append(limit + 1)
+    sql = " UNION ALL ".join(selects) + f" ORDER BY timestamp {order}, id {order} LIMIT ?"
+    params.append(limit + 1)
+
+    try:
+        messages = await db.fetchall(sql, params)
+        has_more = len(messages) > limit
+        messages = messages[:limit]
+        if newest_first:
+            messages.reverse()
+
     except Exception as e:
-        logger.error(f"Get public key error: {str(e)}")
+        logger.error(f"Get messages error for {username}: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal server error")
-    finally:
-        conn.close()
 
-@app.get("/messages/{username}")
-async def get_messages(username: str):
-    conn = sqlite3.connect("users.db")
-    c = conn.cursor()
-    try:
-        # Fetch messages where the user is either the sender or recipient
-        c.execute("""
-            SELECT sender, recipient, encrypted_content, iv, encrypted_aes_key, timestamp, status, file_attachment
-            FROM messages 
-            WHERE sender = ? OR recipient = ?
-            ORDER BY timestamp ASC
-        """, (username, username))
-        messages = c.fetchall()
-        result = []
-        for msg in messages:
-            message_data = {
-                "type": "encrypted_message",
-                "sender": msg[0],
-                "recipient": msg[1],
-                "encryptedContent": msg[2],
-                "iv": msg[3],
-                "encryptedAESKey": msg[4],
-                "timestamp": msg[5],
-                "status": msg[6]
+    # SQLite already rendered each message as JSON, so the page is assembled without re-parsing
+    tail = dumps({
+        "has_more": has_more,
+        "cursors": {
+            "before": _encode_cursor(messages[0][0], messages[0][1]) if messages else None,
+            "after": _encode_cursor(messages[-1][0], messages[-1][1]) if messages else None,
+        },
+    })
+    body = '{"messages":[' + ",".join(msg[2] for msg in messages) + "]," + tail[1:]
+    return Response(content=body, media_type="application/json")
+
+# Conversation list paging
+DEFAULT_CONVERSATIONS_LIMIT = 100
+MAX_CONVERSATIONS_LIMIT = 500
+
+@app.get("/conversations/{username}")
+async def get_conversations(username: str,
+                            limit: int = Query(DEFAULT_CONVERSATIONS_LIMIT, ge=1, le=MAX_CONVERSATIONS_LIMIT),
+                            user: str = Depends(current_user)):
+    """List a user's conversations, most recently active first, with their unread counts."""
+    _require_self(username, user)
+    try:
+        rows = await db.fetchall(CONVERSATIONS_SQL, (username, limit))
+    except Exception as e:
+        logger.error(f"Get conversations error for {username}: {str(e)}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+    return {
+        "conversations": [
+            {
+                "peer": peer,
+                "last_message_id": last_message_id,
+                "last_timestamp": last_timestamp,
+                "last_sender": last_sender,
+                "last_status": last_status,
+                "unread_count": unread_count
             }
-            
-            # Add file attachment if present
-            if msg[7]:  # file_attachment JSON
-                import json
-                try:
-                    file_attachment = json.loads(msg[7])
-                    message_data["fileAttachment"] = file_attachment
-                except (json.JSONDecodeError, TypeError):
-                    logger.error(f"Failed to parse file attachment JSON: {msg[7]}")
-            
-            result.append(message_data)
-        return {"messages": result}
+            for peer, last_message_id, last_timestamp, last_sender, last_status, unread_count in rows
+        ]
+    }
+
+@app.post("/conversations/{username}/read")
+async def mark_conversation_read(username: str, data: ConversationRead, user: str = Depends(current_user)):
+    _require_self(username, user)
+    try:
+        await db.execute(MARK_READ_SQL, (data.up_to_id, data.up_to_id, username, data.peer))
     except Exception as e:
-        logger.error(f"Get messages error for {username}: {str(e)}")
+        logger.error(f"Mark conversation read error for {username}: {str(e)}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+    return {"message": "Conversation marked as read"}
+
+# Group history paging
+DEFAULT_GROUP_HISTORY_PAGE_SIZE = 50
+MAX_GROUP_HISTORY_PAGE_SIZE = 200
+
+@app.post("/groups")
+async def create_group(data: GroupCreate, user: str = Depends(current_user)):
+    """Create a group; its membership is fixed from then on."""
+    name = data.name.strip()
+    members = sorted(set(data.members) | {user})
+    if not name or len(members) < 2 or len(members) > MAX_GROUP_MEMBERS:
+        raise HTTPException(status_code=400, detail=f"A group needs a name and 2 to {MAX_GROUP_MEMBERS} members")
+    try:
+        created = await groups.create(name, user, members)
+    except Exception as e:
+        logger.error(f"Create group error for {user}: {str(e)}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+    if created is None:
+        raise HTTPException(status_code=400, detail="Unknown group member")
+    group_id, members = created
+    return {"id": group_id, "name": name, "created_by": user, "members": list(members)}
+
+@app.get("/groups/{username}")
+async def get_groups(username: str, user: str = Depends(current_user)):
+    """List the groups a user belongs to, newest first, with their members."""
+    _require_self(username, user)
+    try:
+        rows = await db.fetchall(USER_GROUPS_SQL, (username,))
+    except Exception as e:
+        logger.error(f"Get groups error for {username}: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal server error")
-    finally:
-        conn.close()
+    return {
+        "groups": [
+            {"id": group_id, "name": name, "created_by": created_by, "members": loads(members)}
+            for group_id, name, created_by, members in rows
+        ]
+    }
+
+@app.get("/groups/{group_id}/messages")
+async def get_group_messages(group_id: int,
+                             limit: int = Query(DEFAULT_GROUP_HISTORY_PAGE_SIZE, ge=1, le=MAX_GROUP_HISTORY_PAGE_SIZE),
+                             before: Optional[int] = None,
+                             user: str = Depends(current_user)):
+    """Return one page of a group's history in ascending order, each message carrying the caller's key.
+
+    ``before`` is a message id; without it the newest page is returned.
+    """
+    if user not in await groups.members(group_id):
+        raise HTTPException(status_code=404, detail="Group not found")
+    try:
+        rows = await db.fetchall(GROUP_HISTORY_SQL, (user, group_id, before or 2 ** 63 - 1, limit + 1))
+    except Exception as e:
+        logger.error(f"Get group messages error for {group_id}: {str(e)}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    rows.reverse()
+    tail = dumps({"has_more": has_more, "before": rows[0][0] if rows else None})
+    body = '{"messages":[' + ",".join(row[1] for row in rows) + "]," + tail[1:]
+    return Response(content=body, media_type="application/json")
+
+@app.get("/attachments/{blob_id}")
+async def get_attachment(blob_id: str, username: str = Depends(current_user)):
+    """Serve an encrypted attachment payload to a participant of a message that references it.
+
+    The file is sent straight from disk and honours Range requests, so large
+    downloads can be resumed or fetched in parts.
+    """
+    if not blob_store.valid_id(blob_id):
+        raise HTTPException(status_code=404, detail="Attachment not found")
+    try:
+        allowed = await db.fetchone("""
+            SELECT 1 FROM messages
+            WHERE attachment_blob = ? AND (sender = ? OR recipient = ?)
+            UNION ALL
+            SELECT 1 FROM group_messages m
+            WHERE m.attachment_blob = ? AND (m.sender = ? OR EXISTS (
+                SELECT 1 FROM group_members WHERE group_id = m.group_id AND username = ?))
+            LIMIT 1
+        """, (blob_id, username, username, blob_id, username, username))
+    except Exception as e:
+        logger.error(f"Get attachment error: {str(e)}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+    if not allowed or not blob_store.exists(blob_id):
+        raise HTTPException(status_code=404, detail="Attachment not found")
+    # Blobs never change once written, so clients may cache them indefinitely
+    return FileResponse(blob_store.path(blob_id), media_type="application/octet-stream",
+                        headers={"Cache-Control": "private, max-age=31536000, immutable"})
 
 @app.get("/search_users")
-async def search_users(query: str = ""):
-    conn = sqlite3.connect("users.db")
-    c = conn.cursor()
-    try:
-        # Use LIKE for case-insensitive partial matching
-        search_pattern = f"%{query}%"
-        c.execute("""
-            SELECT username, email FROM users 
-            WHERE username LIKE ? OR email LIKE ?
-            LIMIT 20
-        """, (search_pattern, search_pattern))
-        results = c.fetchall()
-        users = [{"username": user[0], "email": user[1]} for user in results]
+async def search_users(query: str = "", user: str = Depends(current_user)):
+    try:
+        # Username prefix matches first, then substring matches on username or email
+        users = await user_search.search(query)
         return {"users": users}
     except Exception as e:
         logger.error(f"Search users error: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal server error")
-    finally:
-        conn.close()
 
 @app.websocket("/ws/{client_id}")
 async def websocket_endpoint(client_id: str, websocket: WebSocket):
-    handler = WebSocketHandler(websocket, client_id, manager)
+    token = token_from_subprotocols(websocket.scope.get("subprotocols", []))
+    if sessions.verify(token) != client_id:
+        logger.warning(f"Rejected WebSocket for {client_id}: invalid or missing session")
+        await websocket.close(code=1008)
+        return
+    session_id, _ = sessions.session_of(token)
+    handler = WebSocketHandler(websocket, client_id, manager, db, writer, transfers, blob_store, groups, session_id,
+                               subprotocol=AUTH_SUBPROTOCOL)
     try:
         await handler.handle_websocket()
     except Exception as e:
         logger.error(f"WebSocket error for {client_id}: {str(e)}")
         await websocket.close(code=1000)
 
+@app.get("/retention/{username}")
+async def get_retention(username: str, user: str = Depends(current_user)):
+    _require_self(username, user)
+    try:
+        rows = await db.fetchall("SELECT peer, max_age_days, action FROM retention_policies WHERE owner = ?",
+                                 (username,))
+    except Exception as e:
+        logger.error(f"Get retention error: {str(e)}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+    return {
+        "default": {"max_age_days": retention.default[0], "action": retention.default[1]},
+        "policies": [{"peer": peer, "max_age_days": days, "action": action} for peer, days, action in rows]
+    }
+
+@app.put("/retention/{username}")
+async def set_retention(username: str, policy: RetentionPolicy, user: str = Depends(current_user)):
+    """Set how long a user keeps their messages, overall or for one conversation."""
+    _require_self(username, user)
+    if policy.action not in RETENTION_ACTIONS:
+        raise HTTPException(status_code=400, detail=f"Action must be one of: {', '.join(RETENTION_ACTIONS)}")
+    if policy.max_age_days is not None and policy.max_age_days < 1:
+        raise HTTPException(status_code=400, detail="max_age_days must be at least 1")
+    try:
+        await db.execute('''INSERT INTO retention_policies (owner, peer, max_age_days, action) VALUES (?, ?, ?, ?)
+                            ON CONFLICT (owner, peer) DO UPDATE
+                            SET max_age_days = excluded.max_age_days, action = excluded.action''',
+                         (username, policy.peer, policy.max_age_days, policy.action))
+    except Exception as e:
+        logger.error(f"Set retention error: {str(e)}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+    return {"message": "Retention policy saved"}
+
+@app.delete("/retention/{username}")
+async def delete_retention(username: str, peer: str = "", user: str = Depends(current_user)):
+    """Drop a policy so the user's default (or the server's) applies again."""
+    _require_self(username, user)
+    try:
+        await db.execute("DELETE FROM retention_policies WHERE owner = ? AND peer = ?", (username, peer))
+    except Exception as e:
+        logger.error(f"Delete retention error: {str(e)}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+    return {"message": "Retention policy removed"}
+
+@app.get("/metrics")
+async def metrics():
+    return Response(registry.render(), media_type=CONTENT_TYPE)
+
 @app.post("/logout")
-async def logout():
-    # For this implementation, we'll just return success as the client will handle clearing local storage
+async def logout(authorization: Optional[str] = Header(None)):
+    # The client clears its own storage; the server forgets the session on every worker
+    token = _bearer_token(authorization)
+    session = sessions.session_of(token) if token else None
+    if session:
+        await manager.revoke_session(*session)
     return {"message": "Logged out successfully"}
@@ -0,0 +1,110 @@
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from typing import Tuple
+
+logger = logging.getLogger(__name__)
+
+# Where encrypted attachment payloads are kept, addressed by their SHA-256
+BLOB_DIR = "blobs"
+HASH_CHUNK_SIZE = 1024 * 1024
+
+BLOB_ID_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+
+class BlobStore:
+    """Content-addressed on-disk store for encrypted attachment payloads.
+
+    A blob's id is the SHA-256 of its bytes and it lives at
+    ``<dir>/<first two hex chars>/<id>``, so storing the same ciphertext twice
+    keeps a single copy. Writes are atomic renames, which makes a blob either
+    fully present or absent. All hashing and file I/O runs off the event loop.
+
+    Storing a blob that is already present refreshes its modification time,
+    which is how ``remove_unused`` knows it was just handed out again.
+    """
+
+    def __init__(self, directory: str = BLOB_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        # Orders storing a blob against removing it
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def valid_id(blob_id: str) -> bool:
+        return bool(BLOB_ID_PATTERN.match(blob_id or ""))
+
+    def path(self, blob_id: str) -> str:
+        return os.path.join(self.directory, blob_id[:2], blob_id)
+
+    def exists(self, blob_id: str) -> bool:
+        return self.valid_id(blob_id) and os.path.exists(self.path(blob_id))
+
+    async def put_file(self, src_path: str) -> Tuple[str, int]:
+        """Move a finished file into the store; returns its blob id and size."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._put_file, src_path)
+
+    async def put_bytes(self, data: bytes) -> Tuple[str, int]:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._put_bytes, data)
+
+    def _put_file(self, src_path: str) -> Tuple[str, int]:
+        digest = hashlib.sha256()
+        size = 0
+        with open(src_path, "rb") as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                digest.update(chunk)
+                size += len(chunk)
+        blob_id = digest.hexdigest()
+        dest = self.path(blob_id)
+        if self._reuse(dest):
+            # Same ciphertext already stored: keep the existing copy
+            os.remove(src_path)
+        else:
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            os.replace(src_path, dest)
+        return blob_id, size
+
+    def _put_bytes(self, data: bytes) -> Tuple[str, int]:
+        blob_id = hashlib.sha256(data).hexdigest()
+        dest = self.path(blob_id)
+        if not self._reuse(dest):
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dest))
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, dest)
+        return blob_id, len(data)
+
+    def _reuse(self, dest: str) -> bool:
+        with self._lock:
+            try:
+                os.utime(dest)
+                return True
+            except FileNotFoundError:
+                return False
+
+    def remove(self, blob_id: str):
+        try:
+            os.remove(self.path(blob_id))
+        except OSError:
+            pass
+
+    def remove_unused(self, blob_id: str, grace: float) -> bool:
+        """Remove a blob nothing references unless it was stored within ``grace`` seconds; True if it is gone."""
+        path = self.path(blob_id)
+        with self._lock:
+            try:
+                if time.time() - os.stat(path).st_mtime < grace:
+                    return False
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        return True
+
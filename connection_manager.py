@@ -1,70 +1,371 @@
-import json
+import asyncio
+import itertools
 import logging
-from typing import Dict, Optional
+import os
+import time
+from typing import Callable, Dict, List, Optional
 from fastapi import WebSocket
 
-logging.basicConfig(level=logging.DEBUG)
+from outbound import MAX_OUTBOUND_QUEUE, OVERFLOW_SPILL, OutboundQueue
+from presence import Presence
+from routing import LocalRouter, Router
+from serialization import dumps
+
 logger = logging.getLogger(__name__)
 
+# Sessions (tabs, devices) one user may hold on a worker; beyond this the oldest is closed
+MAX_SESSIONS_PER_USER = 10
+
+# WebSocket close code for a session pushed out by a newer one (application range, clients do not reconnect)
+CLOSE_SESSION_LIMIT = 4001
+
+# Every connection is pinged this often; one that has sent nothing, pongs included, for the timeout is
+# considered dead and reaped (seconds)
+HEARTBEAT_INTERVAL = float(os.environ.get("WS_HEARTBEAT_INTERVAL", "20"))
+HEARTBEAT_TIMEOUT = float(os.environ.get("WS_HEARTBEAT_TIMEOUT", "60"))
+
+# WebSocket close code for a reaped connection (application range, clients reconnect)
+CLOSE_HEARTBEAT_TIMEOUT = 4002
+
+
+class Connection:
+    """Per-socket state: the outbound queue, liveness and what has not been confirmed yet.
+
+    Stored messages sent on the socket are remembered until the client
+    answers a ping sent after them. Frames are sent in order, so that pong
+    proves everything before the ping arrived; if the connection closes
+    first, the unconfirmed messages go back to offline storage instead of
+    staying marked as delivered. Messages still queued are the outbound
+    queue's to spill, so each one is spilled at most once.
+    """
+
+    __slots__ = ("client_id", "connection_id", "session_id", "outbound", "connected_at", "last_seen",
+                 "received", "unconfirmed", "awaiting", "ping_seq")
+
+    def __init__(self, client_id: str, connection_id: int, session_id: Optional[str], outbound: OutboundQueue):
+        self.client_id = client_id
+        self.connection_id = connection_id
+        self.session_id = session_id
+        self.outbound = outbound
+        self.connected_at = self.last_seen = time.monotonic()
+        self.received = 0
+        # Stored messages sent since the last ping, and those sent before a ping still awaiting its pong
+        self.unconfirmed: List[dict] = []
+        self.awaiting: List[dict] = []
+        self.ping_seq = 0
+        outbound.on_sent = self._sent
+
+    @property
+    def websocket(self) -> WebSocket:
+        return self.outbound.websocket
+
+    def put(self, frame, meta: Optional[dict] = None) -> bool:
+        return self.outbound.put(frame, meta)
+
+    def _sent(self, meta: dict):
+        self.unconfirmed.append(meta)
+
+    def seen(self):
+        """Any frame from the client proves the connection is alive."""
+        self.last_seen = time.monotonic()
+        self.received += 1
+
+    def ping(self, seq: int, frame: str):
+        self.awaiting.extend(self.unconfirmed)
+        self.unconfirmed = []
+        self.ping_seq = seq
+        self.outbound.put(frame)
+
+    def pong(self, seq: int):
+        # An answer to an older ping only confirms part of what is awaiting, so it confirms nothing
+        if seq == self.ping_seq:
+            self.awaiting = []
+
+    def lost(self) -> List[dict]:
+        """Take the messages sent on the socket that the client never confirmed."""
+        lost = self.awaiting + self.unconfirmed
+        self.awaiting, self.unconfirmed = [], []
+        return lost
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return dict(self.outbound.stats(), received=self.received, connected_seconds=now - self.connected_at,
+                    idle_seconds=now - self.last_seen, unconfirmed=len(self.unconfirmed) + len(self.awaiting))
+
+
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: Dict[str, WebSocket] = {}
-    
-    async def connect(self, websocket: WebSocket, client_id: str):
+    def __init__(self, presence: Optional[Presence] = None,
+                 max_queue_size: int = MAX_OUTBOUND_QUEUE,
+                 overflow_policy: str = OVERFLOW_SPILL,
+                 on_spill: Optional[Callable[[dict], None]] = None,
+                 router: Optional[Router] = None,
+                 on_session_revoked: Optional[Callable[[str, float], None]] = None,
+                 max_sessions: int = MAX_SESSIONS_PER_USER,
+                 heartbeat_interval: float = HEARTBEAT_INTERVAL,
+                 heartbeat_timeout: float = HEARTBEAT_TIMEOUT):
+        # Each user connected to this worker has one or more sessions, each reached through its own
+        # bounded outbound queue: user -> connection id -> connection, oldest session first
+        self.active_connections: Dict[str, Dict[int, Connection]] = {}
+        # The same connections by id alone, for replies to one particular session
+        self._connections: Dict[int, Connection] = {}
+        self._connection_ids = itertools.count(1)
+        self.max_sessions = max_sessions
+        self.presence = presence or Presence()
+        self.max_queue_size = max_queue_size
+        self.overflow_policy = overflow_policy
+        self.on_spill = on_spill
+        # Clients on other workers are reached, and presence is shared, through the router
+        self.router = router or LocalRouter()
+        self.on_session_revoked = on_session_revoked
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self._heartbeat_task: Optional[asyncio.Task] = None
+        self._ping_seq = 0
+        self.reaped = 0
+
+    async def start(self):
+        await self.router.start(self._deliver_routed, self._handle_event, self._undelivered)
+        self._heartbeat_task = asyncio.create_task(self._heartbeat())
+
+    async def stop(self):
+        if self._heartbeat_task:
+            self._heartbeat_task.cancel()
+            self._heartbeat_task = None
+        await self.router.stop()
+
+    async def _heartbeat(self):
+        """Ping every connection and reap the ones that stopped answering."""
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                self._ping_seq += 1
+                # One frame per round, shared by every connection
+                frame = dumps({"type": "ping", "seq": self._ping_seq})
+                deadline = time.monotonic() - self.heartbeat_timeout
+                for connection in list(self._connections.values()):
+                    if connection.last_seen < deadline:
+                        await self._reap(connection)
+                    else:
+                        connection.ping(self._ping_seq, frame)
+            except Exception as e:
+                logger.error(f"Heartbeat round failed: {str(e)}")
+
+    async def _reap(self, connection: Connection):
+        logger.info(f"Reaping connection {connection.connection_id} of {connection.client_id}: "
+                    f"silent for {time.monotonic() - connection.last_seen:.0f}s")
+        self.reaped += 1
+        await self._drop_connection(connection.outbound, CLOSE_HEARTBEAT_TIMEOUT)
+
+    def pong(self, connection_id: int, seq: int):
+        connection = self._connections.get(connection_id)
+        if connection:
+            connection.pong(seq)
+
+    def seen(self, connection_id: int):
+        connection = self._connections.get(connection_id)
+        if connection:
+            connection.seen()
+
+    async def connect(self, websocket: WebSocket, client_id: str, session_id: Optional[str] = None,
+                      subprotocol: Optional[str] = None) -> int:
+        """Accept a new session for ``client_id`` next to any it already has; returns its connection id."""
         try:
-            await websocket.accept()
-            self.active_connections[client_id] = websocket
-            logger.debug(f"Client {client_id} connected")
-            await self.broadcast_connected_clients()
+            await websocket.accept(subprotocol=subprotocol)
+            connection_id = next(self._connection_ids)
+            outbound = OutboundQueue(
+                websocket, client_id, connection_id,
+                max_size=self.max_queue_size,
+                overflow_policy=self.overflow_policy,
+                on_spill=self._spill,
+                on_failure=self._drop_connection,
+            )
+            outbound.start()
+            connection = Connection(client_id, connection_id, session_id, outbound)
+            user_sessions = self.active_connections.setdefault(client_id, {})
+            first = not user_sessions
+            user_sessions[connection_id] = connection
+            self._connections[connection_id] = connection
+            logger.debug("Client %s connected (session %d, %d open)", client_id, connection_id, len(user_sessions))
+
+            if len(user_sessions) > self.max_sessions:
+                oldest = next(iter(user_sessions.values()))
+                logger.info(f"Client {client_id} exceeded {self.max_sessions} sessions, closing the oldest")
+                await self._drop_connection(oldest.outbound, CLOSE_SESSION_LIMIT)
+
+            if first:
+                await self.presence.track(client_id)
+                # Announce the join first so the snapshot's version already includes it
+                await self.router.register(client_id)
+            await self.send_presence_snapshot(client_id, connection_id)
+            return connection_id
         except Exception as e:
             logger.error(f"Error in connect for {client_id}: {str(e)}")
             raise
-    
-    def disconnect(self, client_id: str):
-        if client_id in self.active_connections:
-            del self.active_connections[client_id]
-            logger.debug(f"Client {client_id} disconnected")
-    
-    async def broadcast_connected_clients(self):
-        client_list = list(self.active_connections.keys())
-        message = {"type": "connected_clients", "clients": client_list}
-        for client_id, connection in list(self.active_connections.items()):
-            try:
-                await connection.send_text(json.dumps(message))
-            except Exception as e:
-                logger.error(f"Error broadcasting to {client_id}: {str(e)}")
-                self.disconnect(client_id)
-    
-    async def send_personal_message(self, message: dict, client_id: str):
-        if client_id in self.active_connections:
-            try:
-                # Handle large messages that might exceed WebSocket limits for file attachments
-                if message.get("fileAttachment") and len(str(message)) > 1024 * 1024:  # If larger than 1MB
-                    logger.info(f"Large message detected with file attachment, sending in chunks")
-                    # Clone message without file attachment
-                    file_info_message = {k: v for k, v in message.items() if k != "fileAttachment"}
-                    file_info_message["fileAttachmentFollowing"] = True
-                    file_info_message["fileName"] = message["fileAttachment"].get("fileName", "unknown")
-                    file_info_message["fileSize"] = message["fileAttachment"].get("fileSize", 0)
-                    file_info_message["fileType"] = message["fileAttachment"].get("fileType", "application/octet-stream")
-                    
-                    # Send file info first
-                    await self.active_connections[client_id].send_json(file_info_message)
-                    
-                    # Then send the file attachment data in a separate message
-                    file_data_message = {
-                        "type": "file_attachment_data",
-                        "messageTimestamp": message.get("timestamp"),
-                        "sender": message.get("sender"),
-                        "fileAttachment": message["fileAttachment"]
-                    }
-                    await self.active_connections[client_id].send_json(file_data_message)
-                else:
-                    # Normal-sized message, send directly
-                    await self.active_connections[client_id].send_json(message)
-            except Exception as e:
-                logger.error(f"Error sending personal message to {client_id}: {str(e)}")
-                self.disconnect(client_id)
-    
-    def get_connection(self, client_id: str) -> Optional[WebSocket]:
-        return self.active_connections.get(client_id)
\ No newline at end of file
+
+    def disconnect(self, client_id: str, connection_id: int) -> bool:
+        """Forget one session; returns True if it was the user's last one here, so their departure is due."""
+        connection = self._connections.pop(connection_id, None)
+        if connection is None:
+            return False
+        user_sessions = self.active_connections.get(client_id, {})
+        user_sessions.pop(connection_id, None)
+        last = not user_sessions
+        if last:
+            self.active_connections.pop(client_id, None)
+        connection.outbound.close()
+        # Sent but never confirmed: deliver again later unless another session has them
+        for meta in connection.lost():
+            self._spill(meta)
+        logger.debug("Client %s disconnected (session %d)", client_id, connection_id)
+        return last
+
+    async def _drop_connection(self, outbound: OutboundQueue, close_code: int):
+        # Called by an outbound queue whose socket failed or could not keep up, and for evicted sessions
+        connection = self._connections.get(outbound.connection_id)
+        if connection is None or connection.outbound is not outbound:
+            return
+        if self.disconnect(outbound.client_id, outbound.connection_id):
+            await self.announce_departure(outbound.client_id)
+        try:
+            await outbound.websocket.close(code=close_code)
+        except Exception as e:
+            logger.debug("Error closing connection for %s: %s", outbound.client_id, e)
+
+    def _has_open_session(self, client_id: str) -> bool:
+        user_sessions = self.active_connections.get(client_id, {})
+        return any(not connection.outbound.closed for connection in user_sessions.values())
+
+    def _spill(self, meta: dict):
+        # A frame one session could not take still reaches the user while another of their sessions is open,
+        # here or on another worker (frames go to all of them); only the last one hands the message back to
+        # offline storage, so it is not delivered twice
+        recipient = meta.get("recipient")
+        if self._has_open_session(recipient) or self.router.elsewhere(recipient):
+            return
+        if self.on_spill:
+            self.on_spill(meta)
+
+    def _undelivered(self, meta: dict):
+        # No other worker could take the frame, though it may still have reached a session here
+        if not self._has_open_session(meta.get("recipient")) and self.on_spill:
+            self.on_spill(meta)
+
+    async def announce_departure(self, client_id: str):
+        """Tell the users who could see ``client_id`` that it went offline."""
+        await self.router.unregister(client_id)
+
+    async def _handle_event(self, event: dict):
+        # Presence events from every worker, including this one
+        event_type = event.get("type")
+        if event_type == "joined":
+            await self._broadcast_presence(event["client"], self.presence.delta_frame(joined=[event["client"]]))
+        elif event_type == "left":
+            self.presence.forget(event["client"])
+            await self._broadcast_presence(event["client"], self.presence.delta_frame(left=[event["client"]]))
+        elif event_type == "contact":
+            self._apply_contact(event["user"], event["peer"])
+        elif event_type == "session_revoked":
+            if self.on_session_revoked:
+                self.on_session_revoked(event["session"], event["expires"])
+            for connection in list(self._connections.values()):
+                if connection.session_id == event["session"]:
+                    await self._drop_connection(connection.outbound, 1008)
+
+    async def revoke_session(self, session_id: str, expires_at: float):
+        """Reject a logged-out session on every worker and close its sockets wherever they are connected."""
+        await self.router.emit({"type": "session_revoked", "session": session_id, "expires": expires_at})
+
+    async def send_presence_snapshot(self, client_id: str, connection_id: Optional[int] = None):
+        """Send a presence snapshot to one session, or to all of the user's sessions."""
+        frame = self.presence.snapshot_frame(client_id, self.router.online())
+        if connection_id is not None:
+            self.send_to_connection(frame, connection_id)
+        else:
+            self._put_local(client_id, frame)
+
+    async def add_contact(self, user: str, peer: str):
+        """Make two users visible to each other once they start talking (scoped presence only)."""
+        if self.presence.scoped:
+            await self.router.emit({"type": "contact", "user": user, "peer": peer})
+
+    def _apply_contact(self, user: str, peer: str):
+        if not self.presence.add_contact(user, peer):
+            return
+        for viewer, other in ((user, peer), (peer, user)):
+            if self.router.is_online(other):
+                self._put_local(viewer, self.presence.delta_frame(joined=[other], bump=False))
+
+    async def _broadcast_presence(self, client_id: str, frame: str):
+        # The frame is serialised once and queued for every session of every recipient without waiting on any
+        for other in self.presence.audience(client_id, list(self.active_connections)):
+            self._put_local(other, frame)
+
+    def _put_local(self, client_id: str, frame, meta: Optional[dict] = None) -> bool:
+        # Fan a frame out to all of a user's sessions on this worker; True if any of them took it
+        accepted = False
+        for connection in list(self.active_connections.get(client_id, {}).values()):
+            accepted = connection.put(frame, meta) or accepted
+        return accepted
+
+    async def send_personal_message(self, message: dict, client_id: str, frame: Optional[str] = None) -> bool:
+        """Queue a message for every session of a client on any worker; returns False if none could take it.
+
+        ``frame`` is the message already serialised, e.g. the sender's original
+        frame when it is relayed unchanged.
+        """
+
+        # Stored chat messages carry their id so they can be spilled back to offline storage
+        meta = None
+        if message.get("type") == "encrypted_message" and message.get("id") is not None:
+            meta = {"id": message["id"], "recipient": message.get("recipient")}
+
+        # Attachment payloads live in the blob store, so every message fits in a single frame
+        return self.send_frame(frame or dumps(message), client_id, meta)
+
+    def send_frame(self, frame: str, client_id: str, meta: Optional[dict] = None) -> bool:
+        """Queue a pre-serialised text frame for every session of a client on this and every other worker."""
+        local = self._put_local(client_id, frame, meta) if client_id in self.active_connections else False
+        remote = self.router.publish(client_id, frame, meta)
+        return local or remote
+
+    def send_to_connection(self, frame, connection_id: int) -> bool:
+        """Queue a text or binary frame for one particular session, e.g. a reply to something it sent."""
+        connection = self._connections.get(connection_id)
+        return connection.outbound.put(frame) if connection else False
+
+    def fan_out(self, frames: Dict[str, str], meta: Optional[dict] = None) -> List[str]:
+        """Queue a frame per recipient, each on whichever worker holds it; returns who it was queued for.
+
+        Queueing never waits on a socket, so every recipient's delivery starts
+        at once and a slow member cannot hold up the rest.
+        """
+        queued = []
+        for client_id, frame in frames.items():
+            member_meta = dict(meta, recipient=client_id) if meta is not None else None
+            if self.send_frame(frame, client_id, member_meta):
+                queued.append(client_id)
+        return queued
+
+    def _deliver_routed(self, client_id: str, frame: str, meta: Optional[dict]) -> bool:
+        # A frame another worker routed to one of our clients
+        if self._put_local(client_id, frame, meta):
+            return True
+        if client_id not in self.active_connections and meta is not None and self.on_spill:
+            self.on_spill(meta)
+        return False
+
+    def queue_stats(self) -> Dict[str, Dict[int, dict]]:
+        return {
+            client_id: {connection_id: connection.stats() for connection_id, connection in user_sessions.items()}
+            for client_id, user_sessions in self.active_connections.items()
+        }
+
+    def connection_count(self) -> int:
+        return len(self._connections)
+
+    def is_online(self, client_id: str) -> bool:
+        """Whether the client has a session on this or any other worker."""
+        return client_id in self.active_connections or self.router.is_online(client_id)
+
+    def get_connections(self, client_id: str) -> List[WebSocket]:
+        return [connection.websocket for connection in self.active_connections.get(client_id, {}).values()]
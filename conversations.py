@@ -0,0 +1,138 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# A user's conversations, most recently active first
+CONVERSATIONS_SQL = """
+    SELECT peer, last_message_id, last_timestamp, last_sender, last_status, unread_count
+    FROM conversations
+    WHERE owner = ?
+    ORDER BY last_message_id DESC
+    LIMIT ?
+"""
+
+# Messages from the peer the owner has not read: everything after their read position
+UNREAD_COUNT_SQL = """
+    SELECT count(*) FROM messages
+    WHERE sender = conversations.peer AND recipient = conversations.owner AND sender != recipient
+      AND id > {read_id}
+"""
+
+# Everything up to the given message (or the latest one) has been read
+MARK_READ_SQL = f"""
+    UPDATE conversations
+    SET last_read_id = max(last_read_id, coalesce(?, last_message_id)),
+        unread_count = ({UNREAD_COUNT_SQL.format(
+            read_id="max(conversations.last_read_id, coalesce(?, conversations.last_message_id))")})
+    WHERE owner = ? AND peer = ?
+"""
+
+
+def _create_triggers(cursor):
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS conversations_message_insert AFTER INSERT ON messages BEGIN
+                          INSERT INTO conversations (owner, peer, last_message_id, last_timestamp, last_sender, last_status)
+                          VALUES (new.sender, new.recipient, new.id, new.timestamp, new.sender, new.status)
+                          ON CONFLICT (owner, peer) DO UPDATE
+                          SET last_message_id = excluded.last_message_id, last_timestamp = excluded.last_timestamp,
+                              last_sender = excluded.last_sender, last_status = excluded.last_status;
+                          INSERT INTO conversations (owner, peer, last_message_id, last_timestamp, last_sender,
+                                                     last_status, unread_count)
+                          SELECT new.recipient, new.sender, new.id, new.timestamp, new.sender, new.status, 1
+                          WHERE new.recipient != new.sender
+                          ON CONFLICT (owner, peer) DO UPDATE
+                          SET last_message_id = excluded.last_message_id, last_timestamp = excluded.last_timestamp,
+                              last_sender = excluded.last_sender, last_status = excluded.last_status,
+                              unread_count = unread_count + 1;
+                      END''')
+
+    # A read receipt moves the recipient's read position up to that message, as reading it in the app does
+    cursor.execute(f'''CREATE TRIGGER IF NOT EXISTS conversations_message_status AFTER UPDATE OF status ON messages
+                       BEGIN
+                           UPDATE conversations SET last_status = new.status
+                           WHERE owner IN (new.sender, new.recipient) AND last_message_id = new.id;
+                           UPDATE conversations
+                           SET last_read_id = new.id,
+                               unread_count = ({UNREAD_COUNT_SQL.format(read_id="new.id")})
+                           WHERE new.status = 'read' AND old.status != 'read' AND new.sender != new.recipient
+                             AND owner = new.recipient AND peer = new.sender AND last_read_id < new.id;
+                       END''')
+
+    # Retention deletes old messages; only the unread count and, rarely, the last message change
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS conversations_message_delete AFTER DELETE ON messages BEGIN
+                          UPDATE conversations SET unread_count = unread_count - 1
+                          WHERE owner = old.recipient AND peer = old.sender AND old.sender != old.recipient
+                            AND old.id > last_read_id AND unread_count > 0;
+                          UPDATE conversations
+                          SET (last_message_id, last_timestamp, last_sender, last_status) = (
+                              SELECT id, timestamp, sender, status FROM messages
+                              WHERE (sender = conversations.owner AND recipient = conversations.peer)
+                                 OR (sender = conversations.peer AND recipient = conversations.owner)
+                              ORDER BY id DESC LIMIT 1)
+                          WHERE owner IN (old.sender, old.recipient) AND last_message_id = old.id
+                            AND EXISTS (
+                              SELECT 1 FROM messages
+                              WHERE (sender = conversations.owner AND recipient = conversations.peer)
+                                 OR (sender = conversations.peer AND recipient = conversations.owner));
+                          DELETE FROM conversations
+                          WHERE owner IN (old.sender, old.recipient) AND last_message_id = old.id;
+                      END''')
+
+
+def _recount(cursor):
+    # Messages already reported read are the only read position history can offer
+    cursor.execute('''UPDATE conversations
+                      SET last_read_id = max(last_read_id, coalesce((
+                          SELECT max(id) FROM messages
+                          WHERE sender = conversations.peer AND recipient = conversations.owner
+                            AND status = 'read'), 0))''')
+    cursor.execute(f"UPDATE conversations SET unread_count = ({UNREAD_COUNT_SQL.format(read_id='last_read_id')})")
+
+
+def create_conversation_summaries(cursor):
+    """Per-user conversation summaries, kept current by triggers on messages and backfilled once.
+
+    Each conversation has a row for both participants, holding the last
+    message and how many messages from the peer arrived after the owner's
+    last read position. Because the triggers run inside the writer's
+    transaction, summaries commit atomically with the messages they describe.
+    """
+    cursor.execute('''CREATE TABLE IF NOT EXISTS conversations
+                      (owner TEXT NOT NULL,
+                       peer TEXT NOT NULL,
+                       last_message_id INTEGER NOT NULL,
+                       last_timestamp TEXT NOT NULL,
+                       last_sender TEXT NOT NULL,
+                       last_status TEXT NOT NULL,
+                       unread_count INTEGER NOT NULL DEFAULT 0,
+                       last_read_id INTEGER NOT NULL DEFAULT 0,
+                       PRIMARY KEY (owner, peer))''')
+    _create_triggers(cursor)
+
+    logger.info("Building conversation summaries")
+    cursor.execute('''INSERT OR IGNORE INTO conversations (owner, peer, last_message_id, last_timestamp, last_sender,
+                                                           last_status)
+                      SELECT summary.owner, summary.peer, m.id, m.timestamp, m.sender, m.status
+                      FROM (
+                          SELECT owner, peer, max(id) AS last_id FROM (
+                              SELECT sender AS owner, recipient AS peer, id FROM messages
+                              UNION ALL
+                              SELECT recipient, sender, id FROM messages WHERE recipient != sender
+                          )
+                          GROUP BY owner, peer
+                      ) AS summary
+                      JOIN messages m ON m.id = summary.last_id''')
+    _recount(cursor)
+
+
+def recount_unread_messages(cursor):
+    """Move unread counts to the single definition the triggers now keep: messages after the read position.
+
+    Summaries built before counted only undelivered history and ignored
+    read receipts.
+    """
+    # Each count is a range scan of one conversation's messages
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_conversation ON messages (recipient, sender, id)")
+    for trigger in ("insert", "status", "delete"):
+        cursor.execute(f"DROP TRIGGER IF EXISTS conversations_message_{trigger}")
+    _create_triggers(cursor)
+    _recount(cursor)
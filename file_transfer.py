@@ -0,0 +1,282 @@
+import asyncio
+import json
+import logging
+import os
+import struct
+import time
+import uuid
+from typing import Dict, Iterable, Optional, Tuple
+
+from blob_store import BlobStore
+from groups import GroupDirectory
+
+logger = logging.getLogger(__name__)
+
+# Where transfer payloads are spooled while uploading
+TRANSFER_DIR = "transfers"
+# Largest encrypted payload accepted for a single transfer (10MB file + AES-GCM overhead)
+MAX_TRANSFER_SIZE = 10 * 1024 * 1024 + 1024
+# Payload bytes per binary frame, and how many unacknowledged bytes may be in flight
+CHUNK_SIZE = 64 * 1024
+WINDOW_SIZE = 16 * CHUNK_SIZE
+# Incomplete uploads are discarded after this many seconds without progress
+TRANSFER_TTL = 60 * 60
+# How often abandoned uploads are looked for (seconds)
+CLEANUP_INTERVAL = 5 * 60
+
+# Binary frame header: 16-byte transfer UUID followed by the byte offset of the payload
+FRAME_HEADER = struct.Struct("!16sQ")
+
+
+class TransferError(Exception):
+    pass
+
+
+def encode_frame(transfer_id: str, offset: int, payload: bytes) -> bytes:
+    return FRAME_HEADER.pack(uuid.UUID(transfer_id).bytes, offset) + payload
+
+
+def decode_frame(frame: bytes) -> Tuple[str, int, memoryview]:
+    if len(frame) < FRAME_HEADER.size:
+        raise TransferError("Binary frame too short")
+    raw_id, offset = FRAME_HEADER.unpack_from(frame)
+    return str(uuid.UUID(bytes=raw_id)), offset, memoryview(frame)[FRAME_HEADER.size:]
+
+
+class Transfer:
+    def __init__(self, transfer_id: str, owner: str, readers: Iterable[str], size: int, path: str):
+        self.transfer_id = transfer_id
+        self.owner = owner
+        # Recipients of every message the payload was attached to; each of them may download it
+        self.readers = set(readers)
+        self.size = size
+        self.path = path
+        self.blob_id: Optional[str] = None
+        self.received = 0
+        self.updated_at = time.monotonic()
+
+    @property
+    def complete(self) -> bool:
+        return self.received >= self.size
+
+    def can_read(self, client_id: str) -> bool:
+        return client_id == self.owner or client_id in self.readers
+
+
+class FileTransferManager:
+    """Chunked, resumable storage of encrypted attachment payloads.
+
+    Uploads arrive as binary frames (see ``FRAME_HEADER``) and are written
+    straight to a spool file at their offset, so no full in-memory copy of a
+    file is ever built. Progress is tracked per transfer id: a client that
+    reconnects simply restarts the upload and is told how many bytes the
+    server already has. Completed payloads are moved into the blob store and
+    get a metadata sidecar so they can still be downloaded after a restart.
+    All file I/O runs in the default executor, never on the event loop.
+    """
+
+    def __init__(self, blob_store: BlobStore, directory: str = TRANSFER_DIR,
+                 max_size: int = MAX_TRANSFER_SIZE, chunk_size: int = CHUNK_SIZE,
+                 window_size: int = WINDOW_SIZE, groups: Optional[GroupDirectory] = None):
+        self.blob_store = blob_store
+        # Resolves readers named as a whole group ("group:<id>") to the group's members
+        self.groups = groups
+        self.directory = directory
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        self.window_size = window_size
+        self._transfers: Dict[str, Transfer] = {}
+        self._cleanup_task: Optional[asyncio.Task] = None
+        os.makedirs(directory, exist_ok=True)
+
+    def start(self):
+        """Discard abandoned uploads periodically, including spool files left behind by an earlier run."""
+        self._cleanup_task = asyncio.create_task(self._cleanup())
+
+    def stop(self):
+        if self._cleanup_task:
+            self._cleanup_task.cancel()
+            self._cleanup_task = None
+
+    async def _cleanup(self):
+        while True:
+            await asyncio.sleep(CLEANUP_INTERVAL)
+            try:
+                await self.expire_stale()
+            except Exception as e:
+                logger.error(f"Transfer cleanup failed: {str(e)}")
+
+    def _paths(self, transfer_id: str) -> Tuple[str, str]:
+        base = os.path.join(self.directory, transfer_id)
+        return base + ".bin", base + ".json"
+
+    @staticmethod
+    def _normalise_id(transfer_id) -> Optional[str]:
+        # Transfer ids name files, so only well-formed UUIDs are accepted
+        try:
+            return str(uuid.UUID(transfer_id))
+        except (TypeError, ValueError, AttributeError):
+            return None
+
+    async def start_upload(self, owner: str, transfer_id: str, recipient: str, size: int) -> Transfer:
+        """Begin an upload, or resume it if the owner already started one with this id."""
+        transfer_id = self._normalise_id(transfer_id)
+        if transfer_id is None:
+            raise TransferError("Invalid transfer id")
+        if not isinstance(size, int) or size <= 0 or size > self.max_size:
+            raise TransferError(f"Invalid transfer size: {size}")
+
+        transfer = await self.get(transfer_id)
+        if transfer:
+            if transfer.owner != owner or transfer.size != size:
+                raise TransferError("Transfer id already in use")
+            transfer.updated_at = time.monotonic()
+            return transfer
+
+        data_path, _ = self._paths(transfer_id)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._create, data_path)
+        transfer = Transfer(transfer_id, owner, [recipient] if recipient else [], size, data_path)
+        self._transfers[transfer_id] = transfer
+        logger.debug("Started transfer %s from %s (%d bytes)", transfer_id, owner, size)
+        return transfer
+
+    async def write_chunk(self, owner: str, frame: bytes) -> Tuple[Transfer, bool]:
+        """Store one upload frame; returns the transfer and whether the frame was in sequence."""
+        transfer_id, offset, payload = decode_frame(frame)
+        transfer = self._transfers.get(transfer_id)
+        if not transfer or transfer.owner != owner:
+            raise TransferError("Unknown transfer")
+        if offset != transfer.received:
+            # Duplicate or out-of-order frame: report where the client should resume from
+            return transfer, False
+        if offset + len(payload) > transfer.size:
+            raise TransferError("Chunk exceeds declared transfer size")
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._write_at, transfer.path, offset, payload)
+        transfer.received += len(payload)
+        transfer.updated_at = time.monotonic()
+        if transfer.complete:
+            await self.store_blob(transfer)
+            logger.debug("Transfer %s complete, stored as blob %s", transfer_id, transfer.blob_id)
+        return transfer, True
+
+    async def store_blob(self, transfer: Transfer) -> str:
+        """Move a completed transfer's payload into the blob store; returns its blob id."""
+        if transfer.blob_id is None:
+            transfer.blob_id, _ = await self.blob_store.put_file(transfer.path)
+            transfer.path = self.blob_store.path(transfer.blob_id)
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self._write_sidecar, transfer)
+        return transfer.blob_id
+
+    async def grant(self, transfer: Transfer, reader: str):
+        """Let ``reader`` download a completed transfer, e.g. because it was attached to a message for them."""
+        if reader in transfer.readers:
+            return
+        transfer.readers.add(reader)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._write_sidecar, transfer)
+
+    @staticmethod
+    def _create(path: str):
+        open(path, "wb").close()
+
+    @staticmethod
+    def _write_at(path: str, offset: int, payload: memoryview):
+        with open(path, "r+b") as f:
+            f.seek(offset)
+            f.write(payload)
+
+    def _write_sidecar(self, transfer: Transfer):
+        _, meta_path = self._paths(transfer.transfer_id)
+        with open(meta_path, "w") as f:
+            json.dump({"owner": transfer.owner, "readers": sorted(transfer.readers),
+                       "size": transfer.size, "blob_id": transfer.blob_id}, f)
+
+    def _read_sidecar(self, transfer_id: str) -> Optional[dict]:
+        _, meta_path = self._paths(transfer_id)
+        try:
+            with open(meta_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    async def get(self, transfer_id: str) -> Optional[Transfer]:
+        transfer_id = self._normalise_id(transfer_id)
+        if transfer_id is None:
+            return None
+        transfer = self._transfers.get(transfer_id)
+        if transfer:
+            return transfer
+        # Completed transfers from a previous run are reloaded from their sidecar
+        loop = asyncio.get_running_loop()
+        meta = await loop.run_in_executor(None, self._read_sidecar, transfer_id)
+        if meta is None:
+            return None
+        # Transfers finished before the blob store existed still point at their spool file, and
+        # sidecars written before a payload could be attached more than once name a single recipient
+        data_path, _ = self._paths(transfer_id)
+        blob_id = meta.get("blob_id")
+        readers = meta.get("readers") or [meta["recipient"]]
+        transfer = Transfer(transfer_id, meta["owner"], readers, meta["size"],
+                            self.blob_store.path(blob_id) if blob_id else data_path)
+        transfer.blob_id = blob_id
+        transfer.received = transfer.size
+        self._transfers[transfer_id] = transfer
+        return transfer
+
+    async def get_complete(self, transfer_id: str, owner: str) -> Optional[Transfer]:
+        """Look up a finished upload that ``owner`` may attach to a message."""
+        transfer = await self.get(transfer_id)
+        if not transfer or not transfer.complete or transfer.owner != owner:
+            return None
+        return transfer
+
+    async def can_read(self, transfer: Transfer, client_id: str) -> bool:
+        """Whether ``client_id`` may download ``transfer``, as its owner, a reader or a member of a reading group."""
+        if transfer.can_read(client_id):
+            return True
+        if self.groups is None:
+            return False
+        for reader in transfer.readers:
+            if await self.groups.includes(reader, client_id):
+                return True
+        return False
+
+    async def read_chunk(self, transfer: Transfer, offset: int) -> bytes:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._read_at, transfer.path, offset, self.chunk_size)
+
+    @staticmethod
+    def _read_at(path: str, offset: int, length: int) -> bytes:
+        with open(path, "rb") as f:
+            f.seek(offset)
+            return f.read(length)
+
+    async def expire_stale(self) -> int:
+        """Discard uploads without progress for ``TRANSFER_TTL``; returns how many spool files were removed."""
+        now = time.monotonic()
+        for transfer_id, transfer in list(self._transfers.items()):
+            if not transfer.complete and now - transfer.updated_at > TRANSFER_TTL:
+                del self._transfers[transfer_id]
+                logger.info(f"Discarded stale transfer {transfer_id}")
+        # Whatever is not being uploaded now is either stale or from before a restart
+        active = {transfer.path for transfer in self._transfers.values() if not transfer.complete}
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._remove_spools, active)
+
+    def _remove_spools(self, active) -> int:
+        removed = 0
+        cutoff = time.time() - TRANSFER_TTL
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".bin") or entry.path in active:
+                continue
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+                    removed += 1
+            except OSError:
+                pass
+        return removed
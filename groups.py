@@ -0,0 +1,156 @@
+import logging
+import sqlite3
+from typing import Dict, List, Optional, Tuple
+
+from storage import Database
+
+logger = logging.getLogger(__name__)
+
+# Largest group that can be created; every message carries one key per member
+MAX_GROUP_MEMBERS = 256
+
+# How a whole group is named where a single recipient is expected, e.g. as the reader of an upload
+GROUP_RECIPIENT_PREFIX = "group:"
+
+# A group message as one member receives it: the shared payload plus that member's copy of the key.
+# Rendered by SQLite like MESSAGE_JSON_SQL, so stored messages are sent without re-serialising them.
+GROUP_MESSAGE_JSON_SQL = """
+    json_object(
+        'type', 'group_message', 'id', m.id, 'groupId', m.group_id, 'sender', m.sender,
+        'encryptedContent', m.encrypted_content, 'iv', m.iv, 'encryptedAESKey', k.encrypted_aes_key,
+        'timestamp', m.timestamp, 'status', k.status,
+        'fileAttachment', CASE WHEN json_valid(m.file_attachment) THEN json(m.file_attachment) END
+    )
+"""
+
+PENDING_GROUP_MESSAGES_SQL = f"""
+    SELECT m.id, {GROUP_MESSAGE_JSON_SQL}
+    FROM group_message_keys k
+    JOIN group_messages m ON m.id = k.message_id
+    WHERE k.member = ? AND k.status = 'sent' AND k.message_id > ?
+    ORDER BY k.message_id
+    LIMIT ?
+"""
+
+# One page of a group's history for one member, newest first
+GROUP_HISTORY_SQL = f"""
+    SELECT m.id, {GROUP_MESSAGE_JSON_SQL}
+    FROM group_message_keys k
+    JOIN group_messages m ON m.id = k.message_id
+    WHERE k.member = ? AND m.group_id = ? AND k.message_id < ?
+    ORDER BY k.message_id DESC
+    LIMIT ?
+"""
+
+USER_GROUPS_SQL = """
+    SELECT g.id, g.name, g.created_by,
+           (SELECT json_group_array(username) FROM group_members WHERE group_id = g.id) AS members
+    FROM group_members mine
+    JOIN chat_groups g ON g.id = mine.group_id
+    WHERE mine.username = ?
+    ORDER BY g.id DESC
+"""
+
+
+def create_group_tables(cursor):
+    """Groups with a fixed membership, and their messages stored once with a key row per member.
+
+    A group message's ciphertext and attachment reference live in a single
+    ``group_messages`` row; ``group_message_keys`` holds each member's copy of
+    the message key and that member's delivery status, keyed so that one
+    member's pending messages and history are a primary-key range.
+    """
+    cursor.execute('''CREATE TABLE IF NOT EXISTS chat_groups
+                      (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                       name TEXT NOT NULL,
+                       created_by TEXT NOT NULL,
+                       FOREIGN KEY (created_by) REFERENCES users(username))''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS group_members
+                      (group_id INTEGER NOT NULL,
+                       username TEXT NOT NULL,
+                       PRIMARY KEY (group_id, username),
+                       FOREIGN KEY (group_id) REFERENCES chat_groups(id),
+                       FOREIGN KEY (username) REFERENCES users(username)) WITHOUT ROWID''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_group_members_username ON group_members (username, group_id)")
+    cursor.execute('''CREATE TABLE IF NOT EXISTS group_messages
+                      (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                       group_id INTEGER NOT NULL,
+                       sender TEXT NOT NULL,
+                       encrypted_content TEXT NOT NULL,
+                       iv TEXT NOT NULL,
+                       timestamp TEXT NOT NULL,
+                       file_attachment TEXT,
+                       attachment_blob TEXT,
+                       FOREIGN KEY (group_id) REFERENCES chat_groups(id),
+                       FOREIGN KEY (sender) REFERENCES users(username))''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS idx_group_messages_attachment_blob ON group_messages (attachment_blob)
+                      WHERE attachment_blob IS NOT NULL''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS group_message_keys
+                      (member TEXT NOT NULL,
+                       message_id INTEGER NOT NULL,
+                       encrypted_aes_key TEXT NOT NULL,
+                       status TEXT NOT NULL DEFAULT 'sent',
+                       PRIMARY KEY (member, message_id),
+                       FOREIGN KEY (message_id) REFERENCES group_messages(id)) WITHOUT ROWID''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS idx_group_message_keys_pending ON group_message_keys (member, message_id)
+                      WHERE status = 'sent' ''')
+
+
+def group_recipient(group_id: int) -> str:
+    return f"{GROUP_RECIPIENT_PREFIX}{group_id}"
+
+
+def _insert_group(conn: sqlite3.Connection, name: str, creator: str, members: List[str]) -> Optional[int]:
+    with conn:
+        known = {row[0] for row in conn.execute(
+            f"SELECT username FROM users WHERE username IN ({', '.join('?' * len(members))})", members)}
+        if known != set(members):
+            return None
+        group_id = conn.execute("INSERT INTO chat_groups (name, created_by) VALUES (?, ?)", (name, creator)).lastrowid
+        conn.executemany("INSERT INTO group_members (group_id, username) VALUES (?, ?)",
+                         [(group_id, member) for member in members])
+        return group_id
+
+
+class GroupDirectory:
+    """Group membership, cached in memory.
+
+    Membership is fixed when a group is created, so a cached member list can
+    never go stale and every worker may keep its own copy.
+    """
+
+    def __init__(self, db: Database):
+        self.db = db
+        self._members: Dict[int, Tuple[str, ...]] = {}
+
+    async def create(self, name: str, creator: str, members: List[str]) -> Optional[Tuple[int, Tuple[str, ...]]]:
+        """Create a group of ``creator`` and ``members``; returns its id and members, or None if a user is unknown."""
+        everyone = tuple(sorted({creator, *members}))
+        group_id = await self.db.run(_insert_group, name, creator, list(everyone))
+        if group_id is None:
+            return None
+        self._members[group_id] = everyone
+        logger.info(f"Group {group_id} created by {creator} with {len(everyone)} members")
+        return group_id, everyone
+
+    async def members(self, group_id: int) -> Tuple[str, ...]:
+        """Members of a group; empty if it does not exist."""
+        cached = self._members.get(group_id)
+        if cached is None:
+            rows = await self.db.fetchall("SELECT username FROM group_members WHERE group_id = ?", (group_id,))
+            cached = tuple(row[0] for row in rows)
+            if cached:
+                self._members[group_id] = cached
+        return cached
+
+    async def includes(self, recipient: str, username: str) -> bool:
+        """Whether ``username`` is ``recipient`` or, for a group recipient, one of the group's members."""
+        if recipient == username:
+            return True
+        if not recipient.startswith(GROUP_RECIPIENT_PREFIX):
+            return False
+        try:
+            group_id = int(recipient[len(GROUP_RECIPIENT_PREFIX):])
+        except ValueError:
+            return False
+        return username in await self.members(group_id)
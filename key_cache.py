@@ -0,0 +1,71 @@
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Public keys kept in memory, and for how long before they are re-read (seconds)
+MAX_CACHED_KEYS = 10000
+KEY_TTL = 300
+
+
+def key_etag(public_key: str) -> str:
+    """Strong validator for a public key, derived from its content."""
+    return '"' + hashlib.sha256(public_key.encode()).hexdigest()[:32] + '"'
+
+
+class PublicKeyCache:
+    """LRU cache of users' public keys with a time-to-live.
+
+    Entries hold the key and its ETag. The TTL bounds how long another
+    worker's view of a changed key can be stale; ``invalidate`` drops an
+    entry immediately when the key is known to have changed in this process.
+    """
+
+    def __init__(self, max_entries: int = MAX_CACHED_KEYS, ttl: float = KEY_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[str, str, float]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, username: str) -> Optional[Tuple[str, str]]:
+        """Return (public_key, etag) for a cached user, or None."""
+        entry = self._entries.get(username)
+        if entry is None or entry[2] < time.monotonic():
+            if entry is not None:
+                del self._entries[username]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(username)
+        self.hits += 1
+        return entry[0], entry[1]
+
+    def get_many(self, usernames: Iterable[str]) -> Tuple[Dict[str, str], List[str]]:
+        """Split usernames into cached keys and the ones that still have to be loaded."""
+        found = {}
+        missing = []
+        for username in usernames:
+            entry = self.get(username)
+            if entry:
+                found[username] = entry[0]
+            else:
+                missing.append(username)
+        return found, missing
+
+    def put(self, username: str, public_key: str) -> str:
+        """Cache a user's key; returns its ETag."""
+        etag = key_etag(public_key)
+        self._entries[username] = (public_key, etag, time.monotonic() + self.ttl)
+        self._entries.move_to_end(username)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return etag
+
+    def invalidate(self, username: str):
+        self._entries.pop(username, None)
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
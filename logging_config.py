@@ -0,0 +1,145 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+from typing import Any, Dict, Optional
+
+# Root level and per-module overrides, e.g. LOG_LEVELS="websocket_handler=DEBUG,storage=WARNING"
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+LOG_LEVELS = os.environ.get("LOG_LEVELS", "")
+# "text" for people, "json" for log shippers
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")
+# Fraction of DEBUG records kept, so debug logging can stay on under load
+LOG_DEBUG_SAMPLE_RATE = float(os.environ.get("LOG_DEBUG_SAMPLE_RATE", "1.0"))
+
+# Characters of a message payload written to the log before it is cut off
+PAYLOAD_LOG_LIMIT = 256
+
+# Records waiting for the writer thread; beyond this, new records are dropped rather than block
+LOG_QUEUE_SIZE = 10000
+
+TEXT_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+# Attributes every LogRecord has; anything else on a record came from ``extra=``
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+class Payload:
+    """Log argument that renders a message payload truncated to ``limit`` characters.
+
+    Nothing is sliced or copied unless the record is actually formatted,
+    which happens on the logging thread.
+    """
+
+    __slots__ = ("value", "limit")
+
+    def __init__(self, value: Any, limit: int = PAYLOAD_LOG_LIMIT):
+        self.value = value
+        self.limit = limit
+
+    def __str__(self) -> str:
+        text = self.value if isinstance(self.value, str) else str(self.value)
+        if len(text) <= self.limit:
+            return text
+        return f"{text[:self.limit]}... ({len(text)} chars)"
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per record, with fields passed through ``extra=`` kept as keys."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith("_"):
+                entry[key] = value if isinstance(value, (str, int, float, bool, type(None))) else str(value)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class DebugSampler(logging.Filter):
+    """Keeps every record at INFO and above and a random fraction of DEBUG records."""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno > logging.DEBUG or random.random() < self.rate
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    # The stock handler formats the message before queueing it, on the caller's thread.
+    # Records are queued untouched instead, so formatting happens on the listener thread;
+    # log arguments must therefore not be mutated after the call.
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+
+def _parse_levels(spec: str) -> Dict[str, str]:
+    levels = {}
+    for item in spec.split(","):
+        name, _, level = item.partition("=")
+        if name.strip() and level.strip():
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def configure_logging(level: str = LOG_LEVEL, levels: str = LOG_LEVELS, fmt: str = LOG_FORMAT,
+                      debug_sample_rate: float = LOG_DEBUG_SAMPLE_RATE):
+    """Route every log record through a queue to a single writer thread.
+
+    Loggers below their configured level return before a record is built, and
+    records that are built are formatted and written off the event loop.
+    Calling this again replaces the previous configuration.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+
+    output = logging.StreamHandler(sys.stderr)
+    output.setFormatter(JSONFormatter() if fmt == "json" else logging.Formatter(TEXT_FORMAT))
+    records: "queue.Queue[logging.LogRecord]" = queue.Queue(LOG_QUEUE_SIZE)
+    handler = _DeferredQueueHandler(records)
+    if debug_sample_rate < 1.0:
+        handler.addFilter(DebugSampler(debug_sample_rate))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level.upper())
+    for name, module_level in _parse_levels(levels).items():
+        logging.getLogger(name).setLevel(module_level)
+
+    _listener = logging.handlers.QueueListener(records, output)
+    _listener.start()
+
+
+def _stop_listener():
+    # Flush whatever is still queued when the process exits
+    if _listener is not None:
+        try:
+            _listener.stop()
+        except queue.Full:
+            pass
+
+
+atexit.register(_stop_listener)
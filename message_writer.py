@@ -0,0 +1,329 @@
+import asyncio
+import logging
+import time
+from typing import Any, List, Optional, Sequence, Tuple
+
+from storage import SYNCHRONOUS, Database
+
+logger = logging.getLogger(__name__)
+
+# Upper bound on operations committed in one transaction
+MAX_BATCH_SIZE = 256
+# How long a batch may wait for more writes before it is committed (seconds)
+FLUSH_INTERVAL = 0.002
+
+INSERT_MESSAGE_SQL = """
+    INSERT INTO messages (
+        sender, recipient, encrypted_content, iv,
+        encrypted_aes_key, timestamp, status, file_attachment, attachment_blob
+    )
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+# Messages are addressed by their server-assigned id, so a status change is a primary-key update
+UPDATE_STATUS_SQL = """
+    UPDATE messages
+    SET status = ?
+    WHERE id = ?
+"""
+
+# A message relayed but never confirmed goes back to pending. 'delivered' alone may only be the server's
+# assumption; one the recipient has acknowledged, or already spilled by another path, is left alone.
+REQUEUE_SQL = """
+    UPDATE messages
+    SET status = 'sent'
+    WHERE id = ? AND status = 'delivered' AND NOT confirmed
+"""
+
+INSERT_GROUP_MESSAGE_SQL = """
+    INSERT INTO group_messages (group_id, sender, encrypted_content, iv, timestamp, file_attachment, attachment_blob)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+
+INSERT_GROUP_KEY_SQL = """
+    INSERT INTO group_message_keys (message_id, member, encrypted_aes_key, status)
+    VALUES (?, ?, ?, ?)
+"""
+
+# Delivery status of a group message for some of its members; the member list is appended per batch
+UPDATE_GROUP_STATUS_SQL = """
+    UPDATE group_message_keys
+    SET status = ?
+    WHERE message_id = ? AND member IN ({placeholders})
+"""
+
+# The same for some members of a group message; the member list is appended per batch
+REQUEUE_GROUP_SQL = """
+    UPDATE group_message_keys
+    SET status = 'sent'
+    WHERE message_id = ? AND status = 'delivered' AND NOT confirmed AND member IN ({placeholders})
+"""
+
+# Group messages acknowledged by a member in one go, whether still pending or assumed delivered;
+# the id list is appended per batch
+ACK_GROUP_MESSAGES_SQL = """
+    UPDATE group_message_keys
+    SET status = 'delivered', confirmed = 1
+    WHERE member = ? AND status IN ('sent', 'delivered') AND message_id IN ({placeholders})
+"""
+
+# A stored message rendered as its wire-format JSON by SQLite, so rows can be sent without
+# being turned into dicts and serialised again; the attachment JSON is spliced in as-is
+MESSAGE_JSON_SQL = """
+    json_object(
+        'type', 'encrypted_message', 'id', id, 'sender', sender, 'recipient', recipient,
+        'encryptedContent', encrypted_content, 'iv', iv, 'encryptedAESKey', encrypted_aes_key,
+        'timestamp', timestamp, 'status', status,
+        'fileAttachment', CASE WHEN json_valid(file_attachment) THEN json(file_attachment) END
+    )
+"""
+
+# Senders are told a message is stored once its batch commits, so batches fsync on commit, unlike the
+# pool's other connections; that one fsync is shared by every write in the batch
+BATCH_SYNCHRONOUS = "FULL"
+
+# Statuses only move forward: sent -> delivered -> read
+STATUS_ORDER = ("sent", "delivered", "read")
+
+# Messages acknowledged by their recipient in one go, by id and by inclusive id range. The id
+# conditions are appended per batch; the senders are returned so they can be told.
+ACK_MESSAGES_SQL = """
+    UPDATE messages
+    SET status = ?
+    WHERE recipient = ? AND status IN ({earlier}) AND ({selection})
+    RETURNING id, sender
+"""
+
+# Any acknowledgement, even one that moves no status, shows the recipient has the message
+CONFIRM_MESSAGES_SQL = """
+    UPDATE messages
+    SET confirmed = 1
+    WHERE recipient = ? AND NOT confirmed AND ({selection})
+"""
+
+
+class MessageWriter:
+    """Write-behind queue that group-commits message inserts and status updates.
+
+    Writes from every WebSocket are queued and committed together in a single
+    transaction, so N concurrent messages cost one fsync instead of N. The
+    first queued write opens a batch, which keeps collecting writes for up to
+    ``flush_interval`` seconds, or until ``max_batch_size`` is reached, before
+    it is committed; writes arriving while a commit is in flight form the next
+    batch. Each caller's future resolves only after the transaction holding its
+    write has committed and been synced to disk.
+    """
+
+    def __init__(self, db: Database, max_batch_size: int = MAX_BATCH_SIZE,
+                 flush_interval: float = FLUSH_INTERVAL):
+        self.db = db
+        self.max_batch_size = max_batch_size
+        self.flush_interval = flush_interval
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+        # Committed batches and the operations and seconds they took
+        self.batches = 0
+        self.operations = 0
+        self.commit_seconds = 0.0
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Flush everything queued so far and stop the background writer."""
+        if self._task is None:
+            return
+        self._queue.put_nowait(None)
+        await self._task
+        self._task = None
+
+    def _enqueue(self, kind: str, params: tuple) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((kind, params, future))
+        return future
+
+    async def insert_message(self, sender: str, recipient: str, encrypted_content: str, iv: str,
+                             encrypted_aes_key: str, timestamp: str, status: str,
+                             file_attachment_json: Optional[str],
+                             attachment_blob: Optional[str] = None) -> int:
+        """Queue a message insert and wait until it is durable; returns the new row id."""
+        return await self._enqueue("insert", (
+            sender, recipient, encrypted_content, iv,
+            encrypted_aes_key, timestamp, status, file_attachment_json, attachment_blob
+        ))
+
+    async def insert_group_message(self, group_id: int, sender: str, encrypted_content: str, iv: str,
+                                   timestamp: str, file_attachment_json: Optional[str],
+                                   attachment_blob: Optional[str],
+                                   keys: Sequence[Tuple[str, str, str]]) -> int:
+        """Queue a group message, stored once, with its ``(member, encrypted key, status)`` rows; returns its id."""
+        return await self._enqueue("group_insert", (
+            (group_id, sender, encrypted_content, iv, timestamp, file_attachment_json, attachment_blob),
+            tuple(keys)
+        ))
+
+    def update_group_status(self, message_id: int, members: Sequence[str], status: str) -> asyncio.Future:
+        """Queue a status update of one group message for the given members."""
+        future = self._enqueue("group_status", (status, message_id, *members))
+        future.add_done_callback(self._log_failed_update)
+        return future
+
+    def requeue_group(self, message_id: int, members: Sequence[str]) -> asyncio.Future:
+        """Queue a group message to go back to pending for members it was marked delivered to."""
+        future = self._enqueue("group_requeue", (message_id, *members))
+        future.add_done_callback(self._log_failed_update)
+        return future
+
+    def acknowledge_group(self, member: str, message_ids: Sequence[int]) -> asyncio.Future:
+        """Queue a single update marking a member's acknowledged group messages as confirmed 'delivered'."""
+        future = self._enqueue("group_ack", (member, *message_ids))
+        future.add_done_callback(self._log_failed_update)
+        return future
+
+    def update_status(self, message_id: int, status: str) -> asyncio.Future:
+        """Queue a status update; await the returned future to wait for the commit."""
+        future = self._enqueue("status", (status, message_id))
+        future.add_done_callback(self._log_failed_update)
+        return future
+
+    def requeue(self, message_id: int) -> asyncio.Future:
+        """Queue a message marked delivered to go back to pending for later delivery."""
+        future = self._enqueue("requeue", (message_id,))
+        future.add_done_callback(self._log_failed_update)
+        return future
+
+    def acknowledge(self, recipient: str, status: str, message_ids: Sequence[int] = (),
+                    ranges: Sequence[Tuple[int, int]] = ()) -> asyncio.Future:
+        """Queue a single update moving the recipient's acknowledged messages forward to ``status``.
+
+        The future resolves to the ``(id, sender)`` pairs that actually changed.
+        """
+        future = self._enqueue("ack", (recipient, status, tuple(message_ids), tuple(ranges)))
+        future.add_done_callback(self._log_failed_update)
+        return future
+
+    @staticmethod
+    def _log_failed_update(future: asyncio.Future):
+        if not future.cancelled() and future.exception():
+            logger.error("Error updating message status: %s", future.exception())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            op = await self._queue.get()
+            if op is None:
+                break
+            batch = [op]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.max_batch_size:
+                try:
+                    op = self._queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        op = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if op is None:
+                    stopping = True
+                    break
+                batch.append(op)
+            await self._flush(batch)
+
+    async def _flush(self, batch: List[Tuple[str, tuple, asyncio.Future]]):
+        ops = [(kind, params) for kind, params, _ in batch]
+        started_at = time.perf_counter()
+        try:
+            results = await self.db.run(self._write_batch, ops)
+        except Exception as e:
+            # Retry one by one so a single bad write cannot fail its whole batch
+            logger.error("Batched write of %d operations failed, retrying individually: %s", len(batch), e)
+            for kind, params, future in batch:
+                try:
+                    result = (await self.db.run(self._write_batch, [(kind, params)]))[0]
+                except Exception as op_error:
+                    if not future.done():
+                        future.set_exception(op_error)
+                else:
+                    if not future.done():
+                        future.set_result(result)
+            return
+
+        self.batches += 1
+        self.operations += len(batch)
+        self.commit_seconds += time.perf_counter() - started_at
+        logger.debug("Committed batch of %d message writes", len(batch))
+        for (_, _, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize(),
+            "batches": self.batches,
+            "operations": self.operations,
+            "commit_seconds": self.commit_seconds,
+        }
+
+    @staticmethod
+    def _ack_statements(recipient: str, status: str, message_ids: Tuple[int, ...],
+                        ranges: Tuple[Tuple[int, int], ...]) -> List[Tuple[str, list]]:
+        earlier = STATUS_ORDER[:STATUS_ORDER.index(status)]
+        selection = ["id BETWEEN ? AND ?"] * len(ranges)
+        selected: list = []
+        for first, last in ranges:
+            selected += [first, last]
+        if message_ids:
+            selection.append(f"id IN ({', '.join('?' * len(message_ids))})")
+            selected += message_ids
+        confirm = CONFIRM_MESSAGES_SQL.format(selection=" OR ".join(selection))
+        ack = ACK_MESSAGES_SQL.format(earlier=", ".join("?" * len(earlier)), selection=" OR ".join(selection))
+        return [(confirm, [recipient, *selected]), (ack, [status, recipient, *earlier, *selected])]
+
+    @staticmethod
+    def _write_batch(conn, ops: List[Tuple[str, tuple]]) -> List[Any]:
+        c = conn.cursor()
+        results = []
+        c.execute(f"PRAGMA synchronous = {BATCH_SYNCHRONOUS}")
+        try:
+            with conn:
+                for kind, params in ops:
+                    if kind == "insert":
+                        c.execute(INSERT_MESSAGE_SQL, params)
+                        results.append(c.lastrowid)
+                    elif kind == "ack":
+                        confirm, ack = MessageWriter._ack_statements(*params)
+                        c.execute(*confirm)
+                        c.execute(*ack)
+                        results.append(c.fetchall())
+                    elif kind == "group_insert":
+                        message, keys = params
+                        c.execute(INSERT_GROUP_MESSAGE_SQL, message)
+                        message_id = c.lastrowid
+                        c.executemany(INSERT_GROUP_KEY_SQL, [(message_id, *key) for key in keys])
+                        results.append(message_id)
+                    elif kind == "group_status":
+                        placeholders = ", ".join("?" * (len(params) - 2))
+                        c.execute(UPDATE_GROUP_STATUS_SQL.format(placeholders=placeholders), params)
+                        results.append(c.rowcount)
+                    elif kind == "requeue":
+                        c.execute(REQUEUE_SQL, params)
+                        results.append(c.rowcount)
+                    elif kind == "group_requeue":
+                        placeholders = ", ".join("?" * (len(params) - 1))
+                        c.execute(REQUEUE_GROUP_SQL.format(placeholders=placeholders), params)
+                        results.append(c.rowcount)
+                    elif kind == "group_ack":
+                        placeholders = ", ".join("?" * (len(params) - 1))
+                        c.execute(ACK_GROUP_MESSAGES_SQL.format(placeholders=placeholders), params)
+                        results.append(c.rowcount)
+                    else:
+                        c.execute(UPDATE_STATUS_SQL, params)
+                        results.append(c.rowcount)
+        finally:
+            c.execute(f"PRAGMA synchronous = {SYNCHRONOUS}")
+        return results
@@ -0,0 +1,107 @@
+import logging
+import sqlite3
+from typing import Callable, List
+
+from conversations import create_conversation_summaries, recount_unread_messages
+from groups import create_group_tables
+from retention import create_orphaned_blobs_table, create_retention_tables
+from user_search import create_search_index
+
+logger = logging.getLogger(__name__)
+
+
+def _columns(cursor, table: str) -> List[str]:
+    return [column[1] for column in cursor.execute(f"PRAGMA table_info({table})").fetchall()]
+
+
+def _create_base_tables(cursor):
+    cursor.execute('''CREATE TABLE IF NOT EXISTS users
+                      (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                       username TEXT UNIQUE NOT NULL,
+                       email TEXT UNIQUE NOT NULL,
+                       password_hash TEXT NOT NULL,
+                       public_key TEXT NOT NULL)''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS messages
+                      (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                       sender TEXT NOT NULL,
+                       recipient TEXT NOT NULL,
+                       encrypted_content TEXT NOT NULL,
+                       iv TEXT NOT NULL,
+                       encrypted_aes_key TEXT NOT NULL,
+                       timestamp TEXT NOT NULL,
+                       status TEXT NOT NULL DEFAULT 'sent',
+                       file_attachment TEXT,
+                       FOREIGN KEY (sender) REFERENCES users(username),
+                       FOREIGN KEY (recipient) REFERENCES users(username))''')
+    # Databases from before file attachments existed
+    if "file_attachment" not in _columns(cursor, "messages"):
+        cursor.execute("ALTER TABLE messages ADD COLUMN file_attachment TEXT")
+
+
+def _add_history_indexes(cursor):
+    # History lookups walk these in timestamp order for either side of a conversation
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_sender_timestamp ON messages (sender, timestamp)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_recipient_timestamp ON messages (recipient, timestamp)")
+
+
+def _add_attachment_blobs(cursor):
+    # Attachment payloads are kept in the blob store and referenced by hash
+    if "attachment_blob" not in _columns(cursor, "messages"):
+        cursor.execute("ALTER TABLE messages ADD COLUMN attachment_blob TEXT")
+    cursor.execute('''CREATE INDEX IF NOT EXISTS idx_messages_attachment_blob ON messages (attachment_blob)
+                      WHERE attachment_blob IS NOT NULL''')
+
+
+def _add_pending_index(cursor):
+    # Messages still waiting for their recipient, flushed when they connect
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_pending ON messages (recipient, id) WHERE status = 'sent'")
+
+
+def _add_delivery_confirmation(cursor):
+    # Set once the recipient acknowledges a message, so one the server only assumed delivered can be told apart
+    for table in ("messages", "group_message_keys"):
+        if "confirmed" not in _columns(cursor, table):
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN confirmed INTEGER NOT NULL DEFAULT 0")
+
+
+# Schema version N is reached by applying the first N migrations. Only ever append to this list.
+# Databases created before versioning report version 0, so every step has to be idempotent.
+MIGRATIONS: List[Callable] = [
+    _create_base_tables,
+    _add_history_indexes,
+    _add_attachment_blobs,
+    _add_pending_index,
+    create_search_index,
+    create_retention_tables,
+    create_conversation_summaries,
+    create_group_tables,
+    recount_unread_messages,
+    _add_delivery_confirmation,
+    create_orphaned_blobs_table,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def migrate(conn: sqlite3.Connection) -> int:
+    """Bring the schema up to ``SCHEMA_VERSION``; returns the version the database was at.
+
+    The write lock is taken before the version is read, so when several
+    workers start at once exactly one of them applies each migration.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        current = conn.execute("PRAGMA user_version").fetchone()[0]
+        cursor = conn.cursor()
+        for version in range(current + 1, SCHEMA_VERSION + 1):
+            logger.info(f"Applying schema migration {version}: {MIGRATIONS[version - 1].__name__}")
+            MIGRATIONS[version - 1](cursor)
+        if current < SCHEMA_VERSION:
+            conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    if current > SCHEMA_VERSION:
+        logger.warning(f"Database schema version {current} is newer than this code ({SCHEMA_VERSION})")
+    return current
@@ -0,0 +1,145 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Optional, Union
+
+from fastapi import WebSocket
+
+logger = logging.getLogger(__name__)
+
+# Frames buffered per connection before the overflow policy applies
+MAX_OUTBOUND_QUEUE = 256
+
+# Overflow policies
+OVERFLOW_DROP = "drop"              # discard the frame that does not fit
+OVERFLOW_DISCONNECT = "disconnect"  # close the slow consumer
+OVERFLOW_SPILL = "spill"            # hand undeliverable messages back to offline storage
+
+OVERFLOW_POLICIES = (OVERFLOW_DROP, OVERFLOW_DISCONNECT, OVERFLOW_SPILL)
+
+# WebSocket close code used when a consumer cannot keep up ("try again later")
+CLOSE_SLOW_CONSUMER = 1013
+
+
+class OutboundQueue:
+    """Bounded send queue for one WebSocket, drained by its own writer task.
+
+    Producers never await the network: ``put`` either enqueues the
+    pre-serialised frame or applies the overflow policy. A frame may carry
+    ``meta`` (message id and recipient) identifying a stored message;
+    such frames are passed to ``on_spill`` if they cannot be delivered, so
+    the message goes back to the offline queue instead of being lost, and
+    to ``on_sent`` once the socket took them. Each frame is handed to
+    exactly one of the two.
+    """
+
+    def __init__(self, websocket: WebSocket, client_id: str, connection_id: int = 0,
+                 max_size: int = MAX_OUTBOUND_QUEUE,
+                 overflow_policy: str = OVERFLOW_SPILL,
+                 on_spill: Optional[Callable[[dict], None]] = None,
+                 on_failure: Optional[Callable[["OutboundQueue", int], Awaitable[None]]] = None):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow_policy}")
+        self.websocket = websocket
+        self.client_id = client_id
+        # Distinguishes the sessions of a user connected from several tabs or devices
+        self.connection_id = connection_id
+        self.overflow_policy = overflow_policy
+        self.on_spill = on_spill
+        self.on_failure = on_failure
+        self.on_sent: Optional[Callable[[dict], None]] = None
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_size)
+        self._task: Optional[asyncio.Task] = None
+        # Meta of the frame the writer is sending, spilled if the writer is cancelled mid-send
+        self._in_flight: Optional[dict] = None
+        self.closed = False
+
+        # Queue statistics
+        self.sent = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.max_depth = 0
+
+    def start(self):
+        self._task = asyncio.create_task(self._drain())
+
+    def put(self, frame: Union[str, bytes], meta: Optional[dict] = None) -> bool:
+        """Queue a text or binary frame for sending; returns False if it was not accepted."""
+        if self.closed:
+            self._discard(meta)
+            return False
+        try:
+            self._queue.put_nowait((frame, meta))
+        except asyncio.QueueFull:
+            return self._overflow(meta)
+        self.max_depth = max(self.max_depth, self._queue.qsize())
+        return True
+
+    def _overflow(self, meta: Optional[dict]) -> bool:
+        logger.warning("Outbound queue full for %s, applying '%s' policy", self.client_id, self.overflow_policy)
+        if self.overflow_policy == OVERFLOW_DISCONNECT:
+            self.dropped += 1
+            if self.on_failure:
+                asyncio.create_task(self.on_failure(self, CLOSE_SLOW_CONSUMER))
+        elif self.overflow_policy == OVERFLOW_SPILL:
+            self._discard(meta)
+        else:
+            self.dropped += 1
+        return False
+
+    def _discard(self, meta: Optional[dict]):
+        # Stored messages are spilled back to offline storage, anything else is dropped
+        if meta is not None and self.on_spill:
+            self.spilled += 1
+            self.on_spill(meta)
+        else:
+            self.dropped += 1
+
+    async def _drain(self):
+        while True:
+            frame, meta = await self._queue.get()
+            self._in_flight = meta
+            try:
+                if isinstance(frame, bytes):
+                    await self.websocket.send_bytes(frame)
+                else:
+                    await self.websocket.send_text(frame)
+                self.sent += 1
+                self._in_flight = None
+                if meta is not None and self.on_sent:
+                    self.on_sent(meta)
+            except Exception as e:
+                logger.error(f"Error sending to {self.client_id}: {str(e)}")
+                self._in_flight = None
+                # Closed first, so the spill handler sees this connection as gone
+                self.close()
+                self._discard(meta)
+                if self.on_failure:
+                    await self.on_failure(self, 1011)
+                return
+
+    def close(self):
+        """Stop the writer and spill whatever is still queued or being sent."""
+        if self.closed:
+            return
+        self.closed = True
+        if self._task and self._task is not asyncio.current_task():
+            self._task.cancel()
+            if self._in_flight is not None:
+                meta, self._in_flight = self._in_flight, None
+                self._discard(meta)
+        while True:
+            try:
+                _, meta = self._queue.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+            self._discard(meta)
+
+    def stats(self) -> dict:
+        return {
+            "depth": self._queue.qsize(),
+            "max_depth": self.max_depth,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "spilled": self.spilled,
+            "overflow_policy": self.overflow_policy,
+        }
@@ -0,0 +1,98 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional
+
+from passlib.context import CryptContext
+
+logger = logging.getLogger(__name__)
+
+# Worker pool defaults; bcrypt releases the GIL, so threads scale across cores
+HASH_WORKERS = 4
+HASH_EXECUTOR = "thread"
+
+# Password hashing
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+
+def _hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def _verify(password: str, password_hash: str) -> bool:
+    return pwd_context.verify(password, password_hash)
+
+
+class PasswordHasher:
+    """Runs bcrypt hashing and verification on a bounded worker pool.
+
+    At most ``max_concurrency`` operations run at once; further callers wait
+    on a semaphore rather than piling work onto the executor, and the time
+    they spend waiting is recorded so bursts are visible in ``stats()``.
+    ``executor`` may be "thread" or "process".
+    """
+
+    def __init__(self, workers: int = HASH_WORKERS, max_concurrency: Optional[int] = None,
+                 executor: str = HASH_EXECUTOR):
+        self.workers = workers
+        self.max_concurrency = max_concurrency or workers
+        self._executor: Executor
+        if executor == "process":
+            self._executor = ProcessPoolExecutor(max_workers=workers)
+        elif executor == "thread":
+            self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        else:
+            raise ValueError(f"Unknown executor type: {executor}")
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        # Queueing metrics
+        self.waiting = 0
+        self.running = 0
+        self.completed = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.total_run_seconds = 0.0
+
+    async def hash(self, password: str) -> str:
+        return await self._submit(_hash, password)
+
+    async def verify(self, password: str, password_hash: str) -> bool:
+        return await self._submit(_verify, password, password_hash)
+
+    async def _submit(self, fn, *args):
+        queued_at = time.perf_counter()
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        started_at = time.perf_counter()
+        wait = started_at - queued_at
+        self.total_wait_seconds += wait
+        self.max_wait_seconds = max(self.max_wait_seconds, wait)
+
+        self.running += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, fn, *args)
+        finally:
+            self.running -= 1
+            self.completed += 1
+            self.total_run_seconds += time.perf_counter() - started_at
+            self._semaphore.release()
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "max_concurrency": self.max_concurrency,
+            "waiting": self.waiting,
+            "running": self.running,
+            "completed": self.completed,
+            "avg_wait_seconds": self.total_wait_seconds / self.completed if self.completed else 0.0,
+            "max_wait_seconds": self.max_wait_seconds,
+            "avg_run_seconds": self.total_run_seconds / self.completed if self.completed else 0.0,
+        }
+
+    def close(self):
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,83 @@
+import logging
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Set
+
+from serialization import dumps
+
+logger = logging.getLogger(__name__)
+
+ContactsLoader = Callable[[str], Awaitable[Set[str]]]
+
+
+class Presence:
+    """Versioned online-presence state and the frames that describe it.
+
+    Every join or leave bumps ``version`` and is described by a single
+    pre-serialised ``presence_delta`` frame. A client that sees a gap in
+    versions asks for a fresh ``presence_snapshot``. When a
+    ``contacts_loader`` is given, presence is scoped: each user only sees and
+    is seen by the peers they have exchanged messages with.
+    """
+
+    def __init__(self, contacts_loader: Optional[ContactsLoader] = None):
+        self.version = 0
+        self.contacts_loader = contacts_loader
+        self._contacts: Dict[str, Set[str]] = {}
+
+    @property
+    def scoped(self) -> bool:
+        return self.contacts_loader is not None
+
+    async def track(self, client_id: str):
+        """Load the contact set of a newly connected user when presence is scoped."""
+        if self.scoped and client_id not in self._contacts:
+            try:
+                self._contacts[client_id] = set(await self.contacts_loader(client_id))
+            except Exception as e:
+                logger.error(f"Error loading contacts for {client_id}: {str(e)}")
+                self._contacts[client_id] = set()
+
+    def forget(self, client_id: str):
+        self._contacts.pop(client_id, None)
+
+    def add_contact(self, user: str, peer: str) -> bool:
+        """Record that two users now know each other; returns True if this is new."""
+        if not self.scoped or user == peer:
+            return False
+        added = False
+        for a, b in ((user, peer), (peer, user)):
+            contacts = self._contacts.get(a)
+            if contacts is not None and b not in contacts:
+                contacts.add(b)
+                added = True
+        return added
+
+    def _visible(self, viewer: str, client_id: str) -> bool:
+        if not self.scoped:
+            return True
+        return client_id in self._contacts.get(viewer, ())
+
+    def audience(self, client_id: str, online: Iterable[str]) -> List[str]:
+        """Connected users that should be told about ``client_id`` joining or leaving."""
+        return [other for other in online if other != client_id and self._visible(other, client_id)]
+
+    def visible(self, viewer: str, online: Iterable[str]) -> List[str]:
+        """The online users ``viewer`` may see, themselves included."""
+        return [other for other in online if other == viewer or self._visible(viewer, other)]
+
+    def snapshot_frame(self, client_id: str, online: Iterable[str]) -> str:
+        return dumps({
+            "type": "presence_snapshot",
+            "version": self.version,
+            "scoped": self.scoped,
+            "clients": self.visible(client_id, online)
+        })
+
+    def delta_frame(self, joined: Iterable[str] = (), left: Iterable[str] = (), bump: bool = True) -> str:
+        if bump:
+            self.version += 1
+        return dumps({
+            "type": "presence_delta",
+            "version": self.version,
+            "joined": list(joined),
+            "left": list(left)
+        })
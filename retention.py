@@ -0,0 +1,362 @@
+import asyncio
+import datetime
+import logging
+import os
+import sqlite3
+import sys
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+from blob_store import BlobStore
+from groups import group_recipient
+from storage import Database
+
+logger = logging.getLogger(__name__)
+
+# Retention for users without a policy of their own; 0 keeps messages forever
+DEFAULT_RETENTION_DAYS = int(os.environ.get("MESSAGE_RETENTION_DAYS", "0"))
+# "archive" moves expired messages to ARCHIVE_DB_PATH, "purge" deletes them
+DEFAULT_RETENTION_ACTION = os.environ.get("MESSAGE_RETENTION_ACTION", "archive")
+RETENTION_ACTIONS = ("archive", "purge")
+
+ARCHIVE_DB_PATH = os.environ.get("MESSAGE_ARCHIVE_PATH", "archive.db")
+
+# How often the job runs, and how it paces itself so it never holds the write lock for long (seconds)
+RETENTION_INTERVAL = 3600
+RETENTION_BATCH_SIZE = 200
+RETENTION_PAUSE = 0.2
+
+# Unreferenced blobs stored more recently than this are kept for now: an upload is stored before the message
+# that references it, and storing the same ciphertext again refreshes the blob (seconds)
+BLOB_GRACE_PERIOD = 24 * 60 * 60
+
+# Free pages returned to the filesystem per incremental vacuum step
+VACUUM_PAGES_PER_STEP = 512
+
+MESSAGE_COLUMNS = ("id, sender, recipient, encrypted_content, iv, encrypted_aes_key, "
+                   "timestamp, status, file_attachment, attachment_blob")
+
+CANDIDATES_SQL = """
+    SELECT id, sender, recipient, timestamp FROM messages
+    WHERE id > ? AND timestamp < ?
+    ORDER BY id
+    LIMIT ?
+"""
+
+GROUP_MESSAGE_COLUMNS = "id, group_id, sender, encrypted_content, iv, timestamp, file_attachment, attachment_blob"
+GROUP_KEY_COLUMNS = "member, message_id, encrypted_aes_key, status"
+
+# Group messages with everyone they were addressed to, the sender included, as "member,member,..."
+GROUP_CANDIDATES_SQL = """
+    SELECT m.id, m.group_id, m.timestamp, group_concat(k.member)
+    FROM group_messages m JOIN group_message_keys k ON k.message_id = m.id
+    WHERE m.id > ? AND m.timestamp < ?
+    GROUP BY m.id
+    ORDER BY m.id
+    LIMIT ?
+"""
+
+Policy = Tuple[Optional[int], str]
+
+
+def create_retention_tables(cursor):
+    """Per-user (peer '') and per-conversation retention policies; NULL max_age_days keeps forever."""
+    cursor.execute('''CREATE TABLE IF NOT EXISTS retention_policies
+                      (owner TEXT NOT NULL,
+                       peer TEXT NOT NULL DEFAULT '',
+                       max_age_days INTEGER,
+                       action TEXT NOT NULL DEFAULT 'archive',
+                       PRIMARY KEY (owner, peer))''')
+
+
+def create_orphaned_blobs_table(cursor):
+    """Blobs whose last message expired, removed by later runs once nothing references them any more."""
+    cursor.execute("CREATE TABLE IF NOT EXISTS orphaned_blobs (blob_id TEXT PRIMARY KEY)")
+
+
+def _cutoff(days: int) -> str:
+    # Same shape as the clients' ISO timestamps, so the two compare as strings
+    moment = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=days)
+    return moment.strftime("%Y-%m-%dT%H:%M:%S.") + f"{moment.microsecond // 1000:03d}Z"
+
+
+def _now() -> str:
+    return _cutoff(0)
+
+
+@contextmanager
+def _archive_attached(conn: sqlite3.Connection, path: str):
+    """The archive database attached to a pooled connection for the duration, and detached whatever happens."""
+    conn.execute("ATTACH DATABASE ? AS archive", (path,))
+    try:
+        _create_archive_tables(conn)
+        yield conn
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        conn.execute("DETACH DATABASE archive")
+
+
+def _create_archive_tables(conn: sqlite3.Connection):
+    conn.execute('''CREATE TABLE IF NOT EXISTS archive.messages
+                     (id INTEGER PRIMARY KEY,
+                      sender TEXT NOT NULL,
+                      recipient TEXT NOT NULL,
+                      encrypted_content TEXT NOT NULL,
+                      iv TEXT NOT NULL,
+                      encrypted_aes_key TEXT NOT NULL,
+                      timestamp TEXT NOT NULL,
+                      status TEXT NOT NULL,
+                      file_attachment TEXT,
+                      attachment_blob TEXT,
+                      archived_at TEXT NOT NULL)''')
+    conn.execute('''CREATE INDEX IF NOT EXISTS archive.idx_archive_attachment_blob ON messages (attachment_blob)
+                    WHERE attachment_blob IS NOT NULL''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS archive.group_messages
+                     (id INTEGER PRIMARY KEY,
+                      group_id INTEGER NOT NULL,
+                      sender TEXT NOT NULL,
+                      encrypted_content TEXT NOT NULL,
+                      iv TEXT NOT NULL,
+                      timestamp TEXT NOT NULL,
+                      file_attachment TEXT,
+                      attachment_blob TEXT,
+                      archived_at TEXT NOT NULL)''')
+    conn.execute('''CREATE INDEX IF NOT EXISTS archive.idx_archive_group_attachment_blob
+                    ON group_messages (attachment_blob) WHERE attachment_blob IS NOT NULL''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS archive.group_message_keys
+                     (member TEXT NOT NULL,
+                      message_id INTEGER NOT NULL,
+                      encrypted_aes_key TEXT NOT NULL,
+                      status TEXT NOT NULL,
+                      PRIMARY KEY (member, message_id)) WITHOUT ROWID''')
+
+
+def _referenced(conn: sqlite3.Connection, blob_id: str) -> bool:
+    # Blobs are shared by identical ciphertexts and by group messages
+    return any(conn.execute(f"SELECT 1 FROM {table} WHERE attachment_blob = ? LIMIT 1", (blob_id,)).fetchone()
+               for table in ("main.messages", "main.group_messages", "archive.messages", "archive.group_messages"))
+
+
+def _expire_batch(conn: sqlite3.Connection, archive_ids: List[int], purge_ids: List[int], archive_path: str,
+                  groups: bool = False) -> int:
+    """Archive and delete one batch of direct or group messages in a single transaction.
+
+    Returns how many blobs it left unreferenced. Those blobs are only
+    recorded here: they are removed by ``_remove_orphans``.
+    """
+    table, columns = ("group_messages", GROUP_MESSAGE_COLUMNS) if groups else ("messages", MESSAGE_COLUMNS)
+    with _archive_attached(conn, archive_path), conn:
+        ids = archive_ids + purge_ids
+        placeholders = ", ".join("?" * len(ids))
+        blobs = {row[0] for row in conn.execute(
+            f"SELECT DISTINCT attachment_blob FROM main.{table} "
+            f"WHERE id IN ({placeholders}) AND attachment_blob IS NOT NULL", ids)}
+        if archive_ids:
+            archived = ", ".join("?" * len(archive_ids))
+            conn.execute(f"""INSERT OR REPLACE INTO archive.{table} ({columns}, archived_at)
+                             SELECT {columns}, ? FROM main.{table}
+                             WHERE id IN ({archived})""",
+                         [_now(), *archive_ids])
+            if groups:
+                conn.execute(f"""INSERT OR REPLACE INTO archive.group_message_keys ({GROUP_KEY_COLUMNS})
+                                 SELECT {GROUP_KEY_COLUMNS} FROM main.group_message_keys
+                                 WHERE message_id IN ({archived})""", archive_ids)
+        if groups:
+            conn.execute(f"DELETE FROM main.group_message_keys WHERE message_id IN ({placeholders})", ids)
+        conn.execute(f"DELETE FROM main.{table} WHERE id IN ({placeholders})", ids)
+        orphaned = [(blob,) for blob in blobs if not _referenced(conn, blob)]
+        conn.executemany("INSERT OR IGNORE INTO main.orphaned_blobs (blob_id) VALUES (?)", orphaned)
+    return len(orphaned)
+
+
+def _remove_orphans(conn: sqlite3.Connection, blob_store: BlobStore, archive_path: str, grace: float) -> int:
+    """Remove recorded blobs that are still unreferenced and were not stored again lately; returns how many.
+
+    References are checked again here, as a message may have taken the blob
+    up since it was recorded; one that was only just stored again is left for
+    a later run, by when its message will have been written.
+    """
+    removed = 0
+    if not conn.execute("SELECT 1 FROM orphaned_blobs LIMIT 1").fetchone():
+        return removed
+    with _archive_attached(conn, archive_path), conn:
+        for (blob_id,) in conn.execute("SELECT blob_id FROM main.orphaned_blobs").fetchall():
+            if _referenced(conn, blob_id):
+                conn.execute("DELETE FROM main.orphaned_blobs WHERE blob_id = ?", (blob_id,))
+            elif blob_store.remove_unused(blob_id, grace):
+                conn.execute("DELETE FROM main.orphaned_blobs WHERE blob_id = ?", (blob_id,))
+                removed += 1
+    return removed
+
+
+def _vacuum_step(conn: sqlite3.Connection, pages: int) -> int:
+    """Return up to ``pages`` free pages to the filesystem; returns how many are still free."""
+    conn.execute(f"PRAGMA incremental_vacuum({pages})").fetchall()
+    return conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+
+def enable_incremental_vacuum(path: str):
+    """One-off conversion of an existing database; rewrites the whole file, so run it while the server is down."""
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+    finally:
+        conn.close()
+
+
+class RetentionJob:
+    """Background job expiring old messages according to the retention policies.
+
+    A message is expired once it is older than what both participants keep:
+    each side's policy for that conversation, else their own default, else
+    ``DEFAULT_RETENTION_DAYS``. Group messages are kept as long as any of the
+    members they were sent to keeps them, by each member's policy for the
+    group (peer ``group:<id>``) or their default. If anyone asks for
+    archiving the message is copied to the archive database before it is
+    deleted. Work is done in
+    small transactions with pauses between them, then the freed pages are
+    handed back to the filesystem a few at a time with incremental vacuum.
+    """
+
+    def __init__(self, db: Database, blob_store: BlobStore, archive_path: str = ARCHIVE_DB_PATH,
+                 interval: float = RETENTION_INTERVAL, batch_size: int = RETENTION_BATCH_SIZE,
+                 pause: float = RETENTION_PAUSE, default_days: int = DEFAULT_RETENTION_DAYS,
+                 default_action: str = DEFAULT_RETENTION_ACTION, blob_grace: float = BLOB_GRACE_PERIOD):
+        self.db = db
+        self.blob_store = blob_store
+        self.archive_path = archive_path
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pause = pause
+        self.default: Policy = (default_days or None, default_action)
+        self.blob_grace = blob_grace
+        self.archived = 0
+        self.purged = 0
+        self.blobs_removed = 0
+        self.pages_vacuumed = 0
+        self._incremental = False
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        auto_vacuum = (await self.db.fetchone("PRAGMA auto_vacuum"))[0]
+        self._incremental = auto_vacuum == 2
+        if not self._incremental:
+            logger.warning("Database is not in incremental auto-vacuum mode; space freed by retention is reused "
+                           "but the file will not shrink until 'python retention.py <db>' is run offline")
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error(f"Retention run failed: {str(e)}")
+            await asyncio.sleep(self.interval)
+
+    async def _load_policies(self) -> Dict[Tuple[str, str], Policy]:
+        rows = await self.db.fetchall("SELECT owner, peer, max_age_days, action FROM retention_policies")
+        return {(owner, peer): (days, action) for owner, peer, days, action in rows}
+
+    def _resolve(self, policies: Dict[Tuple[str, str], Policy], owner: str, peer: str) -> Policy:
+        return policies.get((owner, peer)) or policies.get((owner, "")) or self.default
+
+    async def run_once(self):
+        await self._expire()
+        removed = await self.db.run(_remove_orphans, self.blob_store, self.archive_path, self.blob_grace)
+        self.blobs_removed += removed
+        if removed:
+            logger.info(f"Retention removed {removed} unreferenced attachment blobs")
+
+    async def _expire(self):
+        policies = await self._load_policies()
+        finite = [days for days, _ in list(policies.values()) + [self.default] if days]
+        if not finite:
+            return
+        # Nothing younger than the shortest retention anywhere can expire
+        scan_cutoff = _cutoff(min(finite))
+        cutoffs: Dict[int, str] = {}
+
+        def direct(row):
+            _, sender, recipient, timestamp = row
+            return [(sender, recipient), (recipient, sender)], timestamp
+
+        def group(row):
+            # Each member keeps the group's history by their policy for it, like a conversation with a peer
+            _, group_id, timestamp, members = row
+            return [(member, group_recipient(group_id)) for member in members.split(",")], timestamp
+
+        archived, purged = await self._expire_table(CANDIDATES_SQL, direct, False, policies, scan_cutoff, cutoffs)
+        group_archived, group_purged = await self._expire_table(GROUP_CANDIDATES_SQL, group, True,
+                                                                policies, scan_cutoff, cutoffs)
+        archived += group_archived
+        purged += group_purged
+
+        self.archived += archived
+        self.purged += purged
+        if archived or purged:
+            logger.info(f"Retention archived {archived} and purged {purged} messages")
+            await self.compact()
+
+    async def _expire_table(self, candidates_sql: str, parties, groups: bool,
+                            policies: Dict[Tuple[str, str], Policy], scan_cutoff: str,
+                            cutoffs: Dict[int, str]) -> Tuple[int, int]:
+        """Expire the direct or group messages everyone they concern no longer keeps; returns the counts."""
+        last_id = 0
+        archived = purged = 0
+        while True:
+            rows = await self.db.fetchall(candidates_sql, (last_id, scan_cutoff, self.batch_size))
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            archive_ids, purge_ids = [], []
+            for row in rows:
+                owners, timestamp = parties(row)
+                resolved = [self._resolve(policies, owner, peer) for owner, peer in owners]
+                if not all(days for days, _ in resolved):
+                    continue
+                days = max(days for days, _ in resolved)
+                if days not in cutoffs:
+                    cutoffs[days] = _cutoff(days)
+                if timestamp >= cutoffs[days]:
+                    continue
+                if any(action == "archive" for _, action in resolved):
+                    archive_ids.append(row[0])
+                else:
+                    purge_ids.append(row[0])
+            if archive_ids or purge_ids:
+                await self.db.run(_expire_batch, archive_ids, purge_ids, self.archive_path, groups)
+                archived += len(archive_ids)
+                purged += len(purge_ids)
+            await asyncio.sleep(self.pause)
+        return archived, purged
+
+    async def compact(self):
+        """Shrink the database file in small steps so writers never wait behind a full VACUUM."""
+        if not self._incremental:
+            return
+        free = (await self.db.fetchone("PRAGMA freelist_count"))[0]
+        while free:
+            remaining = await self.db.run(_vacuum_step, VACUUM_PAGES_PER_STEP)
+            self.pages_vacuumed += max(0, free - remaining)
+            free = remaining
+            await asyncio.sleep(self.pause)
+
+    def stats(self) -> dict:
+        return {
+            "archived": self.archived,
+            "purged": self.purged,
+            "blobs_removed": self.blobs_removed,
+            "pages_vacuumed": self.pages_vacuumed,
+        }
+
+
+if __name__ == "__main__":
+    # Converts an existing database to incremental auto-vacuum; new databases start out that way
+    enable_incremental_vacuum(sys.argv[1] if len(sys.argv) > 1 else "users.db")
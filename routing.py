@@ -0,0 +1,387 @@
+import asyncio
+import logging
+import os
+import struct
+import sys
+from abc import ABC, abstractmethod
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+from logging_config import configure_logging
+from serialization import dumps_bytes, loads
+
+logger = logging.getLogger(__name__)
+
+# Broker messages are JSON objects prefixed with their length
+MESSAGE_HEADER = struct.Struct("!I")
+# Seconds between attempts to reach the broker after the connection is lost
+RECONNECT_DELAY = 1.0
+# How long the broker lets a worker take to read its frames before dropping it as stuck (seconds)
+DRAIN_TIMEOUT = 5.0
+# Messages the broker queues for one worker before dropping it as stuck
+MAX_BROKER_QUEUE = 1024
+# Bytes a worker lets pile up unsent to the broker before it refuses to publish more frames (bytes)
+MAX_WRITE_BUFFER = 4 * 1024 * 1024
+
+Deliver = Callable[[str, str, Optional[dict]], bool]
+EventHandler = Callable[[dict], Awaitable[None]]
+Undelivered = Callable[[dict], None]
+
+
+def _encode(message: dict) -> bytes:
+    body = dumps_bytes(message)
+    return MESSAGE_HEADER.pack(len(body)) + body
+
+
+async def _read(reader: asyncio.StreamReader) -> dict:
+    header = await reader.readexactly(MESSAGE_HEADER.size)
+    (length,) = MESSAGE_HEADER.unpack(header)
+    return loads(await reader.readexactly(length))
+
+
+class Router(ABC):
+    """Reaches clients connected to any worker and shares who is online.
+
+    ``ConnectionManager`` owns the sockets of its own clients. The router
+    tells every worker about joins, leaves and other presence events
+    (``emit``) and carries text frames to a client's sessions on the other
+    workers (``publish``); sessions on this worker are the manager's own to
+    reach. Events emitted by a worker are handled by that worker first, so a
+    local caller sees their effect before ``emit`` returns.
+    """
+
+    def __init__(self):
+        self.deliver: Optional[Deliver] = None
+        self.on_event: Optional[EventHandler] = None
+        self.on_undelivered: Optional[Undelivered] = None
+
+    async def start(self, deliver: Deliver, on_event: EventHandler,
+                    on_undelivered: Optional[Undelivered] = None):
+        self.deliver = deliver
+        self.on_event = on_event
+        self.on_undelivered = on_undelivered
+
+    async def stop(self):
+        pass
+
+    @abstractmethod
+    def online(self) -> List[str]:
+        """Clients connected to any worker."""
+
+    @abstractmethod
+    def is_online(self, client_id: str) -> bool:
+        """Whether a client is connected to any worker."""
+
+    @abstractmethod
+    def elsewhere(self, client_id: str) -> bool:
+        """Whether a client has sessions on another worker."""
+
+    @abstractmethod
+    async def register(self, client_id: str):
+        """Record a client connected to this worker and announce it to every worker."""
+
+    @abstractmethod
+    async def unregister(self, client_id: str):
+        """Forget a client that left this worker, announcing it if no worker holds it any more."""
+
+    @abstractmethod
+    def publish(self, client_id: str, frame: str, meta: Optional[dict] = None) -> bool:
+        """Send a frame to a client's sessions on every other worker; returns False if it has none there."""
+
+    @abstractmethod
+    async def emit(self, event: dict):
+        """Hand an event to every worker, this one first."""
+
+
+class LocalRouter(Router):
+    """Routing for a single worker process: every client is local."""
+
+    def __init__(self):
+        super().__init__()
+        self._clients: Set[str] = set()
+
+    def online(self) -> List[str]:
+        return list(self._clients)
+
+    def is_online(self, client_id: str) -> bool:
+        return client_id in self._clients
+
+    def elsewhere(self, client_id: str) -> bool:
+        return False
+
+    async def register(self, client_id: str):
+        self._clients.add(client_id)
+        await self.emit({"type": "joined", "client": client_id})
+
+    async def unregister(self, client_id: str):
+        self._clients.discard(client_id)
+        await self.emit({"type": "left", "client": client_id})
+
+    def publish(self, client_id: str, frame: str, meta: Optional[dict] = None) -> bool:
+        # There are no other workers
+        return False
+
+    async def emit(self, event: dict):
+        await self.on_event(event)
+
+
+class BrokerRouter(Router):
+    """Routing between worker processes through a ``RoutingBroker`` on a Unix socket.
+
+    Each worker keeps a mirror of the clients connected to the other
+    workers, so online checks and presence snapshots never wait on the
+    broker. A user with sessions on several workers is counted once per
+    worker and only joins or leaves when the first or last one does. If the
+    broker goes away its clients are reported as left, and this worker's
+    clients are registered again once it is reachable.
+    """
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self._local: Set[str] = set()
+        # Client -> number of other workers it has sessions on
+        self._remote: Dict[str, int] = {}
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._task: Optional[asyncio.Task] = None
+        self._connected = asyncio.Event()
+
+    async def start(self, deliver: Deliver, on_event: EventHandler,
+                    on_undelivered: Optional[Undelivered] = None):
+        await super().start(deliver, on_event, on_undelivered)
+        self._task = asyncio.create_task(self._run())
+        try:
+            await asyncio.wait_for(self._connected.wait(), RECONNECT_DELAY)
+        except asyncio.TimeoutError:
+            logger.warning(f"Routing broker at {self.path} not reachable yet, continuing to retry")
+
+    async def stop(self):
+        # The connection is closed by the reader task as it winds down
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def online(self) -> List[str]:
+        return list(self._local.union(self._remote))
+
+    def is_online(self, client_id: str) -> bool:
+        return client_id in self._local or client_id in self._remote
+
+    def elsewhere(self, client_id: str) -> bool:
+        return client_id in self._remote
+
+    def _send(self, message: dict) -> bool:
+        if self._writer is None or self._writer.is_closing():
+            return False
+        self._writer.write(_encode(message))
+        return True
+
+    def _backlogged(self) -> bool:
+        # Frames are refused rather than buffered without bound while the broker is not reading; the
+        # caller keeps the message for later delivery. Presence updates are small and always go out.
+        if self._writer is not None and self._writer.transport.get_write_buffer_size() > MAX_WRITE_BUFFER:
+            logger.warning("Routing broker is not keeping up, not publishing to it for now")
+            return True
+        return False
+
+    async def register(self, client_id: str):
+        was_online = self.is_online(client_id)
+        self._local.add(client_id)
+        self._send({"op": "register", "client": client_id})
+        if not was_online:
+            await self.on_event({"type": "joined", "client": client_id})
+
+    async def unregister(self, client_id: str):
+        self._local.discard(client_id)
+        self._send({"op": "unregister", "client": client_id})
+        if client_id not in self._remote:
+            await self.on_event({"type": "left", "client": client_id})
+
+    def publish(self, client_id: str, frame: str, meta: Optional[dict] = None) -> bool:
+        if client_id not in self._remote or self._backlogged():
+            return False
+        return self._send({"op": "publish", "client": client_id, "frame": frame, "meta": meta})
+
+    async def emit(self, event: dict):
+        self._send({"op": "event", "event": event})
+        await self.on_event(event)
+
+    async def _run(self):
+        while True:
+            try:
+                reader, self._writer = await asyncio.open_unix_connection(self.path)
+            except OSError as e:
+                logger.debug("Could not connect to routing broker at %s: %s", self.path, e)
+                await asyncio.sleep(RECONNECT_DELAY)
+                continue
+
+            logger.info(f"Connected to routing broker at {self.path}")
+            for client_id in self._local:
+                self._send({"op": "register", "client": client_id})
+            try:
+                while True:
+                    await self._handle(await _read(reader))
+            except (asyncio.IncompleteReadError, ConnectionError) as e:
+                logger.error(f"Lost connection to routing broker: {str(e)}")
+            finally:
+                self._connected.clear()
+                if self._writer is not None:
+                    self._writer.close()
+                    self._writer = None
+                # Clients on other workers are unreachable until the broker is back
+                lost, self._remote = self._remote, {}
+                for client_id in lost:
+                    if client_id not in self._local:
+                        await self.on_event({"type": "left", "client": client_id})
+            await asyncio.sleep(RECONNECT_DELAY)
+
+    async def _handle(self, message: dict):
+        op = message.get("op")
+        if op == "deliver":
+            if not self.deliver(message["client"], message["frame"], message.get("meta")):
+                logger.debug("Routed frame for %s could not be delivered", message["client"])
+        elif op == "undelivered":
+            if message.get("meta") and self.on_undelivered:
+                self.on_undelivered(message["meta"])
+        elif op == "online":
+            self._remote = dict(message["clients"])
+            self._connected.set()
+            for client_id in self._remote:
+                if client_id not in self._local:
+                    await self.on_event({"type": "joined", "client": client_id})
+        elif op == "event":
+            event = message["event"]
+            # Joins and leaves are per worker; users only come and go with their first and last worker
+            if event.get("type") == "joined":
+                client_id = event["client"]
+                self._remote[client_id] = self._remote.get(client_id, 0) + 1
+                if self._remote[client_id] > 1 or client_id in self._local:
+                    return
+            elif event.get("type") == "left":
+                client_id = event["client"]
+                remaining = self._remote.pop(client_id, 0) - 1
+                if remaining > 0:
+                    self._remote[client_id] = remaining
+                if remaining > 0 or client_id in self._local:
+                    return
+            await self.on_event(event)
+        else:
+            logger.debug("Unknown routing message: %s", op)
+
+
+class RoutingBroker:
+    """Unix-socket hub that connects the workers of one deployment.
+
+    It knows which workers hold each client's sessions, forwards published
+    frames to all of them except the publisher, which delivers to its own
+    sessions itself, and fans presence events out to every other worker.
+    Frames for clients no other worker holds any more go back to the
+    publisher as ``undelivered`` so the message can return to offline storage.
+    Each worker is written to by its own task, so reading from every worker
+    goes on while one of them is slow to read.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._owners: Dict[str, Set[asyncio.StreamWriter]] = {}
+        # Worker -> messages waiting to be written to it
+        self._workers: Dict[asyncio.StreamWriter, asyncio.Queue] = {}
+
+    async def serve(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        server = await asyncio.start_unix_server(self._handle_worker, self.path)
+        logger.info(f"Routing broker listening on {self.path}")
+        async with server:
+            await server.serve_forever()
+
+    def _send(self, worker: asyncio.StreamWriter, data: bytes):
+        outbox = self._workers.get(worker)
+        if outbox is None or worker.is_closing():
+            return
+        try:
+            outbox.put_nowait(data)
+        except asyncio.QueueFull:
+            logger.error(f"Worker has {MAX_BROKER_QUEUE} routing messages queued, disconnecting it")
+            worker.transport.abort()
+
+    @staticmethod
+    async def _write(worker: asyncio.StreamWriter, outbox: asyncio.Queue):
+        # Waiting for the worker to read keeps a slow one from growing its buffer here without bound;
+        # one that stays stuck is dropped and re-registers its clients when it reconnects
+        while True:
+            worker.write(await outbox.get())
+            while not outbox.empty():
+                worker.write(outbox.get_nowait())
+            try:
+                await asyncio.wait_for(worker.drain(), DRAIN_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.error(f"Worker did not read from the routing broker for {DRAIN_TIMEOUT}s, disconnecting it")
+                # Not close(): that would wait to flush the very buffer the worker is not reading
+                worker.transport.abort()
+                return
+            except ConnectionError:
+                return
+
+    def _send_all(self, workers, message: dict):
+        data = _encode(message)
+        for worker in workers:
+            self._send(worker, data)
+
+    def _broadcast(self, source: asyncio.StreamWriter, message: dict):
+        self._send_all([worker for worker in self._workers if worker is not source], message)
+
+    def _remove_owner(self, client_id: str, writer: asyncio.StreamWriter):
+        owners = self._owners.get(client_id)
+        if not owners or writer not in owners:
+            return
+        owners.discard(writer)
+        if not owners:
+            del self._owners[client_id]
+        self._broadcast(writer, {"op": "event", "event": {"type": "left", "client": client_id}})
+
+    async def _handle_worker(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        outbox: asyncio.Queue = asyncio.Queue(maxsize=MAX_BROKER_QUEUE)
+        self._workers[writer] = outbox
+        sender = asyncio.create_task(self._write(writer, outbox))
+        self._send(writer, _encode({"op": "online",
+                                    "clients": {c: len(owners) for c, owners in self._owners.items()}}))
+        try:
+            while True:
+                message = await _read(reader)
+                op = message.get("op")
+                if op == "register":
+                    owners = self._owners.setdefault(message["client"], set())
+                    if writer not in owners:
+                        owners.add(writer)
+                        self._broadcast(writer, {"op": "event",
+                                                 "event": {"type": "joined", "client": message["client"]}})
+                elif op == "unregister":
+                    self._remove_owner(message["client"], writer)
+                elif op == "publish":
+                    targets = self._owners.get(message["client"], set()) - {writer}
+                    if targets:
+                        self._send_all(list(targets), {"op": "deliver", "client": message["client"],
+                                                       "frame": message["frame"], "meta": message.get("meta")})
+                    else:
+                        self._send(writer, _encode({"op": "undelivered", "meta": message.get("meta")}))
+                elif op == "event":
+                    self._broadcast(writer, message)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            del self._workers[writer]
+            sender.cancel()
+            for client_id in [c for c, owners in self._owners.items() if writer in owners]:
+                self._remove_owner(client_id, writer)
+            writer.close()
+            logger.info("Worker disconnected from routing broker")
+
+
+if __name__ == "__main__":
+    # Run one broker per host, then start the workers with ROUTING_BROKER_SOCKET pointing at it
+    configure_logging()
+    asyncio.run(RoutingBroker(sys.argv[1] if len(sys.argv) > 1 else "/tmp/chat-routing.sock").serve())
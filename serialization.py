@@ -0,0 +1,40 @@
+import json
+import logging
+from typing import Any, Union
+
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # optional speed-up; the standard library produces the same JSON
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+if orjson is not None:
+    def dumps_bytes(obj: Any) -> bytes:
+        return orjson.dumps(obj)
+
+    def dumps(obj: Any) -> str:
+        return orjson.dumps(obj).decode()
+
+    def loads(data: Union[str, bytes]) -> Any:
+        return orjson.loads(data)
+else:
+    def dumps(obj: Any) -> str:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+    def dumps_bytes(obj: Any) -> bytes:
+        return dumps(obj).encode()
+
+    def loads(data: Union[str, bytes]) -> Any:
+        return json.loads(data)
+
+logger.debug("JSON serializer: %s", "orjson" if orjson is not None else "json")
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse rendered with the fastest available serializer."""
+
+    def render(self, content: Any) -> bytes:
+        return dumps_bytes(content)
@@ -0,0 +1,103 @@
+import base64
+import binascii
+import hashlib
+import hmac
+import logging
+import os
+import secrets
+import time
+from typing import Dict, Iterable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# How long a session token stays valid after login (seconds)
+SESSION_TTL = 12 * 60 * 60
+
+# Shared by every worker so a token issued by one is accepted by all; generated per process if unset
+SESSION_SECRET = os.environ.get("SESSION_SECRET")
+
+# Browsers cannot set headers on a WebSocket, and query strings end up in access logs, so clients offer
+# the subprotocols "bearer" and the token itself; the server accepts with "bearer"
+AUTH_SUBPROTOCOL = "bearer"
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def token_from_subprotocols(subprotocols: Iterable[str]) -> Optional[str]:
+    """The session token a WebSocket client offered after ``AUTH_SUBPROTOCOL``, if any."""
+    offered = list(subprotocols)
+    if AUTH_SUBPROTOCOL in offered[:-1]:
+        return offered[offered.index(AUTH_SUBPROTOCOL) + 1]
+    return None
+
+
+class SessionTokens:
+    """Stateless, HMAC-signed session tokens.
+
+    A token is ``<username>.<expiry>.<session id>.<signature>``, with the
+    username base64url-encoded and the signature an HMAC-SHA256 of the first
+    three parts. Checking one costs a single HMAC and a dict lookup: no
+    database query and no bcrypt. Logged-out sessions are remembered by id
+    until they would have expired anyway.
+    """
+
+    def __init__(self, secret: Optional[str] = SESSION_SECRET, ttl: int = SESSION_TTL):
+        if not secret:
+            logger.warning("SESSION_SECRET is not set; sessions will not survive a restart or work across workers")
+            secret = secrets.token_hex(32)
+        self._key = secret.encode()
+        self.ttl = ttl
+        # Revoked session id -> the time its token expires
+        self._revoked: Dict[str, float] = {}
+
+    def _sign(self, payload: str) -> str:
+        return _b64encode(hmac.new(self._key, payload.encode(), hashlib.sha256).digest())
+
+    def issue(self, username: str) -> Tuple[str, int]:
+        """Create a token for ``username``; returns it with its expiry as a Unix timestamp."""
+        expires_at = int(time.time()) + self.ttl
+        payload = f"{_b64encode(username.encode())}.{expires_at}.{secrets.token_hex(16)}"
+        return f"{payload}.{self._sign(payload)}", expires_at
+
+    def _parse(self, token: str) -> Optional[Tuple[str, int, str]]:
+        payload, _, signature = token.rpartition(".")
+        # Compared as bytes: compare_digest rejects str holding anything but ASCII
+        if not payload or not hmac.compare_digest(signature.encode(), self._sign(payload).encode()):
+            return None
+        try:
+            encoded_username, expires_at, session_id = payload.split(".")
+            return _b64decode(encoded_username).decode(), int(expires_at), session_id
+        except (ValueError, binascii.Error, UnicodeDecodeError):
+            return None
+
+    def verify(self, token: Optional[str]) -> Optional[str]:
+        """Return the username a valid, unexpired and unrevoked token belongs to, else None."""
+        if not token:
+            return None
+        parsed = self._parse(token)
+        if parsed is None:
+            return None
+        username, expires_at, session_id = parsed
+        if expires_at < time.time() or session_id in self._revoked:
+            return None
+        return username
+
+    def session_of(self, token: str) -> Optional[Tuple[str, int]]:
+        """Session id and expiry of a validly signed token."""
+        parsed = self._parse(token)
+        return (parsed[2], parsed[1]) if parsed else None
+
+    def revoke(self, session_id: str, expires_at: float):
+        now = time.time()
+        if expires_at < now:
+            return
+        self._revoked[session_id] = expires_at
+        # Forget revocations whose tokens have expired on their own
+        for expired in [sid for sid, expiry in self._revoked.items() if expiry < now]:
+            del self._revoked[expired]
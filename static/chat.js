@@ -6,10 +6,25 @@ let selectedUser = null;
 let publicKeys = {}; // Store fetched public keys
 let unreadMessages = {};
 let clients = [];
+let presenceVersion = 0; // Version of the last presence snapshot/delta applied
+let presenceScoped = false;
 let messageHistory = {};
 let allUsers = []; // Store all users from search results
 let filteredUsers = []; // Store filtered users based on search
 let currentFileAttachment = null; // Store the current file attachment
+let historyCursors = {}; // Paging state per conversation: { before, hasMore }
+let conversationPeers = []; // Peers from the server's conversation summaries, most recent first
+let groups = {}; // groupId -> { name, members }
+let groupHistory = {}; // groupId -> messages, oldest first
+let selectedGroup = null; // groupId of the open group conversation, if any
+let unreadGroups = {}; // groupId -> messages received while another conversation was open
+const AUTH_SUBPROTOCOL = "bearer"; // Offered with the session token as the WebSocket subprotocols
+
+// Streamed attachments: binary frames carry a 16-byte transfer id and an 8-byte offset before the payload
+const FILE_FRAME_HEADER_SIZE = 24;
+let pendingUploads = {}; // transferId -> upload state
+let pendingDownloads = {}; // transferId -> download state
+let loadingOlderMessages = false;
 
 let OQSModule;
 OQS().then(function (module) {
@@ -24,6 +39,8 @@ OQS().then(function (module) {
 function init() {
   connectWebSocket();
   updateWelcomeMessage();
+  fetchConversations();
+  fetchGroups();
 
   // By default, show the placeholder and hide the chat interface
   if (!selectedUser) {
@@ -64,6 +81,17 @@ function init() {
     });
   }
 
+  // Load older messages when scrolled to the top of a conversation
+  const chatMessages = document.getElementById("chat-messages");
+  if (chatMessages) {
+    chatMessages.addEventListener("scroll", handleChatScroll);
+  }
+
+  const newGroupButton = document.getElementById("new-group-button");
+  if (newGroupButton) {
+    newGroupButton.addEventListener("click", handleNewGroup);
+  }
+
   // Add event listener for logout button
   const logoutButton = document.getElementById("logout-button");
   if (logoutButton) {
@@ -77,27 +105,67 @@ function connectWebSocket() {
   updateConnectionStatus("Connecting...");
   const protocol = window.location.protocol === "https:" ? "wss:" : "ws:";
   const wsUrl = `${protocol}//${window.location.host}/ws/${clientId}`;
-  socket = new WebSocket(wsUrl );
+  // The session token travels as a subprotocol, so it never shows up in URLs or access logs
+  const token = sessionToken();
+  socket = new WebSocket(wsUrl, token ? [AUTH_SUBPROTOCOL, token] : []);
+  socket.binaryType = "arraybuffer";
 
   socket.addEventListener("open", function () {
     updateConnectionStatus("Connected");
     logDebug("WebSocket connection established");
+    resumeFileTransfers();
   });
 
   socket.addEventListener("message", function (event) {
+    if (event.data instanceof ArrayBuffer) {
+      handleFileChunk(event.data);
+      return;
+    }
     const data = JSON.parse(event.data);
     switch (data.type) {
-      case "connected_clients":
-        clients = data.clients.filter((client) => client !== clientId);
-        // Update lists to reflect online status changes
-        updateUserList(clients);
+      case "ping":
+        // Proves the connection is alive and confirms every message received before it
+        sendToServer({ type: "pong", seq: data.seq });
+        break;
+      case "presence_snapshot":
+        handlePresenceSnapshot(data);
+        break;
+      case "presence_delta":
+        handlePresenceDelta(data);
         break;
       case "encrypted_message":
         handleEncryptedMessage(data);
         break;
+      case "offline_messages":
+        handleOfflineMessages(data);
+        break;
       case "file_attachment_data":
         handleFileAttachmentData(data);
         break;
+      case "message_ack":
+        handleMessageAck(data);
+        break;
+      case "message_status":
+        handleMessageStatus(data);
+        break;
+      case "group_message":
+        handleGroupMessage(data);
+        break;
+      case "group_message_ack":
+        handleGroupMessageAck(data);
+        break;
+      case "file_upload_ack":
+        handleFileUploadAck(data);
+        break;
+      case "file_upload_error":
+        handleFileTransferError(pendingUploads, data);
+        break;
+      case "file_download_start":
+        handleFileDownloadStart(data);
+        break;
+      case "file_download_error":
+        handleFileTransferError(pendingDownloads, data);
+        break;
       case "error":
         displayError(data.message);
         break;
@@ -109,9 +177,20 @@ function connectWebSocket() {
     }
   });
 
-  socket.addEventListener("close", function () {
+  socket.addEventListener("close", function (event) {
     updateConnectionStatus("Disconnected");
-    logDebug("WebSocket connection closed");
+    logDebug("WebSocket connection closed", event.code);
+    if (event.code === 1008) {
+      // The session was logged out or is no longer valid
+      removeUserItem(clientId, 'session_token');
+      window.location.href = "/static/index.html";
+      return;
+    }
+    if (event.code === 4001) {
+      // Replaced by a newer session of ours; reconnecting would only push another one out
+      displayError("You are signed in from too many tabs or devices. Reload to use this one.");
+      return;
+    }
     setTimeout(connectWebSocket, 3000);
   });
 
@@ -130,6 +209,36 @@ function updateConnectionStatus(status) {
   //document.getElementById("connection-status").textContent = status;
 }
 
+function handlePresenceSnapshot(data) {
+  presenceVersion = data.version;
+  presenceScoped = data.scoped;
+  clients = data.clients.filter((client) => client !== clientId);
+  // Update lists to reflect online status changes
+  updateUserList(clients);
+  prefetchPublicKeys(clients);
+}
+
+function handlePresenceDelta(data) {
+  // Scoped presence only delivers a subset of versions, so gaps are expected there
+  if (!presenceScoped) {
+    if (data.version <= presenceVersion) return;
+    if (data.version !== presenceVersion + 1) {
+      logDebug(`Presence version gap (${presenceVersion} -> ${data.version}), requesting snapshot`);
+      sendToServer({ type: "presence_snapshot_request" });
+      return;
+    }
+  }
+  presenceVersion = Math.max(presenceVersion, data.version);
+
+  data.joined.forEach(username => {
+    if (username !== clientId && !clients.includes(username)) clients.push(username);
+  });
+  if (data.left.length > 0) {
+    clients = clients.filter(username => !data.left.includes(username));
+  }
+  updateUserList(clients);
+}
+
 function updateUserList(onlineClients) {
   const userList = document.getElementById("user-list");
   const offlineList = document.getElementById("offline-list");
@@ -141,6 +250,13 @@ function updateUserList(onlineClients) {
   // Get all users we know about from message history
   let allKnownUsers = [];
   
+  // Add everyone we have a conversation with, most recent first
+  conversationPeers.forEach(username => {
+    if (!allKnownUsers.includes(username)) {
+      allKnownUsers.push(username);
+    }
+  });
+
   // Add all users from message history
   for (const username in messageHistory) {
     if (!allKnownUsers.includes(username)) {
@@ -295,16 +411,78 @@ function renderUserItem(user, containerElement) {
   containerElement.appendChild(userItem);
 }
 
-async function fetchMessageHistory() {
+// Load the conversation list with unread counts, without downloading any history
+async function fetchConversations() {
   try {
-    const response = await fetch(`/messages/${clientId}`);
+    const response = await authFetch(`/conversations/${clientId}`);
+    const data = await response.json();
+    if (data.conversations) {
+      conversationPeers = data.conversations.map(conversation => conversation.peer).filter(peer => peer !== clientId);
+      data.conversations.forEach(conversation => {
+        if (conversation.peer !== selectedUser) unreadMessages[conversation.peer] = conversation.unread_count;
+      });
+      updateUserList(clients);
+    }
+  } catch (error) {
+    displayError(`Failed to fetch conversations: ${error.message}`);
+  }
+}
+
+function markConversationRead(peer) {
+  authFetch(`/conversations/${clientId}/read`, {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify({ peer: peer })
+  }).catch(error => logDebug("Failed to mark conversation as read:", error));
+  sendReadReceipts(peer);
+}
+
+// Tell the server (and through it the sender) which of the peer's messages have been read.
+// Consecutive ids are sent as [first, last] ranges, which is what a read conversation mostly is.
+function sendReadReceipts(peer) {
+  const unread = (messageHistory[peer] || [])
+    .filter(msg => !msg.isSent && msg.id && msg.status !== "read")
+    .map(msg => msg.id)
+    .sort((a, b) => a - b);
+  if (unread.length === 0) return;
+  const ids = [];
+  const ranges = [];
+  let first = unread[0];
+  let last = unread[0];
+  for (const id of unread.slice(1).concat([null])) {
+    if (id === last + 1) {
+      last = id;
+      continue;
+    }
+    if (first === last) ids.push(first);
+    else ranges.push([first, last]);
+    first = last = id;
+  }
+  sendToServer({ type: "message_status", status: "read", ids: ids, ranges: ranges });
+  messageHistory[peer].forEach(msg => {
+    if (!msg.isSent && msg.id) msg.status = "read";
+  });
+}
+
+// Fetch one page of history with a peer: the newest page, or the page before the given cursor
+async function fetchMessageHistory(peer, before = null) {
+  try {
+    const params = new URLSearchParams({ peer: peer, limit: 50 });
+    if (before) params.set("before", before);
+    const response = await authFetch(`/messages/${clientId}?${params}`);
     const data = await response.json();
     if (data.messages) {
+      // Only the first load and explicit older-page loads move the paging cursor
+      if (before || !historyCursors[peer]) {
+        historyCursors[peer] = { before: data.cursors.before, hasMore: data.has_more };
+      }
       data.messages.forEach(msg => {
         const otherUser = msg.sender === clientId ? msg.recipient : msg.sender;
         if (!messageHistory[otherUser]) messageHistory[otherUser] = [];
-        if (!messageHistory[otherUser].some(m => m.timestamp === msg.timestamp && m.sender === msg.sender)) {
+        // Keyed on the server's id: distinct messages can share a timestamp
+        if (!messageHistory[otherUser].some(m => m.id === msg.id)) {
           messageHistory[otherUser].push({
+            id: msg.id,
             sender: msg.sender,
             recipient: msg.recipient,
             content: msg.encryptedContent,
@@ -317,6 +495,9 @@ async function fetchMessageHistory() {
           });
         }
       });
+      if (messageHistory[peer]) {
+        messageHistory[peer].sort((a, b) => a.timestamp.localeCompare(b.timestamp));
+      }
       logDebug("Message history updated:", messageHistory);
     }
   } catch (error) {
@@ -324,6 +505,29 @@ async function fetchMessageHistory() {
   }
 }
 
+async function handleChatScroll(event) {
+  const chatMessages = event.target;
+  if (chatMessages.scrollTop > 0 || !selectedUser || loadingOlderMessages) return;
+
+  const cursor = historyCursors[selectedUser];
+  if (!cursor || !cursor.hasMore || !cursor.before) return;
+
+  loadingOlderMessages = true;
+  try {
+    const user = selectedUser;
+    const previousHeight = chatMessages.scrollHeight;
+    await fetchMessageHistory(user, cursor.before);
+    if (selectedUser !== user) return;
+
+    // Re-render with the older page on top and keep the viewport where it was
+    chatMessages.innerHTML = "";
+    await renderConversation(user);
+    chatMessages.scrollTop = chatMessages.scrollHeight - previousHeight;
+  } finally {
+    loadingOlderMessages = false;
+  }
+}
+
 async function selectUser(user) {
   logDebug(`Selecting user: ${user}, current selectedUser: ${selectedUser}`);
 
@@ -336,6 +540,7 @@ async function selectUser(user) {
   // Clear messages only if switching to a different user
   if (selectedUser !== user) {
     selectedUser = user;
+    selectedGroup = null;
     unreadMessages[user] = 0;
     chatMessages.innerHTML = "";
   }
@@ -362,10 +567,26 @@ async function selectUser(user) {
     chatStatus.textContent = clients.includes(user) ? "Active now" : "Offline";
   }
 
-  // Fetch message history if not already fetched or if we need to refresh
-  await fetchMessageHistory();
+  // Fetch the latest page of history with this user
+  await fetchMessageHistory(user);
+  markConversationRead(user);
+
+  await renderConversation(user);
+
+  // Fetch public key if not already fetched
+  if (!publicKeys[user]) {
+    await fetchPublicKey(user);
+  } else {
+    enableChat();
+  }
+
+  // Update lists to reflect selection
+  updateUserList(clients);
+  renderGroupList();
+}
 
-  // Filter and decrypt messages for the selected user
+// Decrypt and display the loaded history with a user
+async function renderConversation(user) {
   if (messageHistory[user]) {
     for (const msg of messageHistory[user]) {
       if ((msg.sender === user && msg.recipient === clientId) || 
@@ -388,7 +609,7 @@ async function selectUser(user) {
             // Check if this is a file message and parse its content
             if (msg.fileAttachment) {
               try {
-                const encryptedFileData = base64ToArrayBuffer(msg.fileAttachment.encryptedData);
+                const encryptedFileData = await getEncryptedFileData(msg.fileAttachment);
                 const fileIv = base64ToArrayBuffer(msg.fileAttachment.iv);
                 const decryptedFileData = await decryptWithAES(encryptedFileData, fileIv, aesKey);
                 
@@ -419,30 +640,48 @@ async function selectUser(user) {
       }
     }
   }
+}
 
-  // Fetch public key if not already fetched
-  if (!publicKeys[user]) {
-    await fetchPublicKey(user);
-  } else {
-    enableChat();
+function storePublicKey(username, publicKeyBase64) {
+  const publicKey = base64ToArrayBuffer(publicKeyBase64);
+  logDebug(`Public key fetched for ${username}, length: ${publicKey.length}, first 10 bytes:`, publicKey.slice(0, 10));
+  if (publicKey.length !== 1184) {
+    throw new Error(`Invalid public key length: ${publicKey.length} (expected 1184 for Kyber-768)`);
   }
+  publicKeys[username] = publicKey;
+}
 
-  // Update lists to reflect selection
-  updateUserList(clients);
+// Warm the key cache for many users with a single request
+async function prefetchPublicKeys(usernames) {
+  const missing = usernames.filter(username => !publicKeys[username]);
+  if (missing.length === 0) return;
+  try {
+    const response = await authFetch("/public_keys", {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify({ usernames: missing.slice(0, 200) })
+    });
+    if (!response.ok) return;
+    const data = await response.json();
+    for (const [username, publicKeyBase64] of Object.entries(data.public_keys)) {
+      try {
+        storePublicKey(username, publicKeyBase64);
+      } catch (error) {
+        logDebug(`Ignoring public key for ${username}: ${error.message}`);
+      }
+    }
+  } catch (error) {
+    logDebug("Public key prefetch failed:", error);
+  }
 }
 
 async function fetchPublicKey(username) {
   logDebug(`Fetching public key for ${username}`);
   try {
-    const response = await fetch(`/get_public_key/${username}`);
+    const response = await authFetch(`/get_public_key/${username}`);
     if (response.ok) {
       const data = await response.json();
-      const publicKey = base64ToArrayBuffer(data.public_key);
-      publicKeys[username] = publicKey;
-      logDebug(`Public key fetched for ${username}, length: ${publicKey.length}, first 10 bytes:`, publicKey.slice(0, 10));
-      if (publicKey.length !== 1184) {
-        throw new Error(`Invalid public key length: ${publicKey.length} (expected 1184 for Kyber-768)`);
-      }
+      storePublicKey(username, data.public_key);
       enableChat();
     } else {
       const error = await response.json();
@@ -765,6 +1004,11 @@ async function sendMessage() {
   const input = document.getElementById("message-input");
   const message = input.value.trim();
   
+  if (selectedGroup !== null) {
+    await sendToSelectedGroup();
+    return;
+  }
+
   // Check if we have something to send (either text message or file attachment)
   if ((!message && !currentFileAttachment) || !selectedUser || !publicKeys[selectedUser]) {
     if (!publicKeys[selectedUser]) {
@@ -800,11 +1044,14 @@ async function sendMessage() {
     const aesKey = await importAESKey(sharedSecret);
     
     // Create a base message object
+    // Our own id for the message until the server's ack tells us the one it assigned
+    const clientMessageId = crypto.randomUUID();
     const messageData = {
       type: "encrypted_message",
       sender: clientId,
       recipient: selectedUser,
-      timestamp: timestamp
+      timestamp: timestamp,
+      clientMessageId: clientMessageId
     };
     
     // Handle file attachment if present
@@ -817,12 +1064,17 @@ async function sendMessage() {
         
         logDebug("currentFileAttachment", currentFileAttachment);
 
+        // Stream the ciphertext to the server first; the message only references the finished transfer
+        const transferId = crypto.randomUUID();
+        await uploadFile(transferId, selectedUser, encryptedFileData);
+
         fileAttachmentData = {
           fileName: currentFileAttachment.name,
           fileType: currentFileAttachment.type,
           fileSize: currentFileAttachment.size,
           iv: arrayBufferToBase64(fileIv),
-          encryptedData: arrayBufferToBase64(encryptedFileData)
+          transferId: transferId,
+          encryptedSize: encryptedFileData.byteLength
         };
 
         logDebug("File attachment data:", fileAttachmentData);
@@ -852,6 +1104,7 @@ async function sendMessage() {
     // Add to message history
     if (!messageHistory[selectedUser]) messageHistory[selectedUser] = [];
     messageHistory[selectedUser].push({
+      clientMessageId: clientMessageId,
       sender: clientId,
       recipient: selectedUser,
       content: arrayBufferToBase64(encryptedContent),
@@ -879,6 +1132,165 @@ async function sendMessage() {
   }
 }
 
+// Encrypted file bytes for an attachment: fetched from the blob store, streamed over the socket, or inline (older messages)
+async function getEncryptedFileData(fileAttachment) {
+  if (fileAttachment.blobId) {
+    const response = await authFetch(`/attachments/${fileAttachment.blobId}`);
+    if (response.ok) {
+      return new Uint8Array(await response.arrayBuffer());
+    }
+    logDebug(`Attachment download failed with status ${response.status}, falling back`);
+  }
+  if (fileAttachment.transferId) {
+    return new Uint8Array(await downloadFile(fileAttachment.transferId));
+  }
+  return base64ToArrayBuffer(fileAttachment.encryptedData);
+}
+
+function uuidToBytes(uuid) {
+  const hex = uuid.replace(/-/g, "");
+  const bytes = new Uint8Array(16);
+  for (let i = 0; i < 16; i++) {
+    bytes[i] = parseInt(hex.substr(i * 2, 2), 16);
+  }
+  return bytes;
+}
+
+function bytesToUuid(bytes) {
+  const hex = Array.from(bytes, b => b.toString(16).padStart(2, "0")).join("");
+  return `${hex.slice(0, 8)}-${hex.slice(8, 12)}-${hex.slice(12, 16)}-${hex.slice(16, 20)}-${hex.slice(20)}`;
+}
+
+function encodeFileFrame(transferId, offset, payload) {
+  const frame = new Uint8Array(FILE_FRAME_HEADER_SIZE + payload.length);
+  frame.set(uuidToBytes(transferId), 0);
+  new DataView(frame.buffer).setBigUint64(16, BigInt(offset));
+  frame.set(payload, FILE_FRAME_HEADER_SIZE);
+  return frame;
+}
+
+// Upload encrypted bytes as binary chunks; resolves once the server has stored all of them
+function uploadFile(transferId, recipient, encryptedData) {
+  return new Promise((resolve, reject) => {
+    pendingUploads[transferId] = {
+      recipient: recipient,
+      data: new Uint8Array(encryptedData),
+      sent: 0,
+      acked: 0,
+      chunkSize: 64 * 1024,
+      window: 1024 * 1024,
+      resolve: resolve,
+      reject: reject
+    };
+    startUpload(transferId);
+  });
+}
+
+// (Re)starting an upload makes the server report how many bytes it already has
+function startUpload(transferId) {
+  const upload = pendingUploads[transferId];
+  sendToServer({
+    type: "file_upload_start",
+    transferId: transferId,
+    recipient: upload.recipient,
+    encryptedSize: upload.data.length
+  });
+}
+
+function handleFileUploadAck(data) {
+  const upload = pendingUploads[data.transferId];
+  if (!upload) return;
+
+  if (data.chunkSize) upload.chunkSize = data.chunkSize;
+  if (data.window) upload.window = data.window;
+  upload.acked = data.received;
+  // The ack to a (re)start, or a resync, says exactly where the server's copy ends
+  if (data.chunkSize || data.resync || upload.sent < upload.acked) {
+    upload.sent = upload.acked;
+  }
+
+  if (upload.acked >= upload.data.length) {
+    delete pendingUploads[data.transferId];
+    upload.resolve();
+    return;
+  }
+  pumpUpload(data.transferId, upload);
+}
+
+// Send chunks until a full window is awaiting acknowledgement
+function pumpUpload(transferId, upload) {
+  if (!socket || socket.readyState !== WebSocket.OPEN) return;
+  while (upload.sent < upload.data.length && upload.sent - upload.acked < upload.window) {
+    const chunk = upload.data.subarray(upload.sent, upload.sent + upload.chunkSize);
+    socket.send(encodeFileFrame(transferId, upload.sent, chunk));
+    upload.sent += chunk.length;
+  }
+}
+
+function downloadFile(transferId) {
+  if (pendingDownloads[transferId]) return pendingDownloads[transferId].promise;
+
+  const download = { data: null, received: 0, resyncing: false };
+  download.promise = new Promise((resolve, reject) => {
+    download.resolve = resolve;
+    download.reject = reject;
+  });
+  pendingDownloads[transferId] = download;
+  sendToServer({ type: "file_download_request", transferId: transferId, offset: 0 });
+  return download.promise;
+}
+
+function handleFileDownloadStart(data) {
+  const download = pendingDownloads[data.transferId];
+  if (!download) return;
+  if (!download.data) download.data = new Uint8Array(data.size);
+  download.resyncing = false;
+}
+
+function handleFileChunk(buffer) {
+  const bytes = new Uint8Array(buffer);
+  const transferId = bytesToUuid(bytes.subarray(0, 16));
+  const offset = Number(new DataView(buffer).getBigUint64(16));
+  const download = pendingDownloads[transferId];
+  if (!download || !download.data) return;
+
+  if (offset !== download.received) {
+    // A frame went missing: ask the server to resume from what we already have
+    if (offset > download.received && !download.resyncing) {
+      download.resyncing = true;
+      sendToServer({ type: "file_download_request", transferId: transferId, offset: download.received });
+    }
+    return;
+  }
+
+  const payload = bytes.subarray(FILE_FRAME_HEADER_SIZE);
+  download.data.set(payload, offset);
+  download.received += payload.length;
+  sendToServer({ type: "file_download_ack", transferId: transferId, received: download.received });
+
+  if (download.received >= download.data.length) {
+    delete pendingDownloads[transferId];
+    download.resolve(download.data.buffer);
+  }
+}
+
+function handleFileTransferError(pending, data) {
+  const transfer = pending[data.transferId];
+  if (!transfer) return;
+  delete pending[data.transferId];
+  transfer.reject(new Error(data.message));
+}
+
+// After a reconnect, pick up every unfinished transfer where the server left off
+function resumeFileTransfers() {
+  for (const transferId in pendingUploads) {
+    startUpload(transferId);
+  }
+  for (const transferId in pendingDownloads) {
+    sendToServer({ type: "file_download_request", transferId: transferId, offset: pendingDownloads[transferId].received });
+  }
+}
+
 // Read file as ArrayBuffer
 function readFileAsArrayBuffer(file) {
   return new Promise((resolve, reject) => {
@@ -978,7 +1390,7 @@ async function handleEncryptedMessage(data) {
     if (data.fileAttachment) {
       try {
         const fileIv = base64ToArrayBuffer(data.fileAttachment.iv);
-        const encryptedFileData = base64ToArrayBuffer(data.fileAttachment.encryptedData);
+        const encryptedFileData = await getEncryptedFileData(data.fileAttachment);
         
         // Get the AES key
         const iv = base64ToArrayBuffer(data.iv);
@@ -1007,13 +1419,10 @@ async function handleEncryptedMessage(data) {
       messageHistory[data.sender] = [];
     }
 
-    // Avoid adding duplicate messages to history
-    if (!messageHistory[data.sender].some(msg => 
-      msg.sender === data.sender && 
-      msg.timestamp === data.timestamp && 
-      ((msg.content === data.encryptedContent) || (msg.decryptedContent === messageText))
-    )) {
+    // Avoid adding duplicate messages to history, e.g. one redelivered after a lost connection
+    if (!messageHistory[data.sender].some(msg => msg.id === data.id)) {
       messageHistory[data.sender].push({
+        id: data.id,
         sender: data.sender,
         recipient: data.recipient,
         content: data.encryptedContent,
@@ -1028,6 +1437,7 @@ async function handleEncryptedMessage(data) {
 
       if (selectedUser === data.sender) {
         displayMessage(data.sender, messageText, false, data.timestamp, fileAttachment);
+        markConversationRead(data.sender);
       } else {
         unreadMessages[data.sender] = (unreadMessages[data.sender] || 0) + 1;
         updateUserList(clients);
@@ -1041,6 +1451,331 @@ async function handleEncryptedMessage(data) {
   }
 }
 
+// Messages that arrived while we were offline are pushed in batches after connecting
+async function handleOfflineMessages(data) {
+  logDebug(`Received ${data.messages.length} messages stored while offline`);
+  for (const message of data.messages) {
+    if (message.type === "group_message") await handleGroupMessage(message);
+    else await handleEncryptedMessage(message);
+  }
+  // Acknowledging the batch marks it delivered and lets the server send the next one
+  sendToServer({ type: "offline_messages_ack", ids: data.messages.map(msg => msg.id) });
+}
+
+// The server acknowledges a sent message once it has been stored, with the id it assigned
+function handleMessageAck(data) {
+  const history = messageHistory[data.recipient];
+  if (!history) return;
+  const message = history.find(msg => msg.isSent && !msg.id && msg.clientMessageId === data.clientMessageId);
+  if (message) {
+    message.id = data.id;
+    message.status = data.status;
+    logDebug(`Message ${data.id} to ${data.recipient} stored with status ${data.status}`);
+  }
+}
+
+// The recipient acknowledged some of our messages as delivered or read
+function handleMessageStatus(data) {
+  const history = messageHistory[data.recipient];
+  if (!history) return;
+  const ids = new Set(data.ids);
+  history.forEach(msg => {
+    if (msg.isSent && ids.has(msg.id)) msg.status = data.status;
+  });
+  logDebug(`${data.ids.length} messages to ${data.recipient} are now ${data.status}`);
+}
+
+// Groups the user belongs to; membership is fixed when a group is created
+async function fetchGroups() {
+  try {
+    const response = await authFetch(`/groups/${clientId}`);
+    const data = await response.json();
+    if (data.groups) {
+      data.groups.forEach(group => {
+        groups[group.id] = { name: group.name, members: group.members };
+      });
+      renderGroupList();
+    }
+  } catch (error) {
+    displayError(`Failed to fetch groups: ${error.message}`);
+  }
+}
+
+function renderGroupList() {
+  const groupList = document.getElementById("group-list");
+  if (!groupList) return;
+  groupList.innerHTML = "";
+
+  for (const [groupId, group] of Object.entries(groups)) {
+    const id = Number(groupId);
+    const groupItem = document.createElement("div");
+    groupItem.className = "user-item";
+    if (selectedGroup === id) groupItem.classList.add("selected");
+
+    const avatarContainer = document.createElement("div");
+    avatarContainer.className = "avatar-container";
+    const avatar = document.createElement("div");
+    avatar.className = "avatar";
+    avatar.textContent = group.name.substring(0, 2).toUpperCase();
+    avatarContainer.appendChild(avatar);
+    groupItem.appendChild(avatarContainer);
+
+    const groupInfo = document.createElement("div");
+    groupInfo.className = "user-info";
+    const nameSpan = document.createElement("span");
+    nameSpan.className = "username";
+    nameSpan.textContent = group.name;
+    groupInfo.appendChild(nameSpan);
+    const membersSpan = document.createElement("span");
+    membersSpan.className = "user-status";
+    membersSpan.textContent = `${group.members.length} members`;
+    groupInfo.appendChild(membersSpan);
+    groupItem.appendChild(groupInfo);
+
+    if (unreadGroups[id] > 0 && selectedGroup !== id) {
+      const badge = document.createElement("div");
+      badge.className = "unread-badge";
+      badge.textContent = unreadGroups[id];
+      groupItem.appendChild(badge);
+    }
+
+    groupItem.addEventListener("click", () => {
+      selectGroup(id);
+    });
+    groupList.appendChild(groupItem);
+  }
+
+  if (Object.keys(groups).length === 0) {
+    const emptyMessage = document.createElement("div");
+    emptyMessage.className = "empty-list-message";
+    emptyMessage.textContent = "No groups yet";
+    emptyMessage.style.padding = "10px 15px";
+    emptyMessage.style.color = "#757575";
+    emptyMessage.style.fontStyle = "italic";
+    emptyMessage.style.fontSize = "13px";
+    groupList.appendChild(emptyMessage);
+  }
+}
+
+// Ask for a name and members, then open the new group
+async function handleNewGroup() {
+  const name = prompt("Group name:");
+  if (!name || !name.trim()) return;
+  const members = (prompt("Members (comma-separated usernames):") || "")
+    .split(",")
+    .map(member => member.trim())
+    .filter(member => member && member !== clientId);
+  if (members.length === 0) return;
+  try {
+    const groupId = await createGroup(name.trim(), members);
+    await selectGroup(groupId);
+  } catch (error) {
+    displayError(`Failed to create group: ${error.message}`);
+  }
+}
+
+async function selectGroup(groupId) {
+  const group = groups[groupId];
+  if (!group) return;
+
+  document.getElementById("chat-placeholder").style.display = "none";
+  document.getElementById("chat-interface").style.display = "flex";
+  selectedGroup = groupId;
+  selectedUser = null;
+  unreadGroups[groupId] = 0;
+
+  document.getElementById("chat-title").textContent = group.name;
+  document.getElementById("selected-user-avatar").textContent = group.name.substring(0, 2).toUpperCase();
+  document.getElementById("chat-status").textContent = group.members.join(", ");
+
+  // The latest page of history; messages already known are skipped by handleGroupMessage
+  try {
+    const response = await authFetch(`/groups/${groupId}/messages`);
+    const data = await response.json();
+    if (data.messages) {
+      for (const message of data.messages) await handleGroupMessage(message, false);
+    }
+  } catch (error) {
+    displayError(`Failed to fetch group messages: ${error.message}`);
+  }
+  if (selectedGroup !== groupId) return;
+
+  document.getElementById("chat-messages").innerHTML = "";
+  const history = groupHistory[groupId] || [];
+  history.sort((a, b) => (a.id ?? Infinity) - (b.id ?? Infinity));
+  history.forEach(displayGroupMessage);
+  enableChat();
+  updateUserList(clients);
+  renderGroupList();
+}
+
+function displayGroupMessage(msg) {
+  const text = msg.isSent ? msg.decryptedContent : `${msg.sender}: ${msg.decryptedContent}`;
+  displayMessage(msg.sender, text, msg.isSent, msg.timestamp, msg.decryptedFileAttachment || null);
+}
+
+// Send the input (and any attachment) to the open group
+async function sendToSelectedGroup() {
+  const input = document.getElementById("message-input");
+  const message = input.value.trim();
+  if (!message && !currentFileAttachment) return;
+  const groupId = selectedGroup;
+  const file = currentFileAttachment;
+  input.value = "";
+  removeAttachment();
+  try {
+    await sendGroupMessage(groupId, message, file);
+    const history = groupHistory[groupId];
+    const sent = history[history.length - 1];
+    if (file) {
+      sent.decryptedFileAttachment = { fileName: file.name, fileType: file.type, fileSize: file.size,
+                                       data: await readFileAsArrayBuffer(file) };
+    }
+    if (selectedGroup === groupId) displayGroupMessage(sent);
+  } catch (error) {
+    displayError(`Failed to send group message: ${error.message}`);
+  }
+}
+
+async function createGroup(name, members) {
+  const response = await authFetch("/groups", {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify({ name: name, members: members })
+  });
+  const data = await response.json();
+  if (!response.ok) throw new Error(data.detail);
+  groups[data.id] = { name: data.name, members: data.members };
+  renderGroupList();
+  return data.id;
+}
+
+// A group message is encrypted once under a random content key. Each member gets that key wrapped
+// with a Kyber shared secret of their own: Kyber ciphertext || IV || AES-GCM(content key).
+async function wrapGroupKey(contentKey, publicKey) {
+  const { ciphertext, sharedSecret } = await encapsulateWithKyber(publicKey);
+  const wrappingKey = await importAESKey(sharedSecret);
+  const rawKey = await window.crypto.subtle.exportKey("raw", contentKey);
+  const { iv, encryptedContent } = await encryptWithAES(rawKey, wrappingKey);
+  const wrapped = new Uint8Array(ciphertext.length + iv.length + encryptedContent.byteLength);
+  wrapped.set(ciphertext, 0);
+  wrapped.set(iv, ciphertext.length);
+  wrapped.set(new Uint8Array(encryptedContent), ciphertext.length + iv.length);
+  return arrayBufferToBase64(wrapped);
+}
+
+async function unwrapGroupKey(wrappedBase64) {
+  const wrapped = new Uint8Array(base64ToArrayBuffer(wrappedBase64));
+  const ciphertextLength = OQSModule._get_kyber_768_ciphertext_length();
+  const privateKeyBase64 = getUserItem(clientId, 'kyber_private_key');
+  if (!privateKeyBase64) throw new Error("Kyber private key not found in localStorage");
+  const wrappingKey = await decryptWithKyber(wrapped.slice(0, ciphertextLength), base64ToArrayBuffer(privateKeyBase64));
+  const iv = wrapped.slice(ciphertextLength, ciphertextLength + 12);
+  const rawKey = await window.crypto.subtle.decrypt(
+    { name: "AES-GCM", iv }, wrappingKey, wrapped.slice(ciphertextLength + 12)
+  );
+  return await window.crypto.subtle.importKey("raw", rawKey, { name: "AES-GCM", length: 256 }, false, ["decrypt"]);
+}
+
+// Send one ciphertext (and at most one attachment upload) to every member of a group
+async function sendGroupMessage(groupId, text, file = null) {
+  const group = groups[groupId];
+  if (!group) throw new Error(`Unknown group ${groupId}`);
+  await prefetchPublicKeys(group.members);
+  const missing = group.members.filter(member => !publicKeys[member]);
+  if (missing.length > 0) throw new Error(`Public key not available for ${missing.join(", ")}`);
+
+  const contentKey = await generateAESKey();
+  const timestamp = new Date().toISOString();
+  const messageData = {
+    type: "group_message", groupId: groupId, sender: clientId, timestamp: timestamp,
+    clientMessageId: crypto.randomUUID()
+  };
+
+  if (file) {
+    const { iv: fileIv, encryptedContent: encryptedFileData } = await encryptWithAES(
+      await readFileAsArrayBuffer(file), contentKey
+    );
+    const transferId = crypto.randomUUID();
+    await uploadFile(transferId, `group:${groupId}`, encryptedFileData);
+    messageData.fileAttachment = {
+      fileName: file.name,
+      fileType: file.type,
+      fileSize: file.size,
+      iv: arrayBufferToBase64(fileIv),
+      transferId: transferId,
+      encryptedSize: encryptedFileData.byteLength
+    };
+  }
+
+  const { iv, encryptedContent } = await encryptWithAES(text, contentKey);
+  messageData.iv = arrayBufferToBase64(iv);
+  messageData.encryptedContent = arrayBufferToBase64(encryptedContent);
+  // Our own copy of the key lets this message be read back from history
+  messageData.encryptedAESKeys = {};
+  for (const member of group.members) {
+    messageData.encryptedAESKeys[member] = await wrapGroupKey(contentKey, publicKeys[member]);
+  }
+
+  if (!groupHistory[groupId]) groupHistory[groupId] = [];
+  groupHistory[groupId].push({
+    clientMessageId: messageData.clientMessageId,
+    sender: clientId,
+    isSent: true,
+    timestamp: timestamp,
+    decryptedContent: text,
+    fileAttachment: messageData.fileAttachment || null
+  });
+  sendToServer(messageData);
+}
+
+// Decrypt and keep a group message; live ones are shown or counted as unread
+async function handleGroupMessage(data, live = true) {
+  try {
+    const contentKey = await unwrapGroupKey(data.encryptedAESKey);
+    const text = await decryptWithAES(base64ToArrayBuffer(data.encryptedContent), base64ToArrayBuffer(data.iv), contentKey);
+    let fileAttachment = null;
+    if (data.fileAttachment) {
+      const encryptedFileData = await getEncryptedFileData(data.fileAttachment);
+      fileAttachment = {
+        fileName: data.fileAttachment.fileName,
+        fileType: data.fileAttachment.fileType,
+        fileSize: data.fileAttachment.fileSize,
+        data: await decryptWithAES(encryptedFileData, base64ToArrayBuffer(data.fileAttachment.iv), contentKey)
+      };
+    }
+    if (!groupHistory[data.groupId]) groupHistory[data.groupId] = [];
+    if (groupHistory[data.groupId].some(msg => msg.id === data.id)) return;
+    const message = {
+      id: data.id,
+      sender: data.sender,
+      isSent: data.sender === clientId,
+      timestamp: data.timestamp,
+      decryptedContent: text,
+      decryptedFileAttachment: fileAttachment
+    };
+    groupHistory[data.groupId].push(message);
+    if (!groups[data.groupId]) fetchGroups();
+    if (live && selectedGroup === data.groupId) {
+      displayGroupMessage(message);
+    } else if (live) {
+      unreadGroups[data.groupId] = (unreadGroups[data.groupId] || 0) + 1;
+      renderGroupList();
+    }
+    logDebug(`Group message ${data.id} from ${data.sender} in group ${data.groupId}`);
+  } catch (error) {
+    displayError(`Failed to process group message: ${error.message || error}`);
+  }
+}
+
+function handleGroupMessageAck(data) {
+  const message = (groupHistory[data.groupId] || []).find(
+    msg => msg.isSent && !msg.id && msg.clientMessageId === data.clientMessageId
+  );
+  if (message) message.id = data.id;
+  logDebug(`Group message ${data.id} stored, delivered to ${data.delivered} members`);
+}
+
 // Helper function to decrypt message content
 async function decryptMessage(data) {
   if (!data.encryptedContent || !data.iv || !data.encryptedAESKey) {
@@ -1146,7 +1881,8 @@ async function decryptWithAES(encryptedContent, iv, aesKey) {
 }
 
 function displayMessage(sender, content, isSent, timestamp = new Date().toISOString(), fileAttachment = null) {
-  if (sender !== selectedUser && sender !== clientId) return;
+  // Group messages are only passed in while their group is open
+  if (selectedGroup === null && sender !== selectedUser && sender !== clientId) return;
 
   const chatMessages = document.getElementById("chat-messages");
 
@@ -1349,7 +2085,7 @@ function arrayBufferToBase64(buffer) {
 // fetch users based on search query
 async function searchUsers(query) {
   try {
-    const response = await fetch(`/search_users?query=${encodeURIComponent(query)}`);
+    const response = await authFetch(`/search_users?query=${encodeURIComponent(query)}`);
     if (response.ok) {
       const data = await response.json();
       allUsers = data.users;
@@ -1390,13 +2126,14 @@ async function handleLogout() {
     // Call logout endpoint
     const response = await fetch('/logout', {
       method: 'POST',
-      headers: {
+      headers: authHeaders({
         'Content-Type': 'application/json'
-      }
+      })
     });
     
     // Clear only current user's data from localStorage
     //clearUserStorage(clientId);
+    removeUserItem(clientId, 'session_token');
     
     // Redirect to login page
     window.location.href = "/static/index.html";
@@ -1405,6 +2142,25 @@ async function handleLogout() {
   }
 }
 
+// Session token issued at login, sent with every authenticated request
+function sessionToken() {
+  return getUserItem(clientId, 'session_token') || "";
+}
+
+function authHeaders(headers = {}) {
+  return { ...headers, Authorization: `Bearer ${sessionToken()}` };
+}
+
+// fetch() with the session token; an expired or revoked session sends the user back to the login page
+async function authFetch(url, options = {}) {
+  const response = await fetch(url, { ...options, headers: authHeaders(options.headers) });
+  if (response.status === 401) {
+    removeUserItem(clientId, 'session_token');
+    window.location.href = "/static/index.html";
+  }
+  return response;
+}
+
 // User-specific localStorage helper functions
 function getUserKey(username, key) {
   return `user_${username}_${key}`;
@@ -38,6 +38,8 @@ document.addEventListener('DOMContentLoaded', function() {
         
         if (response.ok) {
           const data = await response.json();
+          // Authenticates the chat page's requests and WebSocket until it expires or the user logs out
+          setUserItem(username, 'session_token', data.token);
           statusElement.textContent = 'Login successful! Redirecting...';
           statusElement.style.color = '#2ecc71';
           setTimeout(() => {
@@ -0,0 +1,180 @@
+import gzip
+import hashlib
+import logging
+import os
+import re
+from typing import Dict, List, Tuple
+
+from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers
+from starlette.responses import Response
+from starlette.types import Scope
+
+from serialization import dumps, loads
+
+try:
+    import brotli
+except ImportError:  # optional; gzip variants are still built and served
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# Web client sources, and where their hashed and precompressed copies are built
+STATIC_SOURCE_DIR = "static"
+STATIC_BUILD_DIR = os.environ.get("STATIC_BUILD_DIR", "build/static")
+MANIFEST_FILE = "manifest.json"
+
+# Assets that get a content hash in their name, in build order: a file is hashed after the assets it refers to,
+# so its own hash changes whenever one of theirs does (oqs.js names oqs.wasm, the pages name everything)
+HASHED_EXTENSIONS = (".wasm", ".css", ".js")
+PAGE_EXTENSIONS = (".html",)
+
+# Variants tried in order of preference when the client accepts them
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+# Files smaller than this are not worth a compressed variant (bytes)
+MIN_COMPRESS_SIZE = 512
+
+# Hashed names never change content; everything else is revalidated on each use
+CACHE_IMMUTABLE = "public, max-age=31536000, immutable"
+CACHE_REVALIDATE = "no-cache"
+
+# Explicit, so serving never depends on the host's mime.types; application/wasm lets browsers compile while streaming
+MEDIA_TYPES = {
+    ".html": "text/html; charset=utf-8",
+    ".js": "text/javascript; charset=utf-8",
+    ".css": "text/css; charset=utf-8",
+    ".wasm": "application/wasm",
+}
+
+
+def _write(path: str, data: bytes):
+    # Atomic, so workers building at the same time never serve a half-written file
+    temp = f"{path}.{os.getpid()}.tmp"
+    with open(temp, "wb") as f:
+        f.write(data)
+    os.replace(temp, path)
+
+
+def _rewrite_references(text: str, hashed: Dict[str, str]) -> str:
+    """Point references to hashed assets, as a quoted name or a /static/ path, at their hashed names."""
+    for name, hashed_name in hashed.items():
+        text = re.sub(rf"""(?<=["'/]){re.escape(name)}(?=["'?#])""", hashed_name, text)
+    return text
+
+
+def _compress(data: bytes) -> List[Tuple[str, bytes]]:
+    variants = [(".gz", gzip.compress(data, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        variants.append((".br", brotli.compress(data, quality=11)))
+    return [(suffix, body) for suffix, body in variants if len(body) < len(data)]
+
+
+def _build_order(name: str) -> int:
+    ext = os.path.splitext(name)[1]
+    return HASHED_EXTENSIONS.index(ext) if ext in HASHED_EXTENSIONS else len(HASHED_EXTENSIONS)
+
+
+def build(source: str = STATIC_SOURCE_DIR, target: str = STATIC_BUILD_DIR) -> Dict[str, str]:
+    """Write hashed and precompressed copies of the static assets; returns the manifest of hashed names.
+
+    Every file is also kept under its own name, so pages (which are never
+    hashed) and anything still asking for an unhashed asset keep working.
+    """
+    os.makedirs(target, exist_ok=True)
+    hashed: Dict[str, str] = {}
+    written = {MANIFEST_FILE}
+    names = sorted((name for name in os.listdir(source) if os.path.isfile(os.path.join(source, name))),
+                   key=lambda name: (_build_order(name), name))
+    for name in names:
+        with open(os.path.join(source, name), "rb") as f:
+            data = f.read()
+        stem, ext = os.path.splitext(name)
+        if ext in HASHED_EXTENSIONS[1:] or ext in PAGE_EXTENSIONS:
+            data = _rewrite_references(data.decode(), hashed).encode()
+        outputs = [name]
+        if ext in HASHED_EXTENSIONS:
+            hashed[name] = f"{stem}.{hashlib.sha256(data).hexdigest()[:12]}{ext}"
+            outputs.append(hashed[name])
+        variants = _compress(data) if ext in MEDIA_TYPES and len(data) >= MIN_COMPRESS_SIZE else []
+        for output in outputs:
+            _write(os.path.join(target, output), data)
+            written.add(output)
+            for suffix, body in variants:
+                _write(os.path.join(target, output + suffix), body)
+                written.add(output + suffix)
+    # Hashed copies from earlier builds are only clutter: pages always name the current ones.
+    # Temporary files may belong to another worker building at the same moment.
+    for stale in set(os.listdir(target)) - written:
+        if not stale.endswith(".tmp"):
+            os.remove(os.path.join(target, stale))
+    _write(os.path.join(target, MANIFEST_FILE), dumps(hashed).encode())
+    logger.info(f"Built {len(names)} static assets into {target} ({len(hashed)} hashed, "
+                f"{'gzip and brotli' if brotli is not None else 'gzip only'})")
+    return hashed
+
+
+def ensure_built(source: str = STATIC_SOURCE_DIR, target: str = STATIC_BUILD_DIR) -> Dict[str, str]:
+    """The current manifest, rebuilding first if a source file changed since the last build."""
+    manifest_path = os.path.join(target, MANIFEST_FILE)
+    try:
+        built_at = os.stat(manifest_path).st_mtime
+        with open(manifest_path, "rb") as f:
+            manifest = loads(f.read())
+    except (OSError, ValueError):
+        return build(source, target)
+    if any(entry.stat().st_mtime > built_at for entry in os.scandir(source) if entry.is_file()):
+        return build(source, target)
+    return manifest
+
+
+def _accepted_encodings(header: str) -> set:
+    accepted = set()
+    for part in header.split(","):
+        coding, _, params = part.partition(";")
+        weight = params.strip()
+        try:
+            if weight.startswith("q=") and float(weight[2:]) == 0:
+                continue
+        except ValueError:
+            continue
+        accepted.add(coding.strip().lower())
+    return accepted
+
+
+class StaticAssets(StaticFiles):
+    """Serves the built assets: precompressed variants when accepted, immutable caching for hashed names."""
+
+    def __init__(self, directory: str, manifest: Dict[str, str]):
+        super().__init__(directory=directory)
+        self.immutable = set(manifest.values())
+        # The build is finished before serving starts, so which variants exist is known up front
+        self.files = set(os.listdir(directory))
+
+    async def get_response(self, path: str, scope: Scope) -> Response:
+        name = os.path.basename(path)
+        ext = os.path.splitext(name)[1]
+        encoding = None
+        if ext in MEDIA_TYPES:
+            accepted = _accepted_encodings(Headers(scope=scope).get("accept-encoding", ""))
+            for candidate, suffix in ENCODINGS:
+                if candidate in accepted and path + suffix in self.files:
+                    encoding = candidate
+                    path += suffix
+                    break
+        response = await super().get_response(path, scope)
+        response.headers["Cache-Control"] = CACHE_IMMUTABLE if name in self.immutable else CACHE_REVALIDATE
+        if ext in MEDIA_TYPES:
+            response.headers["Vary"] = "Accept-Encoding"
+            # Ranges and revalidations of a variant are of its encoded bytes too, so they name the encoding
+            if encoding:
+                response.headers["Content-Encoding"] = encoding
+            # A multi-range answer keeps its multipart type, a 304 has no body to describe
+            content_type = response.headers.get("content-type", "")
+            if response.status_code != 304 and not content_type.startswith("multipart/"):
+                response.headers["Content-Type"] = MEDIA_TYPES[ext]
+        return response
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    build()
@@ -0,0 +1,151 @@
+import asyncio
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, List, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+# Default database location and pool sizing
+DB_PATH = "users.db"
+POOL_SIZE = 4
+STATEMENT_CACHE_SIZE = 256
+
+# WAL with NORMAL sync never fsyncs on commit: a crash cannot corrupt the database or lose a commit, but power
+# loss may lose the last ones. Writes that must survive it raise the level for their own transaction.
+SYNCHRONOUS = "NORMAL"
+
+# Applied to every pooled connection when it is opened. auto_vacuum only takes effect on a new
+# database, before its first table exists; it lets retention shrink the file incrementally.
+CONNECTION_PRAGMAS = (
+    "PRAGMA auto_vacuum = INCREMENTAL",
+    "PRAGMA journal_mode = WAL",
+    f"PRAGMA synchronous = {SYNCHRONOUS}",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA busy_timeout = 5000",
+)
+
+
+class Database:
+    """Bounded pool of SQLite connections whose queries run off the event loop.
+
+    Connections are opened once, tuned with ``CONNECTION_PRAGMAS`` and reused,
+    so each one keeps its own prepared statement cache. All async methods run
+    on a dedicated thread pool sized to the connection pool, which means a
+    slow query only ever occupies a worker thread, never the event loop.
+    """
+
+    def __init__(self, path: str = DB_PATH, pool_size: int = POOL_SIZE,
+                 statement_cache_size: int = STATEMENT_CACHE_SIZE):
+        self.path = path
+        self.pool_size = pool_size
+        self.statement_cache_size = statement_cache_size
+        self._pool: "queue.Queue[sqlite3.Connection]" = queue.Queue(maxsize=pool_size)
+        self._opened = 0
+        self._open_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="sqlite")
+        # Calls made through run() and the seconds callers spent awaiting them, queueing included
+        self.calls = 0
+        self.call_seconds = 0.0
+
+    def _open_connection(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path,
+            timeout=5.0,
+            check_same_thread=False,
+            cached_statements=self.statement_cache_size,
+        )
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        logger.debug("Opened pooled database connection to %s", self.path)
+        return conn
+
+    def _acquire(self) -> sqlite3.Connection:
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            pass
+        # Lazily grow the pool up to its bound, then wait for a free connection
+        with self._open_lock:
+            grow = self._opened < self.pool_size
+            if grow:
+                self._opened += 1
+        if grow:
+            try:
+                return self._open_connection()
+            except Exception:
+                with self._open_lock:
+                    self._opened -= 1
+                raise
+        return self._pool.get()
+
+    def _release(self, conn: sqlite3.Connection):
+        if conn.in_transaction:
+            conn.rollback()
+        self._pool.put_nowait(conn)
+
+    @contextmanager
+    def connection(self):
+        """Borrow a pooled connection synchronously (for startup and worker threads)."""
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            self._release(conn)
+
+    def _run_sync(self, fn: Callable[..., Any], *args) -> Any:
+        # Any transaction left open by a failing fn is rolled back on release
+        with self.connection() as conn:
+            return fn(conn, *args)
+
+    async def run(self, fn: Callable[..., Any], *args) -> Any:
+        """Run ``fn(conn, *args)`` on a pooled connection in a worker thread."""
+        loop = asyncio.get_running_loop()
+        started_at = time.perf_counter()
+        try:
+            return await loop.run_in_executor(self._executor, self._run_sync, fn, *args)
+        finally:
+            self.calls += 1
+            self.call_seconds += time.perf_counter() - started_at
+
+    async def fetchone(self, sql: str, params: Sequence = ()) -> Optional[tuple]:
+        def _fetchone(conn):
+            return conn.execute(sql, params).fetchone()
+        return await self.run(_fetchone)
+
+    async def fetchall(self, sql: str, params: Sequence = ()) -> List[tuple]:
+        def _fetchall(conn):
+            return conn.execute(sql, params).fetchall()
+        return await self.run(_fetchall)
+
+    async def execute(self, sql: str, params: Sequence = ()) -> int:
+        """Execute a single write statement in its own transaction and return the last row id."""
+        def _execute(conn):
+            with conn:
+                return conn.execute(sql, params).lastrowid
+        return await self.run(_execute)
+
+    def stats(self) -> dict:
+        return {
+            "pool_size": self.pool_size,
+            "open_connections": self._opened,
+            "idle_connections": self._pool.qsize(),
+            "calls": self.calls,
+            "call_seconds": self.call_seconds,
+        }
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        while True:
+            try:
+                conn = self._pool.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+        self._opened = 0
@@ -0,0 +1,101 @@
+import os
+import sys
+
+import pytest
+
+# The application modules live at the repository root
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, ROOT)
+
+from migrations import migrate  # noqa: E402
+from storage import Database  # noqa: E402
+
+
+@pytest.fixture
+def db(tmp_path):
+    """A migrated database of its own for each test."""
+    database = Database(str(tmp_path / "test.db"), pool_size=2)
+    with database.connection() as conn:
+        migrate(conn)
+    yield database
+    database.close()
+
+
+def add_user(database: Database, username: str):
+    with database.connection() as conn, conn:
+        conn.execute("INSERT INTO users (username, email, password_hash, public_key) VALUES (?, ?, 'x', 'key')",
+                     (username, f"{username}@example.com"))
+
+
+@pytest.fixture(scope="session")
+def app_module(tmp_path_factory):
+    """The application, imported once with its database and files in a scratch directory."""
+    workdir = tmp_path_factory.mktemp("app")
+    os.symlink(os.path.join(ROOT, "static"), workdir / "static")
+    previous = os.getcwd()
+    # Pooled connections are opened lazily by relative path, so the directory stays current for the session
+    os.chdir(workdir)
+    os.environ.setdefault("SESSION_SECRET", "test-session-secret")
+    import app
+    yield app
+    os.chdir(previous)
+
+
+@pytest.fixture(scope="session")
+def client(app_module):
+    from fastapi.testclient import TestClient
+    with TestClient(app_module.app) as test_client:
+        yield test_client
+
+
+_users = iter(range(1, 1_000_000))
+
+
+def signup(test_client, prefix: str = "user") -> tuple:
+    """Register and log in a fresh user; returns the username and their session token."""
+    username = f"{prefix}{next(_users)}"
+    response = test_client.post("/signup", json={"username": username, "email": f"{username}@example.com",
+                                                 "password": "password", "public_key": "key"})
+    assert response.status_code == 200, response.text
+    token = test_client.post("/login", json={"username": username, "password": "password"}).json()["token"]
+    return username, token
+
+
+def auth(token: str) -> dict:
+    return {"Authorization": f"Bearer {token}"}
+
+
+def ws_connect(test_client, username: str, token: str):
+    """Open a user's WebSocket, offering the session token as a subprotocol like the web client does."""
+    return test_client.websocket_connect(f"/ws/{username}", subprotocols=["bearer", token])
+
+
+class FakeWebSocket:
+    """Stands in for a client socket: records what the server sends and how it was closed."""
+
+    def __init__(self, fail: bool = False):
+        self.fail = fail
+        self.accepted = False
+        self.sent = []
+        self.close_code = None
+
+    async def accept(self, subprotocol=None):
+        self.accepted = True
+
+    async def send_text(self, text: str):
+        if self.fail:
+            raise ConnectionError("socket gone")
+        self.sent.append(text)
+
+    async def send_bytes(self, data: bytes):
+        if self.fail:
+            raise ConnectionError("socket gone")
+        self.sent.append(data)
+
+    async def close(self, code: int = 1000):
+        self.close_code = code
+
+    def frames(self, frame_type=None) -> list:
+        from serialization import loads
+        frames = [loads(text) for text in self.sent if isinstance(text, str)]
+        return [f for f in frames if frame_type is None or f.get("type") == frame_type]
@@ -0,0 +1,46 @@
+import asyncio
+import hashlib
+import os
+
+from blob_store import BlobStore
+from conftest import auth, signup
+
+
+def test_identical_payloads_are_stored_once(tmp_path):
+    store = BlobStore(str(tmp_path / "blobs"))
+    spool = tmp_path / "upload.bin"
+    spool.write_bytes(b"ciphertext")
+
+    async def scenario():
+        return await store.put_bytes(b"ciphertext"), await store.put_file(str(spool))
+
+    (first, size), (second, _) = asyncio.run(scenario())
+    assert first == second == hashlib.sha256(b"ciphertext").hexdigest()
+    assert size == len(b"ciphertext")
+    assert not spool.exists()
+    assert os.listdir(os.path.dirname(store.path(first))) == [first]
+
+
+def test_ids_are_validated_before_use(tmp_path):
+    store = BlobStore(str(tmp_path / "blobs"))
+    assert not store.valid_id("../../etc/passwd")
+    assert not store.exists("a" * 63)
+    store.remove("f" * 64)
+
+
+def test_attachments_are_served_to_participants_with_ranges(app_module, client):
+    alice, alice_token = signup(client, "alice")
+    bob, bob_token = signup(client, "bob")
+    _, mallory_token = signup(client, "mallory")
+    blob_id, _ = asyncio.run(app_module.blob_store.put_bytes(b"0123456789"))
+    with app_module.db.connection() as conn, conn:
+        conn.execute("INSERT INTO messages (sender, recipient, encrypted_content, iv, encrypted_aes_key, timestamp, "
+                     "attachment_blob) VALUES (?, ?, 'c', 'iv', 'k', 't', ?)", (alice, bob, blob_id))
+
+    response = client.get(f"/attachments/{blob_id}", headers={**auth(bob_token), "Range": "bytes=2-5"})
+    assert response.status_code == 206
+    assert response.content == b"2345"
+    assert "immutable" in response.headers["cache-control"]
+    assert client.get(f"/attachments/{blob_id}", headers=auth(alice_token)).content == b"0123456789"
+    assert client.get(f"/attachments/{blob_id}", headers=auth(mallory_token)).status_code == 404
+    assert client.get(f"/attachments/{blob_id}").status_code == 401
@@ -0,0 +1,59 @@
+import asyncio
+
+from conftest import FakeWebSocket
+from connection_manager import ConnectionManager
+
+
+def _manager(spilled, **kwargs):
+    return ConnectionManager(on_spill=spilled.append, **kwargs)
+
+
+def test_clean_disconnect_spills_unconfirmed_messages_once():
+    spilled = []
+
+    async def scenario():
+        manager = _manager(spilled)
+        await manager.start()
+        connection_id = await manager.connect(FakeWebSocket(), "bob")
+        manager.send_frame('{"type":"note"}', "bob", {"id": 1, "recipient": "bob"})
+        await asyncio.sleep(0.01)
+        manager.disconnect("bob", connection_id)
+        await manager.stop()
+
+    asyncio.run(scenario())
+    assert spilled == [{"id": 1, "recipient": "bob"}]
+
+
+def test_confirmed_messages_are_not_spilled():
+    spilled = []
+
+    async def scenario():
+        manager = _manager(spilled, heartbeat_interval=0.02)
+        await manager.start()
+        connection_id = await manager.connect(FakeWebSocket(), "bob")
+        manager.send_frame('{"type":"note"}', "bob", {"id": 1, "recipient": "bob"})
+        await asyncio.sleep(0.03)
+        manager.pong(connection_id, manager._ping_seq)
+        manager.disconnect("bob", connection_id)
+        await manager.stop()
+
+    asyncio.run(scenario())
+    assert spilled == []
+
+
+def test_reaped_connection_spills_each_message_once():
+    spilled = []
+
+    async def scenario():
+        manager = _manager(spilled, heartbeat_interval=0.02, heartbeat_timeout=0.05)
+        await manager.start()
+        await manager.connect(FakeWebSocket(), "bob")
+        manager.send_frame('{"type":"note"}', "bob", {"id": 1, "recipient": "bob"})
+        await asyncio.sleep(0.03)
+        manager.send_frame('{"type":"note"}', "bob", {"id": 2, "recipient": "bob"})
+        await asyncio.sleep(0.1)
+        await manager.stop()
+        return manager.reaped
+
+    assert asyncio.run(scenario()) == 1
+    assert sorted(meta["id"] for meta in spilled) == [1, 2]
@@ -0,0 +1,81 @@
+import sqlite3
+
+from conftest import auth, signup
+from conversations import CONVERSATIONS_SQL
+from migrations import migrate
+
+
+def _store(conn, sender, recipient, status="sent"):
+    with conn:
+        return conn.execute("INSERT INTO messages (sender, recipient, encrypted_content, iv, encrypted_aes_key, "
+                            "timestamp, status) VALUES (?, ?, 'c', 'iv', 'k', 't', ?)",
+                            (sender, recipient, status)).lastrowid
+
+
+def _summaries(conn, owner):
+    return {row[0]: (row[1], row[3], row[4], row[5]) for row in conn.execute(CONVERSATIONS_SQL, (owner, 10))}
+
+
+def test_triggers_keep_summaries_current(db):
+    with db.connection() as conn:
+        first = _store(conn, "alice", "bob")
+        second = _store(conn, "alice", "bob")
+        reply = _store(conn, "bob", "alice")
+        assert _summaries(conn, "bob") == {"alice": (reply, "bob", "sent", 2)}
+        assert _summaries(conn, "alice") == {"bob": (reply, "bob", "sent", 1)}
+
+        with conn:
+            conn.execute("UPDATE messages SET status = 'delivered' WHERE id = ?", (reply,))
+            conn.execute("DELETE FROM messages WHERE id IN (?, ?)", (reply, first))
+        assert _summaries(conn, "alice") == {"bob": (second, "alice", "sent", 0)}
+        assert _summaries(conn, "bob") == {"alice": (second, "alice", "sent", 1)}
+
+
+def test_existing_history_is_backfilled(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / "old.db"), isolation_level=None)
+    migrate(conn)
+    # As it was before summaries existed
+    for trigger in ("insert", "status", "delete"):
+        conn.execute(f"DROP TRIGGER conversations_message_{trigger}")
+    conn.execute("DROP TABLE conversations")
+    read = _store(conn, "alice", "bob", "read")
+    delivered = _store(conn, "alice", "bob", "delivered")
+    last = _store(conn, "alice", "bob")
+    conn.execute("PRAGMA user_version = 0")
+    migrate(conn)
+    # Unread is everything after the last message reported read, whatever its delivery status
+    assert _summaries(conn, "bob") == {"alice": (last, "alice", "sent", 2)}
+
+    # Later inserts, deletes and read receipts keep to the same count as the backfill
+    newer = _store(conn, "alice", "bob")
+    assert _summaries(conn, "bob")["alice"][3] == 3
+    with conn:
+        conn.execute("DELETE FROM messages WHERE id IN (?, ?)", (read, delivered))
+    assert _summaries(conn, "bob")["alice"][3] == 2
+    with conn:
+        conn.execute("UPDATE messages SET status = 'read' WHERE id = ?", (last,))
+    assert _summaries(conn, "bob") == {"alice": (newer, "alice", "sent", 1)}
+    with conn:
+        conn.execute("UPDATE messages SET status = 'read' WHERE id = ?", (newer,))
+        conn.execute("DELETE FROM messages WHERE id = ?", (last,))
+    assert _summaries(conn, "bob") == {"alice": (newer, "alice", "read", 0)}
+    assert _summaries(conn, "alice") == {"bob": (newer, "alice", "read", 0)}
+
+
+def test_reading_a_conversation_clears_its_unread_count(app_module, client):
+    alice, alice_token = signup(client, "alice")
+    bob, bob_token = signup(client, "bob")
+    with app_module.db.connection() as conn:
+        first = _store(conn, alice, bob)
+        _store(conn, alice, bob)
+
+    def unread():
+        page = client.get(f"/conversations/{bob}", headers=auth(bob_token)).json()
+        return [(c["peer"], c["unread_count"]) for c in page["conversations"]]
+
+    assert unread() == [(alice, 2)]
+    client.post(f"/conversations/{bob}/read", json={"peer": alice, "up_to_id": first}, headers=auth(bob_token))
+    assert unread() == [(alice, 1)]
+    client.post(f"/conversations/{bob}/read", json={"peer": alice}, headers=auth(bob_token))
+    assert unread() == [(alice, 0)]
+    assert client.get(f"/conversations/{bob}", headers=auth(alice_token)).status_code == 403
@@ -0,0 +1,122 @@
+import asyncio
+import json
+import os
+import uuid
+
+import pytest
+
+from blob_store import BlobStore
+from conftest import signup, ws_connect
+from file_transfer import FileTransferManager, TransferError, encode_frame
+
+
+@pytest.fixture
+def transfers(tmp_path):
+    return FileTransferManager(BlobStore(str(tmp_path / "blobs")), str(tmp_path / "transfers"), chunk_size=4)
+
+
+def _upload(transfers, payload=b"encrypted!", recipient="bob"):
+    async def scenario():
+        transfer_id = str(uuid.uuid4())
+        transfer = await transfers.start_upload("alice", transfer_id, recipient, len(payload))
+        for offset in range(0, len(payload), 4):
+            await transfers.write_chunk("alice", encode_frame(transfer_id, offset, payload[offset:offset + 4]))
+        return transfer
+
+    return asyncio.run(scenario())
+
+
+def test_upload_completes_into_the_blob_store(transfers):
+    transfer = _upload(transfers)
+    assert transfer.complete and transfer.blob_id
+    with open(transfer.path, "rb") as f:
+        assert f.read() == b"encrypted!"
+
+
+def test_out_of_order_chunks_ask_the_client_to_resync(transfers):
+    async def scenario():
+        transfer_id = str(uuid.uuid4())
+        await transfers.start_upload("alice", transfer_id, "bob", 8)
+        _, in_sequence = await transfers.write_chunk("alice", encode_frame(transfer_id, 4, b"late"))
+        with pytest.raises(TransferError):
+            await transfers.write_chunk("mallory", encode_frame(transfer_id, 0, b"evil"))
+        return in_sequence
+
+    assert asyncio.run(scenario()) is False
+
+
+def test_invalid_uploads_are_rejected(transfers):
+    async def scenario(transfer_id, size):
+        await transfers.start_upload("alice", transfer_id, "bob", size)
+
+    with pytest.raises(TransferError):
+        asyncio.run(scenario("../../etc/passwd", 10))
+    with pytest.raises(TransferError):
+        asyncio.run(scenario(str(uuid.uuid4()), transfers.max_size + 1))
+    assert asyncio.run(transfers.get("../../etc/passwd")) is None
+
+
+def test_lookup_has_no_side_effects_and_grants_accumulate(transfers):
+    transfer = _upload(transfers)
+
+    async def scenario():
+        found = await transfers.get_complete(transfer.transfer_id, "alice")
+        assert found is transfer
+        assert await transfers.get_complete(transfer.transfer_id, "bob") is None
+        await transfers.grant(transfer, "carol")
+
+    asyncio.run(scenario())
+    assert transfer.can_read("bob") and transfer.can_read("carol") and not transfer.can_read("mallory")
+
+    # A restarted server still knows every reader
+    reloaded = asyncio.run(FileTransferManager(transfers.blob_store, transfers.directory).get(transfer.transfer_id))
+    assert reloaded.readers == {"bob", "carol"}
+
+
+def test_sidecars_with_a_single_recipient_still_load(transfers):
+    transfer_id = str(uuid.uuid4())
+    with open(os.path.join(transfers.directory, transfer_id + ".json"), "w") as f:
+        json.dump({"owner": "alice", "recipient": "bob", "size": 3, "blob_id": None}, f)
+    transfer = asyncio.run(transfers.get(transfer_id))
+    assert transfer.can_read("bob") and transfer.complete
+
+
+def test_download_of_a_removed_blob_reports_an_error(app_module, client):
+    alice, alice_token = signup(client, "alice")
+    bob, _ = signup(client, "bob")
+    transfer_id = str(uuid.uuid4())
+    with ws_connect(client, alice, alice_token) as ws:
+        ws.send_json({"type": "file_upload_start", "transferId": transfer_id, "recipient": bob, "encryptedSize": 6})
+        while ws.receive_json()["type"] != "file_upload_ack":
+            pass
+        ws.send_bytes(encode_frame(transfer_id, 0, b"secret"))
+        assert ws.receive_json()["received"] == 6
+
+        transfer = asyncio.run(app_module.transfers.get(transfer_id))
+        os.remove(transfer.path)
+        ws.send_json({"type": "file_download_request", "transferId": transfer_id})
+        assert ws.receive_json()["type"] == "file_download_start"
+        error = ws.receive_json()
+        assert (error["type"], error["transferId"]) == ("file_download_error", transfer_id)
+
+
+def test_abandoned_uploads_are_removed_from_disk(transfers):
+    old = 0
+    # Left behind by an earlier run, and one abandoned in this one
+    leftover = os.path.join(transfers.directory, f"{uuid.uuid4()}.bin")
+    with open(leftover, "wb") as f:
+        f.write(b"partial")
+    os.utime(leftover, (old, old))
+
+    async def scenario():
+        abandoned = await transfers.start_upload("alice", str(uuid.uuid4()), "bob", 8)
+        abandoned.updated_at -= 2 * 60 * 60
+        os.utime(abandoned.path, (old, old))
+        ongoing = await transfers.start_upload("alice", str(uuid.uuid4()), "bob", 8)
+        return abandoned, ongoing, await transfers.expire_stale()
+
+    abandoned, ongoing, removed = asyncio.run(scenario())
+    assert removed == 2
+    assert not os.path.exists(leftover) and not os.path.exists(abandoned.path)
+    assert os.path.exists(ongoing.path)
+    assert asyncio.run(transfers.get(abandoned.transfer_id)) is None
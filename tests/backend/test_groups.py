@@ -0,0 +1,86 @@
+import asyncio
+import uuid
+
+from blob_store import BlobStore
+from conftest import add_user, auth, signup, ws_connect
+from file_transfer import FileTransferManager, encode_frame
+from groups import GroupDirectory, group_recipient
+
+
+def _receive(ws, frame_type):
+    while (frame := ws.receive_json())["type"] != frame_type:
+        pass
+    return frame
+
+
+def test_group_recipients_resolve_to_members(db):
+    for username in ("alice", "bob", "carol"):
+        add_user(db, username)
+    directory = GroupDirectory(db)
+
+    async def scenario():
+        group_id, members = await directory.create("team", "alice", ["bob"])
+        return members, [await directory.includes(recipient, username) for recipient, username in (
+            (group_recipient(group_id), "bob"),
+            (group_recipient(group_id), "carol"),
+            ("carol", "carol"),
+            ("group:nonsense", "bob"),
+        )]
+
+    members, included = asyncio.run(scenario())
+    assert members == ("alice", "bob")
+    assert included == [True, False, True, False]
+
+
+def test_group_uploads_are_readable_by_members(db, tmp_path):
+    for username in ("alice", "bob", "carol"):
+        add_user(db, username)
+    directory = GroupDirectory(db)
+    transfers = FileTransferManager(BlobStore(str(tmp_path / "blobs")), str(tmp_path / "transfers"), groups=directory)
+
+    async def scenario():
+        group_id, _ = await directory.create("team", "alice", ["bob"])
+        transfer_id = str(uuid.uuid4())
+        transfer = await transfers.start_upload("alice", transfer_id, group_recipient(group_id), 4)
+        await transfers.write_chunk("alice", encode_frame(transfer_id, 0, b"data"))
+        return [await transfers.can_read(transfer, username) for username in ("alice", "bob", "carol")]
+
+    assert asyncio.run(scenario()) == [True, True, False]
+
+
+def test_group_message_with_attachment_reaches_every_member(client):
+    alice, alice_token = signup(client, "alice")
+    bob, bob_token = signup(client, "bob")
+    carol, carol_token = signup(client, "carol")
+    outsider, outsider_token = signup(client, "outsider")
+    group = client.post("/groups", json={"name": "team", "members": [bob, carol]}, headers=auth(alice_token)).json()
+    assert group["members"] == sorted([alice, bob, carol])
+
+    transfer_id = str(uuid.uuid4())
+    with ws_connect(client, bob, bob_token) as bob_ws, ws_connect(client, alice, alice_token) as alice_ws:
+        alice_ws.send_json({"type": "file_upload_start", "transferId": transfer_id,
+                            "recipient": group_recipient(group["id"]), "encryptedSize": 4})
+        _receive(alice_ws, "file_upload_ack")
+        alice_ws.send_bytes(encode_frame(transfer_id, 0, b"data"))
+        assert _receive(alice_ws, "file_upload_ack")["received"] == 4
+        alice_ws.send_json({
+            "type": "group_message", "groupId": group["id"], "sender": alice, "timestamp": "t",
+            "encryptedContent": "c", "iv": "iv", "encryptedAESKeys": {bob: "kb", carol: "kc"},
+            "fileAttachment": {"fileName": "f", "fileType": "text/plain", "fileSize": 4, "iv": "fiv",
+                               "transferId": transfer_id},
+        })
+        assert _receive(alice_ws, "group_message_ack")["delivered"] == 1
+        live = _receive(bob_ws, "group_message")
+        assert (live["encryptedAESKey"], live["fileAttachment"]["transferId"]) == ("kb", transfer_id)
+
+    # carol was offline: the message waits for her, and so does the attachment
+    with ws_connect(client, carol, carol_token) as carol_ws:
+        stored = _receive(carol_ws, "offline_messages")["messages"]
+        assert [(m["type"], m["encryptedAESKey"]) for m in stored] == [("group_message", "kc")]
+        carol_ws.send_json({"type": "file_download_request", "transferId": transfer_id})
+        assert _receive(carol_ws, "file_download_start")["size"] == 4
+        assert carol_ws.receive_bytes()[-4:] == b"data"
+
+    with ws_connect(client, outsider, outsider_token) as outsider_ws:
+        outsider_ws.send_json({"type": "file_download_request", "transferId": transfer_id})
+        assert _receive(outsider_ws, "file_download_error")["transferId"] == transfer_id
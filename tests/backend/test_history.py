@@ -0,0 +1,53 @@
+from conftest import auth, signup
+
+
+def _store(app_module, sender, recipient, count):
+    with app_module.db.connection() as conn, conn:
+        conn.executemany(
+            "INSERT INTO messages (sender, recipient, encrypted_content, iv, encrypted_aes_key, timestamp) "
+            "VALUES (?, ?, ?, 'iv', 'key', ?)",
+            [(sender, recipient, f"m{i}", f"2024-01-01T00:00:{i:02d}") for i in range(count)])
+
+
+def test_history_pages_backwards_without_gaps(app_module, client):
+    alice, token = signup(client, "alice")
+    bob, _ = signup(client, "bob")
+    _store(app_module, alice, bob, 5)
+    _store(app_module, bob, alice, 2)
+
+    seen = []
+    cursor = None
+    while True:
+        params = {"limit": 3, **({"before": cursor} if cursor else {})}
+        page = client.get(f"/messages/{alice}", params=params, headers=auth(token)).json()
+        timestamps = [m["timestamp"] for m in page["messages"]]
+        assert timestamps == sorted(timestamps)
+        seen = page["messages"] + seen
+        if not page["has_more"]:
+            break
+        cursor = page["cursors"]["before"]
+    assert len(seen) == 7
+    assert len({m["id"] for m in seen}) == 7
+
+
+def test_history_pages_forwards_and_by_peer(app_module, client):
+    alice, token = signup(client, "alice")
+    bob, _ = signup(client, "bob")
+    carol, _ = signup(client, "carol")
+    _store(app_module, alice, bob, 4)
+    _store(app_module, carol, alice, 3)
+
+    first = client.get(f"/messages/{alice}", params={"limit": 2, "peer": bob}, headers=auth(token)).json()
+    assert {m["recipient"] for m in first["messages"]} == {bob}
+    older = client.get(f"/messages/{alice}", params={"limit": 10, "peer": bob, "before": first["cursors"]["before"]},
+                       headers=auth(token)).json()
+    newer = client.get(f"/messages/{alice}", params={"limit": 10, "peer": bob, "after": older["cursors"]["after"]},
+                       headers=auth(token)).json()
+    assert [m["id"] for m in newer["messages"]] == [m["id"] for m in first["messages"]]
+
+
+def test_history_rejects_bad_cursors(client):
+    alice, token = signup(client, "alice")
+    assert client.get(f"/messages/{alice}", params={"before": "nonsense"}, headers=auth(token)).status_code == 400
+    assert client.get(f"/messages/{alice}", params={"before": "x", "after": "y"},
+                      headers=auth(token)).status_code == 400
@@ -0,0 +1,54 @@
+import json
+import logging
+
+import logging_config
+from logging_config import DebugSampler, JSONFormatter, Payload, configure_logging
+
+
+def test_payload_is_truncated_only_when_formatted():
+    class Loud:
+        formatted = 0
+
+        def __str__(self):
+            Loud.formatted += 1
+            return "x" * 10
+
+    payload = Payload(Loud(), limit=4)
+    logging.getLogger("quiet").debug("payload %s", payload)
+    assert Loud.formatted == 0
+    assert str(payload) == "xxxx... (10 chars)"
+    assert str(Payload("short")) == "short"
+
+
+def test_json_formatter_keeps_extra_fields():
+    record = logging.makeLogRecord({"name": "relay", "levelno": logging.INFO, "levelname": "INFO",
+                                    "msg": "sent %s", "args": ("m1",), "client_id": "alice", "size": 3})
+    entry = json.loads(JSONFormatter().format(record))
+    assert entry["message"] == "sent m1"
+    assert (entry["logger"], entry["client_id"], entry["size"]) == ("relay", "alice", 3)
+
+
+def test_sampler_only_drops_debug_records():
+    sampler = DebugSampler(0.0)
+    assert not sampler.filter(logging.makeLogRecord({"levelno": logging.DEBUG}))
+    assert sampler.filter(logging.makeLogRecord({"levelno": logging.INFO}))
+
+
+def test_records_are_written_by_the_listener_thread(capsys):
+    root = logging.getLogger()
+    handlers, level = list(root.handlers), root.level
+    try:
+        configure_logging("WARNING", "logging_test_module=DEBUG", "json")
+        logging.getLogger("logging_test_module").debug("kept", extra={"n": 1})
+        logging.getLogger("other").info("dropped")
+        logging_config._stop_listener()
+    finally:
+        logging_config._listener = None
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        for handler in handlers:
+            root.addHandler(handler)
+        root.setLevel(level)
+        logging.getLogger("logging_test_module").setLevel(logging.NOTSET)
+    lines = [json.loads(line) for line in capsys.readouterr().err.splitlines()]
+    assert [(line["message"], line["n"]) for line in lines] == [("kept", 1)]
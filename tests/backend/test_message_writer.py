@@ -0,0 +1,122 @@
+import asyncio
+
+from conftest import add_user
+from message_writer import MessageWriter
+from storage import Database
+
+
+def _insert(writer, sender="alice", recipient="bob", status="sent"):
+    return writer.insert_message(sender, recipient, "content", "iv", "key", "2024-01-01T00:00:00", status, None)
+
+
+def _statuses(db):
+    with db.connection() as conn:
+        return dict(conn.execute("SELECT id, status FROM messages").fetchall())
+
+
+def test_concurrent_inserts_share_one_commit(db):
+    add_user(db, "alice")
+    add_user(db, "bob")
+
+    async def scenario():
+        writer = MessageWriter(db, flush_interval=0.05)
+        await writer.start()
+        ids = await asyncio.gather(*(_insert(writer) for _ in range(20)))
+        await writer.stop()
+        return writer, ids
+
+    writer, ids = asyncio.run(scenario())
+    assert sorted(ids) == list(range(1, 21))
+    assert writer.batches == 1
+    assert writer.operations == 20
+
+
+def test_stop_flushes_queued_writes(db):
+    async def scenario():
+        writer = MessageWriter(db, flush_interval=10)
+        await writer.start()
+        future = writer.update_status(1, "delivered")
+        await writer.stop()
+        return future
+
+    assert asyncio.run(scenario()).done()
+
+
+def test_acknowledge_only_moves_status_forward(db):
+    async def scenario():
+        writer = MessageWriter(db)
+        await writer.start()
+        ids = [await _insert(writer) for _ in range(4)]
+        await writer.update_status(ids[3], "read")
+        changed = await writer.acknowledge("bob", "delivered", [ids[0]], [(ids[2], ids[3])])
+        await writer.stop()
+        return ids, changed
+
+    ids, changed = asyncio.run(scenario())
+    assert changed == [(ids[0], "alice"), (ids[2], "alice")]
+    assert _statuses(db) == {ids[0]: "delivered", ids[1]: "sent", ids[2]: "delivered", ids[3]: "read"}
+
+
+def test_acknowledge_is_limited_to_the_recipient(db):
+    async def scenario():
+        writer = MessageWriter(db)
+        await writer.start()
+        message_id = await _insert(writer)
+        changed = await writer.acknowledge("mallory", "read", [message_id])
+        await writer.stop()
+        return changed
+
+    assert asyncio.run(scenario()) == []
+
+
+def test_one_bad_write_does_not_fail_its_batch(db):
+    async def scenario():
+        writer = MessageWriter(db, flush_interval=0.05)
+        await writer.start()
+        good = _insert(writer)
+        bad = writer.insert_message("alice", "bob", None, "iv", "key", "t", "sent", None)
+        results = await asyncio.gather(good, bad, return_exceptions=True)
+        await writer.stop()
+        return results
+
+    good, bad = asyncio.run(scenario())
+    assert isinstance(good, int)
+    assert isinstance(bad, Exception)
+
+
+def test_requeue_only_takes_back_delivered_messages(db):
+    async def scenario():
+        writer = MessageWriter(db)
+        await writer.start()
+        ids = [await _insert(writer, status=status) for status in ("delivered", "read", "sent", "delivered")]
+        # The recipient acknowledged this one, so its status no longer rests on the server's assumption
+        await writer.acknowledge("bob", "delivered", [ids[3]])
+        changed = await asyncio.gather(*(writer.requeue(message_id) for message_id in ids))
+        # Spilled again by a second path: already pending, so nothing changes
+        again = await writer.requeue(ids[0])
+        await writer.stop()
+        return ids, changed, again
+
+    ids, changed, again = asyncio.run(scenario())
+    assert (changed, again) == ([1, 0, 0, 0], 0)
+    assert _statuses(db) == {ids[0]: "sent", ids[1]: "read", ids[2]: "sent", ids[3]: "delivered"}
+
+
+def test_batches_commit_with_a_full_sync(db):
+    statements = []
+
+    async def scenario():
+        writer = MessageWriter(Database(db.path, pool_size=1))
+        await writer.start()
+        with writer.db.connection() as conn:
+            conn.set_trace_callback(statements.append)
+        await _insert(writer)
+        await writer.stop()
+        with writer.db.connection() as conn:
+            level = conn.execute("PRAGMA synchronous").fetchone()[0]
+        writer.db.close()
+        return level
+
+    # Back to NORMAL (1) for the pool's other users once the batch is in
+    assert asyncio.run(scenario()) == 1
+    assert statements.index("PRAGMA synchronous = FULL") < statements.index("COMMIT")
@@ -0,0 +1,47 @@
+import pytest
+
+from conftest import signup
+from metrics import MetricsRegistry
+
+
+def test_counter_and_histogram_render_as_prometheus_text():
+    registry = MetricsRegistry()
+    sent = registry.counter("sent_total", "Messages sent.", labels=("outcome",))
+    latency = registry.histogram("latency_seconds", "Latency.", buckets=(0.1, 1.0))
+    sent.inc(outcome="relayed")
+    sent.inc(2, outcome="relayed")
+    latency.observe(0.05)
+    latency.observe(0.5)
+    latency.observe(5)
+
+    lines = registry.render().splitlines()
+    assert "# TYPE sent_total counter" in lines
+    assert 'sent_total{outcome="relayed"} 3' in lines
+    assert 'latency_seconds_bucket{le="0.1"} 1' in lines
+    assert 'latency_seconds_bucket{le="1"} 2' in lines
+    assert 'latency_seconds_bucket{le="+Inf"} 3' in lines
+    assert "latency_seconds_count 3" in lines
+
+
+def test_label_values_are_escaped_and_names_unique():
+    registry = MetricsRegistry()
+    registry.counter("c", "C.", labels=("route",)).inc(route='a"b')
+    assert 'c{route="a\\"b"} 1' in registry.render()
+    with pytest.raises(ValueError):
+        registry.counter("c", "Again.")
+
+
+def test_failing_callback_keeps_the_scrape_working():
+    registry = MetricsRegistry()
+    registry.callback("broken", "Broken.", lambda: 1 / 0)
+    registry.callback("queued", "Queued.", lambda: {("a",): 2}, labels=("queue",))
+    rendered = registry.render()
+    assert "# TYPE broken gauge" in rendered
+    assert 'queued{queue="a"} 2' in rendered
+
+
+def test_metrics_endpoint_reports_requests_by_route(client):
+    signup(client, "metrics")
+    response = client.get("/metrics")
+    assert response.headers["content-type"].startswith("text/plain")
+    assert 'route="/signup",status="200"' in response.text
@@ -0,0 +1,41 @@
+import sqlite3
+
+from migrations import SCHEMA_VERSION, migrate
+
+
+def _columns(conn, table):
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def test_fresh_database_is_migrated_once(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / "fresh.db"), isolation_level=None)
+    assert migrate(conn) == 0
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION
+    assert {"file_attachment", "attachment_blob", "status"} <= _columns(conn, "messages")
+    assert migrate(conn) == SCHEMA_VERSION
+
+
+def test_unversioned_database_is_upgraded_in_place(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / "legacy.db"), isolation_level=None)
+    conn.execute("CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT UNIQUE NOT NULL, "
+                 "email TEXT UNIQUE NOT NULL, password_hash TEXT NOT NULL, public_key TEXT NOT NULL)")
+    conn.execute("CREATE TABLE messages (id INTEGER PRIMARY KEY AUTOINCREMENT, sender TEXT NOT NULL, "
+                 "recipient TEXT NOT NULL, encrypted_content TEXT NOT NULL, iv TEXT NOT NULL, "
+                 "encrypted_aes_key TEXT NOT NULL, timestamp TEXT NOT NULL, status TEXT NOT NULL DEFAULT 'sent')")
+    conn.execute("INSERT INTO users (username, email, password_hash, public_key) VALUES ('old', 'o@x', 'h', 'k')")
+    conn.execute("INSERT INTO messages (sender, recipient, encrypted_content, iv, encrypted_aes_key, timestamp) "
+                 "VALUES ('old', 'old', 'c', 'iv', 'k', 't')")
+
+    assert migrate(conn) == 0
+    assert {"file_attachment", "attachment_blob"} <= _columns(conn, "messages")
+    assert conn.execute("SELECT encrypted_content FROM messages").fetchall() == [("c",)]
+    # Existing users are indexed for search as well
+    assert conn.execute("SELECT username FROM users_search WHERE users_search MATCH 'old'").fetchall() == [("old",)]
+
+
+def test_every_step_is_idempotent(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / "replay.db"), isolation_level=None)
+    migrate(conn)
+    conn.execute("PRAGMA user_version = 0")
+    assert migrate(conn) == 0
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION
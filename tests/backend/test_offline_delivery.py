@@ -0,0 +1,59 @@
+import time
+
+from conftest import signup, ws_connect
+
+
+def _message(sender, recipient, n):
+    return {"type": "encrypted_message", "sender": sender, "recipient": recipient, "encryptedContent": f"c{n}",
+            "iv": "iv", "encryptedAESKey": "key", "timestamp": f"2024-01-01T00:00:{n:02d}"}
+
+
+def _receive(ws, frame_type):
+    while (frame := ws.receive_json())["type"] != frame_type:
+        pass
+    return frame
+
+
+def _statuses(app_module, recipient):
+    with app_module.db.connection() as conn:
+        return [row[0] for row in conn.execute("SELECT status FROM messages WHERE recipient = ? ORDER BY id",
+                                               (recipient,))]
+
+
+def test_pending_messages_arrive_in_an_acknowledged_batch(app_module, client):
+    alice, alice_token = signup(client, "alice")
+    bob, bob_token = signup(client, "bob")
+    with ws_connect(client, alice, alice_token) as ws:
+        for n in range(3):
+            ws.send_json(_message(alice, bob, n))
+            assert _receive(ws, "message_ack")["status"] == "sent"
+
+    with ws_connect(client, bob, bob_token) as ws:
+        batch = _receive(ws, "offline_messages")
+        assert [m["encryptedContent"] for m in batch["messages"]] == ["c0", "c1", "c2"]
+        assert batch["more"] is False
+        ws.send_json({"type": "offline_messages_ack", "ids": [m["id"] for m in batch["messages"][:2]]})
+        time.sleep(0.2)
+    assert _statuses(app_module, bob) == ["delivered", "delivered", "sent"]
+
+    # What was not acknowledged is offered again on the next connect
+    with ws_connect(client, bob, bob_token) as ws:
+        batch = _receive(ws, "offline_messages")
+        assert [m["encryptedContent"] for m in batch["messages"]] == ["c2"]
+
+
+def test_acks_outside_the_batch_are_ignored(app_module, client):
+    alice, alice_token = signup(client, "alice")
+    bob, bob_token = signup(client, "bob")
+    carol, _ = signup(client, "carol")
+    with ws_connect(client, alice, alice_token) as ws:
+        ws.send_json(_message(alice, bob, 0))
+        _receive(ws, "message_ack")
+        ws.send_json(_message(alice, carol, 1))
+        carols = _receive(ws, "message_ack")["id"]
+
+    with ws_connect(client, bob, bob_token) as ws:
+        batch = _receive(ws, "offline_messages")
+        ws.send_json({"type": "offline_messages_ack", "ids": [m["id"] for m in batch["messages"]] + [carols]})
+        time.sleep(0.2)
+    assert _statuses(app_module, carol) == ["sent"]
@@ -0,0 +1,126 @@
+import asyncio
+
+import pytest
+
+from conftest import FakeWebSocket
+from outbound import CLOSE_SLOW_CONSUMER, OVERFLOW_DISCONNECT, OVERFLOW_DROP, OutboundQueue
+
+
+def test_frames_are_sent_in_order():
+    async def scenario():
+        websocket = FakeWebSocket()
+        queue = OutboundQueue(websocket, "alice")
+        queue.start()
+        for i in range(5):
+            assert queue.put(f'{{"n":{i}}}')
+        queue.put(b"binary")
+        await asyncio.sleep(0.01)
+        queue.close()
+        return websocket, queue
+
+    websocket, queue = asyncio.run(scenario())
+    assert websocket.sent == [f'{{"n":{i}}}' for i in range(5)] + [b"binary"]
+    assert queue.stats()["sent"] == 6
+
+
+def test_overflow_spills_stored_messages_and_drops_the_rest():
+    spilled = []
+
+    async def scenario():
+        queue = OutboundQueue(FakeWebSocket(), "alice", max_size=1, on_spill=spilled.append)
+        assert queue.put("first", {"id": 1})
+        assert not queue.put("second", {"id": 2})
+        assert not queue.put("presence")
+        return queue
+
+    queue = asyncio.run(scenario())
+    assert spilled == [{"id": 2}]
+    assert (queue.stats()["spilled"], queue.stats()["dropped"]) == (1, 1)
+
+
+def test_drop_policy_discards_without_spilling():
+    spilled = []
+
+    async def scenario():
+        queue = OutboundQueue(FakeWebSocket(), "alice", max_size=1, overflow_policy=OVERFLOW_DROP,
+                              on_spill=spilled.append)
+        queue.put("first", {"id": 1})
+        queue.put("second", {"id": 2})
+        return queue
+
+    assert asyncio.run(scenario()).stats()["dropped"] == 1
+    assert spilled == []
+
+
+def test_disconnect_policy_reports_the_slow_consumer():
+    failures = []
+
+    async def on_failure(queue, code):
+        failures.append(code)
+
+    async def scenario():
+        queue = OutboundQueue(FakeWebSocket(), "alice", max_size=1, overflow_policy=OVERFLOW_DISCONNECT,
+                              on_failure=on_failure)
+        queue.put("first")
+        queue.put("second")
+        await asyncio.sleep(0)
+
+    asyncio.run(scenario())
+    assert failures == [CLOSE_SLOW_CONSUMER]
+
+
+def test_failed_send_closes_the_queue_and_spills_what_is_left():
+    spilled = []
+    failures = []
+
+    async def on_failure(queue, code):
+        failures.append(code)
+
+    async def scenario():
+        queue = OutboundQueue(FakeWebSocket(fail=True), "alice", on_spill=spilled.append, on_failure=on_failure)
+        queue.put("first", {"id": 1})
+        queue.put("second", {"id": 2})
+        queue.start()
+        await asyncio.sleep(0.01)
+        return queue
+
+    queue = asyncio.run(scenario())
+    assert queue.closed
+    assert sorted(meta["id"] for meta in spilled) == [1, 2]
+    assert failures == [1011]
+
+
+def test_each_stored_frame_is_either_sent_or_spilled_once():
+    sent, spilled = [], []
+
+    class SlowWebSocket(FakeWebSocket):
+        async def send_text(self, text: str):
+            await asyncio.sleep(1)
+
+    async def scenario():
+        queue = OutboundQueue(FakeWebSocket(), "alice", on_spill=spilled.append)
+        queue.on_sent = sent.append
+        queue.start()
+        queue.put("first", {"id": 1})
+        await asyncio.sleep(0.01)
+        queue.close()
+
+        # Closed while the writer is still sending: the frame in flight is spilled, not lost
+        slow = OutboundQueue(SlowWebSocket(), "alice", on_spill=spilled.append)
+        slow.on_sent = sent.append
+        slow.start()
+        slow.put("second", {"id": 2})
+        slow.put("third", {"id": 3})
+        await asyncio.sleep(0.01)
+        slow.close()
+        slow.close()
+        await asyncio.sleep(0)
+
+    asyncio.run(scenario())
+    assert sent == [{"id": 1}]
+    assert spilled == [{"id": 2}, {"id": 3}]
+
+
+def test_unknown_policy_is_rejected():
+    with pytest.raises(ValueError):
+        OutboundQueue(FakeWebSocket(), "alice", overflow_policy="block")
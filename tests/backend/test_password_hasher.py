@@ -0,0 +1,49 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from password_hasher import PasswordHasher
+
+
+def test_hash_and_verify_round_trip():
+    hasher = PasswordHasher(workers=2)
+
+    async def scenario():
+        password_hash = await hasher.hash("correct horse")
+        return (await hasher.verify("correct horse", password_hash),
+                await hasher.verify("wrong", password_hash))
+
+    assert asyncio.run(scenario()) == (True, False)
+    assert hasher.stats()["completed"] == 3
+    hasher.close()
+
+
+def test_concurrency_is_bounded_and_waits_are_recorded():
+    hasher = PasswordHasher(workers=4, max_concurrency=2)
+    lock = threading.Lock()
+    state = {"running": 0, "peak": 0}
+
+    def work():
+        with lock:
+            state["running"] += 1
+            state["peak"] = max(state["peak"], state["running"])
+        time.sleep(0.05)
+        with lock:
+            state["running"] -= 1
+
+    async def scenario():
+        await asyncio.gather(*(hasher._submit(work) for _ in range(6)))
+
+    asyncio.run(scenario())
+    assert state["peak"] == 2
+    stats = hasher.stats()
+    assert stats["completed"] == 6
+    assert stats["max_wait_seconds"] > 0.05
+    hasher.close()
+
+
+def test_unknown_executor_is_rejected():
+    with pytest.raises(ValueError):
+        PasswordHasher(executor="fiber")
@@ -0,0 +1,76 @@
+import asyncio
+
+from conftest import FakeWebSocket, signup, ws_connect
+from connection_manager import ConnectionManager
+from presence import Presence
+from serialization import loads
+
+
+def test_unscoped_presence_shows_everyone():
+    presence = Presence()
+    assert presence.visible("alice", ["alice", "bob"]) == ["alice", "bob"]
+    assert presence.audience("alice", ["alice", "bob"]) == ["bob"]
+
+
+def test_scoped_presence_follows_contacts():
+    async def contacts(username):
+        return {"bob"} if username == "alice" else set()
+
+    presence = Presence(contacts)
+
+    async def scenario():
+        await presence.track("alice")
+        await presence.track("carol")
+
+    asyncio.run(scenario())
+    assert presence.visible("alice", ["alice", "bob", "carol"]) == ["alice", "bob"]
+    assert presence.visible("carol", ["alice", "bob", "carol"]) == ["carol"]
+    assert presence.add_contact("carol", "alice")
+    assert not presence.add_contact("carol", "alice")
+    assert presence.visible("carol", ["alice", "carol"]) == ["alice", "carol"]
+
+
+def test_deltas_are_versioned():
+    presence = Presence()
+    first = loads(presence.delta_frame(joined=["a"]))
+    second = loads(presence.delta_frame(left=["a"]))
+    unbumped = loads(presence.delta_frame(joined=["b"], bump=False))
+    assert (first["version"], second["version"], unbumped["version"]) == (1, 2, 2)
+    assert second["left"] == ["a"]
+
+
+def test_joins_and_leaves_are_sent_as_deltas():
+    async def scenario():
+        manager = ConnectionManager()
+        await manager.start()
+        alice, bob = FakeWebSocket(), FakeWebSocket()
+        await manager.connect(alice, "alice")
+        bob_id = await manager.connect(bob, "bob")
+        if manager.disconnect("bob", bob_id):
+            await manager.announce_departure("bob")
+        await asyncio.sleep(0.01)
+        await manager.stop()
+        return alice
+
+    alice = asyncio.run(scenario())
+    snapshot, joined, left = alice.frames()
+    assert snapshot["type"] == "presence_snapshot" and snapshot["clients"] == ["alice"]
+    assert (joined["joined"], left["left"]) == (["bob"], ["bob"])
+    assert left["version"] == joined["version"] + 1
+
+
+def test_debug_info_respects_scoped_presence(app_module, client, monkeypatch):
+    async def no_contacts(username):
+        return set()
+
+    monkeypatch.setattr(app_module.manager, "presence", Presence(no_contacts))
+    alice, alice_token = signup(client, "alice")
+    bob, bob_token = signup(client, "bob")
+    with ws_connect(client, alice, alice_token) as alice_ws, \
+            ws_connect(client, bob, bob_token) as bob_ws:
+        bob_ws.receive_json()
+        alice_ws.receive_json()
+        alice_ws.send_json({"type": "debug_info_request"})
+        while (frame := alice_ws.receive_json())["type"] != "debug_info":
+            pass
+        assert frame["active_connections"] == [alice]
@@ -0,0 +1,37 @@
+from conftest import auth, signup
+from key_cache import PublicKeyCache, key_etag
+
+
+def test_cache_evicts_least_recently_used():
+    cache = PublicKeyCache(max_entries=2)
+    cache.put("a", "ka")
+    cache.put("b", "kb")
+    cache.get("a")
+    cache.put("c", "kc")
+    assert cache.get("b") is None
+    assert cache.get("a") == ("ka", key_etag("ka"))
+    assert cache.stats()["entries"] == 2
+
+
+def test_entries_expire():
+    cache = PublicKeyCache(ttl=-1)
+    cache.put("a", "ka")
+    assert cache.get("a") is None
+    found, missing = cache.get_many(["a", "b"])
+    assert (found, missing) == ({}, ["a", "b"])
+
+
+def test_public_key_revalidates_with_etag(client):
+    alice, token = signup(client, "alice")
+    first = client.get(f"/get_public_key/{alice}", headers=auth(token))
+    assert first.json() == {"public_key": "key"}
+    again = client.get(f"/get_public_key/{alice}", headers={**auth(token), "If-None-Match": first.headers["etag"]})
+    assert again.status_code == 304
+    assert client.get("/get_public_key/nobody", headers=auth(token)).status_code == 404
+
+
+def test_batch_lookup_reports_missing_users(client):
+    alice, token = signup(client, "alice")
+    bob, _ = signup(client, "bob")
+    response = client.post("/public_keys", json={"usernames": [alice, bob, "nobody", bob]}, headers=auth(token))
+    assert response.json() == {"public_keys": {alice: "key", bob: "key"}, "missing": ["nobody"]}
@@ -0,0 +1,61 @@
+from conftest import signup, ws_connect
+
+
+def _message(sender, recipient, n):
+    return {"type": "encrypted_message", "sender": sender, "recipient": recipient, "encryptedContent": f"c{n}",
+            "iv": "iv", "encryptedAESKey": "key", "timestamp": "2024-01-01T00:00:00"}
+
+
+def _receive(ws, frame_type):
+    while (frame := ws.receive_json())["type"] != frame_type:
+        pass
+    return frame
+
+
+def _status(app_module, message_id):
+    with app_module.db.connection() as conn:
+        return conn.execute("SELECT status FROM messages WHERE id = ?", (message_id,)).fetchone()[0]
+
+
+def test_messages_are_addressed_by_server_id(app_module, client):
+    alice, alice_token = signup(client, "alice")
+    bob, bob_token = signup(client, "bob")
+    with ws_connect(client, bob, bob_token) as bob_ws, ws_connect(client, alice, alice_token) as alice_ws:
+        ids = []
+        # Equal timestamps no longer make messages ambiguous
+        for n in range(3):
+            alice_ws.send_json(dict(_message(alice, bob, n), clientMessageId=f"pending-{n}"))
+            ack = _receive(alice_ws, "message_ack")
+            # The sender's own id tells it which of its pending messages was stored
+            assert ack["clientMessageId"] == f"pending-{n}"
+            assert _receive(bob_ws, "encrypted_message")["id"] == ack["id"]
+            ids.append(ack["id"])
+
+        bob_ws.send_json({"type": "message_status", "status": "read", "ranges": [[ids[0], ids[1]]]})
+        receipt = _receive(alice_ws, "message_status")
+        assert (receipt["recipient"], receipt["status"], receipt["ids"]) == (bob, "read", ids[:2])
+
+        # Only messages whose status actually moved are reported
+        bob_ws.send_json({"type": "message_status", "status": "read", "ids": ids})
+        assert _receive(alice_ws, "message_status")["ids"] == [ids[2]]
+        # Statuses never move backwards
+        bob_ws.send_json({"type": "message_status", "status": "delivered", "ids": ids})
+        bob_ws.send_json({"type": "message_status", "status": "nonsense", "ids": ids})
+        _receive(bob_ws, "error")
+    assert [_status(app_module, i) for i in ids] == ["read", "read", "read"]
+
+
+def test_bad_receipts_are_rejected(app_module, client):
+    alice, alice_token = signup(client, "alice")
+    bob, bob_token = signup(client, "bob")
+    with ws_connect(client, alice, alice_token) as alice_ws:
+        alice_ws.send_json(_message(alice, bob, 0))
+        message_id = _receive(alice_ws, "message_ack")["id"]
+        alice_ws.send_json({"type": "message_status", "status": "sent", "ids": [message_id]})
+        assert _receive(alice_ws, "error")["message"] == "Invalid message status: sent"
+    with ws_connect(client, bob, bob_token) as bob_ws:
+        # Ranges running backwards are dropped
+        bob_ws.send_json({"type": "message_status", "status": "read", "ranges": [[message_id, message_id - 1]]})
+        bob_ws.send_json({"type": "message_status", "status": "sent", "ids": [message_id]})
+        _receive(bob_ws, "error")
+    assert _status(app_module, message_id) == "sent"
@@ -0,0 +1,147 @@
+import asyncio
+import os
+import sqlite3
+
+import pytest
+
+from blob_store import BlobStore
+from retention import RetentionJob, _cutoff
+
+OLD = "2000-01-01T00:00:00.000Z"
+
+
+def _store(db, sender, recipient, timestamp, blob=None):
+    with db.connection() as conn, conn:
+        conn.execute("INSERT INTO messages (sender, recipient, encrypted_content, iv, encrypted_aes_key, timestamp, "
+                     "attachment_blob) VALUES (?, ?, 'c', 'iv', 'k', ?, ?)", (sender, recipient, timestamp, blob))
+
+
+def _policy(db, owner, days, action="archive", peer=""):
+    with db.connection() as conn, conn:
+        conn.execute("INSERT INTO retention_policies (owner, peer, max_age_days, action) VALUES (?, ?, ?, ?)",
+                     (owner, peer, days, action))
+
+
+def _remaining(db):
+    with db.connection() as conn:
+        return [row[0] for row in conn.execute("SELECT sender FROM messages ORDER BY id")]
+
+
+def _job(db, tmp_path, **kwargs):
+    return RetentionJob(db, BlobStore(str(tmp_path / "blobs")), archive_path=str(tmp_path / "archive.db"),
+                        pause=0, batch_size=2, **kwargs)
+
+
+def test_expired_messages_are_archived_in_batches(db, tmp_path):
+    for _ in range(3):
+        _store(db, "alice", "bob", OLD)
+    _store(db, "recent", "bob", _cutoff(0))
+    job = _job(db, tmp_path, default_days=30, default_action="archive")
+    asyncio.run(job.run_once())
+
+    assert _remaining(db) == ["recent"]
+    assert job.stats()["archived"] == 3
+    archive = sqlite3.connect(str(tmp_path / "archive.db"))
+    assert archive.execute("SELECT COUNT(*) FROM messages WHERE archived_at IS NOT NULL").fetchone()[0] == 3
+
+
+def test_both_participants_must_have_expired_a_message(db, tmp_path):
+    _store(db, "alice", "bob", OLD)
+    _store(db, "alice", "carol", OLD)
+    _policy(db, "alice", 1, "purge")
+    _policy(db, "bob", 1, "purge")
+    job = _job(db, tmp_path)
+    asyncio.run(job.run_once())
+    # carol has no policy and the default keeps messages forever
+    assert _remaining(db) == ["alice"]
+    assert job.stats()["purged"] == 1
+
+
+def test_only_unreferenced_blobs_are_removed(db, tmp_path):
+    job = _job(db, tmp_path, default_days=1, default_action="purge", blob_grace=0)
+    shared, _ = asyncio.run(job.blob_store.put_bytes(b"shared"))
+    alone, _ = asyncio.run(job.blob_store.put_bytes(b"alone"))
+    _store(db, "alice", "bob", OLD, shared)
+    _store(db, "alice", "bob", _cutoff(0), shared)
+    _store(db, "alice", "bob", OLD, alone)
+    asyncio.run(job.run_once())
+    assert job.blob_store.exists(shared)
+    assert not job.blob_store.exists(alone)
+
+
+def test_a_blob_stored_again_is_kept_until_its_grace_period_ends(db, tmp_path):
+    job = _job(db, tmp_path, default_days=1, default_action="purge", blob_grace=3600)
+    blob, _ = asyncio.run(job.blob_store.put_bytes(b"payload"))
+    _store(db, "alice", "bob", OLD, blob)
+    os.utime(job.blob_store.path(blob), (0, 0))
+    # The same ciphertext is uploaded again while retention runs, for a message not written yet
+    original = job.blob_store.remove_unused
+
+    def remove_unused(blob_id, grace):
+        asyncio.run(job.blob_store.put_bytes(b"payload"))
+        return original(blob_id, grace)
+
+    job.blob_store.remove_unused = remove_unused
+    asyncio.run(job.run_once())
+    assert job.blob_store.exists(blob)
+
+    # Its message arrives: the blob is no longer an orphan at all
+    _store(db, "alice", "carol", _cutoff(0), blob)
+    job.blob_store.remove_unused = original
+    asyncio.run(job.run_once())
+    assert job.blob_store.exists(blob)
+    with db.connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM orphaned_blobs").fetchone()[0] == 0
+
+
+def test_failed_archive_setup_leaves_the_connection_usable(db, tmp_path):
+    # An archive whose messages table predates attachments: creating its index fails
+    archive = sqlite3.connect(str(tmp_path / "archive.db"))
+    archive.execute("CREATE TABLE messages (id INTEGER PRIMARY KEY)")
+    archive.close()
+    _store(db, "alice", "bob", OLD)
+    job = _job(db, tmp_path, default_days=1)
+    with pytest.raises(sqlite3.OperationalError):
+        asyncio.run(job.run_once())
+    # Whichever pooled connection the job used
+    with db.connection() as first, db.connection() as second:
+        for conn in (first, second):
+            assert [row[1] for row in conn.execute("PRAGMA database_list")] == ["main"]
+
+
+def _store_group_message(db, group_id, sender, members, timestamp, blob=None):
+    with db.connection() as conn, conn:
+        message_id = conn.execute("INSERT INTO group_messages (group_id, sender, encrypted_content, iv, timestamp, "
+                                  "attachment_blob) VALUES (?, ?, 'c', 'iv', ?, ?)",
+                                  (group_id, sender, timestamp, blob)).lastrowid
+        conn.executemany("INSERT INTO group_message_keys (member, message_id, encrypted_aes_key) VALUES (?, ?, 'k')",
+                         [(member, message_id) for member in members])
+
+
+def _group_remaining(db):
+    with db.connection() as conn:
+        return (conn.execute("SELECT COUNT(*) FROM group_messages").fetchone()[0],
+                conn.execute("SELECT COUNT(*) FROM group_message_keys").fetchone()[0])
+
+
+def test_group_messages_expire_once_no_member_keeps_them(db, tmp_path):
+    job = _job(db, tmp_path, blob_grace=0)
+    blob, _ = asyncio.run(job.blob_store.put_bytes(b"shared with a group"))
+    _store(db, "alice", "bob", OLD, blob)
+    _store_group_message(db, 1, "alice", ["alice", "bob", "carol"], OLD, blob)
+    _policy(db, "alice", 1, "purge")
+    _policy(db, "bob", 1, "purge")
+    asyncio.run(job.run_once())
+    # carol keeps everything, so only the direct message goes, and the group message still needs the blob
+    assert _remaining(db) == []
+    assert _group_remaining(db) == (1, 3)
+    assert job.blob_store.exists(blob)
+
+    _policy(db, "carol", 2, "archive", peer="group:1")
+    asyncio.run(job.run_once())
+    assert _group_remaining(db) == (0, 0)
+    assert job.stats()["archived"] == 1
+    archive = sqlite3.connect(str(tmp_path / "archive.db"))
+    assert archive.execute("SELECT COUNT(*) FROM group_message_keys").fetchone()[0] == 3
+    # Archived messages keep their attachments
+    assert job.blob_store.exists(blob)
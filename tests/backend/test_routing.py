@@ -0,0 +1,207 @@
+import asyncio
+
+import pytest
+
+import routing
+from conftest import FakeWebSocket
+from connection_manager import ConnectionManager
+from routing import BrokerRouter, LocalRouter, Router, RoutingBroker, _encode
+
+
+def test_router_is_abstract():
+    with pytest.raises(TypeError):
+        Router()
+
+
+def test_local_router_announces_and_delivers():
+    events, delivered = [], []
+
+    async def on_event(event):
+        events.append((event["type"], event["client"]))
+
+    async def scenario():
+        router = LocalRouter()
+        await router.start(lambda c, f, m: delivered.append((c, f)) or True, on_event)
+        await router.register("alice")
+        assert router.is_online("alice") and router.online() == ["alice"]
+        await router.unregister("alice")
+        assert not router.is_online("alice")
+
+    asyncio.run(scenario())
+    assert events == [("joined", "alice"), ("left", "alice")]
+
+
+async def _worker(path, name, log):
+    router = BrokerRouter(path)
+
+    async def on_event(event):
+        log.append((name, event["type"], event.get("client")))
+
+    def deliver(client_id, frame, meta):
+        log.append((name, "deliver", client_id, frame))
+        return True
+
+    await router.start(deliver, on_event)
+    return router
+
+
+def test_broker_shares_presence_and_routes_frames(tmp_path):
+    path = str(tmp_path / "broker.sock")
+    log = []
+
+    async def scenario():
+        broker = asyncio.create_task(RoutingBroker(path).serve())
+        await asyncio.sleep(0.05)
+        a = await _worker(path, "a", log)
+        b = await _worker(path, "b", log)
+        await a.register("alice")
+        await asyncio.sleep(0.05)
+        assert b.is_online("alice") and b.online() == ["alice"]
+        assert b.publish("alice", "hello")
+        await asyncio.sleep(0.05)
+        await a.unregister("alice")
+        await asyncio.sleep(0.05)
+        assert not b.is_online("alice")
+        # Shutting down must not trip over the connection the reader task is closing
+        await a.stop()
+        await b.stop()
+        broker.cancel()
+
+    asyncio.run(scenario())
+    assert ("a", "deliver", "alice", "hello") in log
+    assert ("b", "joined", "alice") in log and ("b", "left", "alice") in log
+
+
+def test_frames_for_unknown_clients_come_back_undelivered(tmp_path):
+    path = str(tmp_path / "broker.sock")
+    undelivered = []
+
+    async def scenario():
+        broker = asyncio.create_task(RoutingBroker(path).serve())
+        await asyncio.sleep(0.05)
+        a = await _worker(path, "a", [])
+        a.on_undelivered = undelivered.append
+        a._remote["ghost"] = 1
+        a.publish("ghost", "frame", {"id": 7, "recipient": "ghost"})
+        await asyncio.sleep(0.05)
+        await a.stop()
+        broker.cancel()
+
+    asyncio.run(scenario())
+    assert undelivered == [{"id": 7, "recipient": "ghost"}]
+
+
+def test_broker_drops_a_worker_that_stops_reading(tmp_path, monkeypatch):
+    monkeypatch.setattr(routing, "DRAIN_TIMEOUT", 0.2)
+    path = str(tmp_path / "broker.sock")
+
+    async def scenario():
+        broker = RoutingBroker(path)
+        server = asyncio.create_task(broker.serve())
+        await asyncio.sleep(0.05)
+        # A worker that registers a client and then never reads again
+        _, stuck = await asyncio.open_unix_connection(path)
+        stuck.write(_encode({"op": "register", "client": "alice"}))
+        await stuck.drain()
+        sender = await _worker(path, "b", [])
+        await asyncio.sleep(0.05)
+        for _ in range(20):
+            sender.publish("alice", "x" * 1_000_000)
+        for _ in range(50):
+            await asyncio.sleep(0.05)
+            if not broker._owners:
+                break
+        remaining = dict(broker._owners)
+        await sender.stop()
+        stuck.close()
+        server.cancel()
+        return remaining
+
+    assert asyncio.run(scenario()) == {}
+
+
+def test_sessions_on_several_workers_all_get_the_frame(tmp_path):
+    path = str(tmp_path / "broker.sock")
+    spilled = []
+
+    async def scenario():
+        broker = asyncio.create_task(RoutingBroker(path).serve())
+        await asyncio.sleep(0.05)
+        workers = [ConnectionManager(router=BrokerRouter(path), on_spill=spilled.append) for _ in range(2)]
+        for manager in workers:
+            await manager.start()
+        sockets = [FakeWebSocket(), FakeWebSocket(), FakeWebSocket()]
+        await workers[0].connect(sockets[0], "bob")
+        await workers[1].connect(sockets[1], "bob")
+        await workers[1].connect(sockets[2], "carol")
+        await asyncio.sleep(0.05)
+
+        assert workers[0].send_frame('{"type":"note","n":1}', "bob", {"id": 1, "recipient": "bob"})
+        # Only another worker holds carol
+        assert workers[0].send_frame('{"type":"note","n":2}', "carol", {"id": 2, "recipient": "carol"})
+        await asyncio.sleep(0.1)
+        received = [[frame["n"] for frame in socket.frames("note")] for socket in sockets]
+
+        # Bob's session on the other worker has the unconfirmed message too, so leaving here spills nothing
+        if workers[0].disconnect("bob", 1):
+            await workers[0].announce_departure("bob")
+        await asyncio.sleep(0.05)
+        assert spilled == []
+        # Until his last session goes
+        if workers[1].disconnect("bob", 1):
+            await workers[1].announce_departure("bob")
+        for manager in workers:
+            await manager.stop()
+        broker.cancel()
+        return received
+
+    assert asyncio.run(scenario()) == [[1], [1], [2]]
+    assert spilled == [{"id": 1, "recipient": "bob"}]
+
+
+def test_a_stuck_worker_does_not_hold_up_the_others(tmp_path):
+    path = str(tmp_path / "broker.sock")
+    log = []
+
+    async def scenario():
+        server = asyncio.create_task(RoutingBroker(path).serve())
+        await asyncio.sleep(0.05)
+        _, stuck = await asyncio.open_unix_connection(path)
+        stuck.write(_encode({"op": "register", "client": "alice"}))
+        await stuck.drain()
+        healthy = await _worker(path, "b", log)
+        await healthy.register("bob")
+        sender = await _worker(path, "c", [])
+        await asyncio.sleep(0.05)
+        for _ in range(3):
+            sender.publish("alice", "x" * 1_000_000)
+        assert sender.publish("bob", "hello")
+        # Well within DRAIN_TIMEOUT, which the stuck worker is still being given
+        await asyncio.sleep(0.5)
+        await healthy.stop()
+        await sender.stop()
+        stuck.close()
+        server.cancel()
+
+    asyncio.run(scenario())
+    assert ("b", "deliver", "bob", "hello") in log
+
+
+def test_worker_stops_publishing_while_the_broker_is_not_reading(tmp_path, monkeypatch):
+    monkeypatch.setattr(routing, "MAX_WRITE_BUFFER", 1_000_000)
+    path = str(tmp_path / "broker.sock")
+
+    async def broker_that_never_reads(reader, writer):
+        writer.write(_encode({"op": "online", "clients": {"alice": 1}}))
+        await asyncio.sleep(10)
+
+    async def scenario():
+        server = await asyncio.start_unix_server(broker_that_never_reads, path)
+        worker = await _worker(path, "a", [])
+        published = [worker.publish("alice", "x" * 500_000) for _ in range(40)]
+        await worker.stop()
+        server.close()
+        return published
+
+    published = asyncio.run(scenario())
+    assert published[0] and not published[-1]
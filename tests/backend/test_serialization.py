@@ -0,0 +1,42 @@
+from conftest import signup, ws_connect
+from message_writer import MESSAGE_JSON_SQL
+from serialization import FastJSONResponse, dumps, dumps_bytes, loads
+
+
+def test_serializer_is_compact_and_round_trips():
+    data = {"type": "encrypted_message", "text": "héllo", "ids": [1, 2]}
+    assert dumps(data) == '{"type":"encrypted_message","text":"héllo","ids":[1,2]}'
+    assert dumps_bytes(data) == dumps(data).encode()
+    assert loads(dumps(data)) == loads(dumps_bytes(data)) == data
+
+
+def test_fast_response_renders_with_the_serializer():
+    assert FastJSONResponse({"ok": True}).body == b'{"ok":true}'
+
+
+def test_sqlite_renders_stored_messages(db):
+    with db.connection() as conn, conn:
+        conn.execute("INSERT INTO messages (sender, recipient, encrypted_content, iv, encrypted_aes_key, timestamp, "
+                     "file_attachment) VALUES ('a', 'b', 'c', 'iv', 'k', 't', ?)", ('{"name":"f.txt","size":3}',))
+        conn.execute("INSERT INTO messages (sender, recipient, encrypted_content, iv, encrypted_aes_key, timestamp) "
+                     "VALUES ('a', 'b', 'd', 'iv', 'k', 't')")
+        rows = conn.execute(f"SELECT {MESSAGE_JSON_SQL} FROM messages ORDER BY id").fetchall()
+    with_file, without_file = (loads(row[0]) for row in rows)
+    assert with_file["fileAttachment"] == {"name": "f.txt", "size": 3}
+    assert with_file["encryptedAESKey"] == "k" and with_file["type"] == "encrypted_message"
+    assert without_file["fileAttachment"] is None
+
+
+def test_relay_forwards_the_original_frame(client):
+    alice, alice_token = signup(client, "alice")
+    bob, bob_token = signup(client, "bob")
+    frame = dumps({"type": "encrypted_message", "sender": alice, "recipient": bob, "encryptedContent": "c",
+                   "iv": "iv", "encryptedAESKey": "key", "timestamp": "2024-01-01T00:00:00", "extra": "kept"})
+    with ws_connect(client, bob, bob_token) as bob_ws, \
+            ws_connect(client, alice, alice_token) as alice_ws:
+        alice_ws.send_text(frame)
+        while (received := bob_ws.receive_text()).find('"encrypted_message"') < 0:
+            pass
+    message = loads(received)
+    assert received.startswith(frame[:-1])
+    assert message["extra"] == "kept" and isinstance(message["id"], int)
@@ -0,0 +1,57 @@
+import time
+
+import pytest
+from starlette.websockets import WebSocketDisconnect
+
+from conftest import auth, signup, ws_connect
+from session_tokens import SessionTokens, token_from_subprotocols
+
+
+def test_tokens_verify_across_instances_sharing_a_secret():
+    issuer, other = SessionTokens("secret"), SessionTokens("secret")
+    token, expires_at = issuer.issue("alice")
+    assert other.verify(token) == "alice"
+    assert SessionTokens("another secret").verify(token) is None
+    assert issuer.verify(token[:-1] + ("A" if token[-1] != "A" else "B")) is None
+    assert expires_at > time.time()
+
+
+def test_expired_and_revoked_tokens_are_rejected():
+    assert SessionTokens("secret", ttl=-1).verify(SessionTokens("secret", ttl=-1).issue("alice")[0]) is None
+    tokens = SessionTokens("secret")
+    token, _ = tokens.issue("alice")
+    tokens.revoke(*tokens.session_of(token))
+    assert tokens.verify(token) is None
+
+
+def test_token_is_taken_from_the_offered_subprotocols():
+    assert token_from_subprotocols(["bearer", "t0k3n"]) == "t0k3n"
+    assert token_from_subprotocols(["chat", "bearer", "t0k3n"]) == "t0k3n"
+    assert token_from_subprotocols(["bearer"]) is None
+    assert token_from_subprotocols([]) is None
+
+
+def test_websocket_accepts_the_subprotocol_token_only(client):
+    alice, token = signup(client, "alice")
+    with ws_connect(client, alice, token) as ws:
+        assert ws.accepted_subprotocol == "bearer"
+    with pytest.raises(WebSocketDisconnect):
+        with client.websocket_connect(f"/ws/{alice}?token={token}"):
+            pass
+    bob, _ = signup(client, "bob")
+    with pytest.raises(WebSocketDisconnect):
+        with ws_connect(client, bob, token):
+            pass
+
+
+def test_logout_revokes_the_session(client):
+    alice, token = signup(client, "alice")
+    assert client.get(f"/conversations/{alice}", headers=auth(token)).status_code == 200
+    client.post("/logout", headers=auth(token))
+    assert client.get(f"/conversations/{alice}", headers=auth(token)).status_code == 401
+
+
+def test_non_ascii_tokens_are_rejected_not_errors(client):
+    assert SessionTokens("secret").verify("a.b.c.é") is None
+    response = client.get("/search_users?query=al", headers={"Authorization": b"Bearer a.b.c.\xe9"})
+    assert response.status_code == 401
@@ -0,0 +1,40 @@
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from static_assets import StaticAssets, build
+
+
+def _client(tmp_path):
+    source, target = tmp_path / "static", tmp_path / "build"
+    source.mkdir()
+    (source / "app.js").write_text("console.log('hello');\n" * 100)
+    manifest = build(str(source), str(target))
+    app = FastAPI()
+    app.mount("/static", StaticAssets(directory=str(target), manifest=manifest), name="static")
+    return TestClient(app), manifest
+
+
+def test_compressed_variant_is_served_with_its_encoding(tmp_path):
+    client, manifest = _client(tmp_path)
+    response = client.get(f"/static/{manifest['app.js']}", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["content-type"] == "text/javascript; charset=utf-8"
+    assert response.headers["cache-control"].endswith("immutable")
+    assert response.text.startswith("console.log")
+
+
+def test_ranges_and_revalidations_of_a_variant_name_its_encoding(tmp_path):
+    client, _ = _client(tmp_path)
+    headers = {"Accept-Encoding": "gzip"}
+    full = client.get("/static/app.js", headers=headers)
+
+    partial = client.get("/static/app.js", headers={**headers, "Range": "bytes=0-9"})
+    assert partial.status_code == 206
+    assert partial.headers["content-encoding"] == "gzip"
+    assert partial.headers["vary"] == "Accept-Encoding"
+    assert partial.headers["content-type"] == "text/javascript; charset=utf-8"
+
+    revalidated = client.get("/static/app.js", headers={**headers, "If-None-Match": full.headers["etag"]})
+    assert revalidated.status_code == 304
+    assert revalidated.headers["content-encoding"] == "gzip"
+    assert revalidated.headers["vary"] == "Accept-Encoding"
@@ -0,0 +1,55 @@
+import asyncio
+import threading
+
+from storage import Database
+
+
+def test_queries_run_off_the_event_loop(db):
+    async def scenario():
+        loop_thread = threading.get_ident()
+        thread = await db.run(lambda conn: threading.get_ident())
+        assert thread != loop_thread
+        await db.execute("INSERT INTO users (username, email, password_hash, public_key) VALUES ('a', 'a@x', 'h', 'k')")
+        assert await db.fetchone("SELECT username FROM users") == ("a",)
+        assert await db.fetchall("SELECT username FROM users WHERE username = ?", ("b",)) == []
+
+    asyncio.run(scenario())
+    assert db.stats()["calls"] == 4
+
+
+def test_pool_never_grows_past_its_bound(tmp_path):
+    database = Database(str(tmp_path / "pool.db"), pool_size=2)
+
+    def slow(conn):
+        conn.execute("SELECT 1")
+        return id(conn)
+
+    async def scenario():
+        return await asyncio.gather(*(database.run(slow) for _ in range(10)))
+
+    connections = set(asyncio.run(scenario()))
+    assert len(connections) <= 2
+    assert database.stats()["open_connections"] <= 2
+    database.close()
+
+
+def test_failed_transaction_is_rolled_back_before_reuse(db):
+    def fail(conn):
+        conn.execute("BEGIN")
+        conn.execute("INSERT INTO users (username, email, password_hash, public_key) VALUES ('a', 'a@x', 'h', 'k')")
+        raise RuntimeError("boom")
+
+    async def scenario():
+        try:
+            await db.run(fail)
+        except RuntimeError:
+            pass
+        return await db.fetchone("SELECT COUNT(*) FROM users")
+
+    assert asyncio.run(scenario()) == (0,)
+
+
+def test_connections_are_tuned(db):
+    with db.connection() as conn:
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        assert conn.execute("PRAGMA busy_timeout").fetchone()[0] == 5000
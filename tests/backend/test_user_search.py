@@ -0,0 +1,55 @@
+import asyncio
+
+from conftest import add_user, auth, signup
+from user_search import UserSearch
+
+
+def test_prefix_matches_come_before_substring_matches(db):
+    for username in ("bobby", "alice", "jimbob", "bob"):
+        add_user(db, username)
+    search = UserSearch(db)
+    users = asyncio.run(search.search("Bob"))
+    assert [user["username"] for user in users] == ["bob", "bobby", "jimbob"]
+    assert users[0] == {"username": "bob", "email": "bob@example.com"}
+
+
+def test_short_queries_only_match_prefixes(db):
+    add_user(db, "alice")
+    add_user(db, "malik")
+    search = UserSearch(db)
+    assert [user["username"] for user in asyncio.run(search.search("al"))] == ["alice"]
+    assert asyncio.run(search.search("   ")) == []
+
+
+def test_results_are_limited(db):
+    for i in range(5):
+        add_user(db, f"carol{i}")
+    assert len(asyncio.run(UserSearch(db, max_results=3).search("carol"))) == 3
+
+
+def test_cache_is_dropped_on_invalidate(db):
+    add_user(db, "dave")
+    search = UserSearch(db)
+    assert len(asyncio.run(search.search("dav"))) == 1
+    add_user(db, "davina")
+    assert len(asyncio.run(search.search("dav"))) == 1
+    search.invalidate()
+    assert len(asyncio.run(search.search("dav"))) == 2
+
+
+def test_index_follows_username_changes(db):
+    add_user(db, "erin")
+    with db.connection() as conn, conn:
+        conn.execute("UPDATE users SET username = 'frank', email = 'frank@example.com' WHERE username = 'erin'")
+    search = UserSearch(db)
+    assert asyncio.run(search.search("erin")) == []
+    assert [user["username"] for user in asyncio.run(search.search("ank"))] == ["frank"]
+
+
+def test_signup_shows_up_in_search(client):
+    _, token = signup(client, "searcher")
+    first = client.get("/search_users", params={"query": "findme"}, headers=auth(token)).json()["users"]
+    username, _ = signup(client, "findme")
+    found = client.get("/search_users", params={"query": "findme"}, headers=auth(token)).json()["users"]
+    assert username in [user["username"] for user in found]
+    assert len(found) == len(first) + 1
@@ -0,0 +1,523 @@
+#!/usr/bin/env python3
+"""
+Quantum-Safe Chat - Benchmark
+Starts the server on a fresh database and drives simulated clients through
+signup, login, key lookup, messaging (with and without attachments, inline
+or streamed as binary chunked transfers) and history paging, then writes throughput and latency percentiles to a JSON
+file so results can be compared across commits.
+"""
+
+import argparse
+import asyncio
+import base64
+import datetime
+import json
+import os
+import secrets
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+try:
+    import httpx
+    import websockets
+except ImportError as e:
+    print(f"Missing benchmark dependency: {e.name}. Please install with: pip install httpx websockets")
+    sys.exit(1)
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = "benchmark_results"
+
+# How long to wait for the server to start, and for any single reply (seconds)
+STARTUP_TIMEOUT = 30
+REPLY_TIMEOUT = 30
+
+# Binary transfer frame header, as in file_transfer.py: 16-byte transfer UUID and the payload's byte offset
+FRAME_HEADER = struct.Struct("!16sQ")
+
+
+class Recorder:
+    """Latency samples per operation, plus error counts."""
+
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+
+    def add(self, operation, seconds):
+        self.samples.setdefault(operation, []).append(seconds)
+
+    def error(self, operation):
+        self.errors[operation] = self.errors.get(operation, 0) + 1
+
+    async def timed(self, operation, coro):
+        start = time.perf_counter()
+        try:
+            result = await coro
+        except Exception:
+            self.error(operation)
+            raise
+        self.add(operation, time.perf_counter() - start)
+        return result
+
+    def summary(self, elapsed_for):
+        """Percentiles per operation; throughput is over the seconds ``elapsed_for(operation)`` returns."""
+        operations = {}
+        for operation in sorted(set(self.samples) | set(self.errors)):
+            samples = sorted(self.samples.get(operation, []))
+            elapsed = elapsed_for(operation)
+            operations[operation] = {
+                "count": len(samples),
+                "errors": self.errors.get(operation, 0),
+                "throughput_per_s": round(len(samples) / elapsed, 2) if elapsed else 0.0,
+                "p50_ms": percentile(samples, 50),
+                "p90_ms": percentile(samples, 90),
+                "p99_ms": percentile(samples, 99),
+                "max_ms": round(samples[-1] * 1000, 3) if samples else None,
+            }
+        return operations
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of sorted samples, in milliseconds."""
+    if not samples:
+        return None
+    rank = max(1, -(-len(samples) * pct // 100))
+    return round(samples[int(rank) - 1] * 1000, 3)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=PROJECT_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def start_broker(workdir):
+    """Run the routing broker that lets several workers deliver to each other's connections."""
+    path = os.path.join(workdir, "routing.sock")
+    log = open(os.path.join(workdir, "broker.log"), "w")
+    process = subprocess.Popen([sys.executable, os.path.join(PROJECT_ROOT, "routing.py"), path], cwd=workdir,
+                               stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while not os.path.exists(path):
+        if process.poll() is not None or time.monotonic() > deadline:
+            process.kill()
+            raise RuntimeError("Routing broker did not start")
+        time.sleep(0.05)
+    return process, path
+
+
+def start_server(port, workdir, workers, broker_path=None):
+    """Run the app under uvicorn in a scratch directory so every run starts from an empty database."""
+    os.symlink(os.path.join(PROJECT_ROOT, "static"), os.path.join(workdir, "static"))
+    # Every worker has to accept the tokens the others issue
+    env = dict(os.environ, PYTHONPATH=PROJECT_ROOT,
+               SESSION_SECRET=os.environ.get("SESSION_SECRET") or secrets.token_hex(32))
+    if broker_path:
+        env["ROUTING_BROKER_SOCKET"] = broker_path
+    command = [sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(port),
+               "--workers", str(workers), "--log-level", "warning"]
+    log = open(os.path.join(workdir, "server.log"), "w")
+    return subprocess.Popen(command, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+async def wait_for_server(http, process):
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError("Server exited during startup")
+        try:
+            if (await http.get("/")).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError("Server did not start in time")
+
+
+class PendingTransfer:
+    """Progress of one chunked upload or download, updated by the reader task."""
+
+    def __init__(self, size=None):
+        self.size = size
+        self.done = 0
+        self.chunk_size = None
+        self.window = None
+        self.resync = False
+        self.error = None
+        self.progress = asyncio.Event()
+
+
+class SimulatedClient:
+    """One user: registers, logs in, then chats with its peer over a WebSocket."""
+
+    def __init__(self, index, run_id, args, http, recorder):
+        self.username = f"bench{run_id}_{index}"
+        self.peer = f"bench{run_id}_{(index + 1) % args.clients}"
+        self.args = args
+        self.http = http
+        self.recorder = recorder
+        self.token = None
+        self.headers = {}
+        self.websocket = None
+        self._reader = None
+        self._acks = {}
+        self._uploads = {}
+        self._downloads = {}
+        # Attachment downloads started for received messages
+        self.download_tasks = []
+        # Send times of messages in flight, shared by every client to measure delivery latency
+        self.sent_at = None
+
+    async def register(self):
+        public_key = base64.b64encode(os.urandom(800)).decode()
+        response = await self.recorder.timed("signup", self.http.post("/signup", json={
+            "username": self.username, "email": f"{self.username}@bench.local",
+            "password": "benchmark-password", "public_key": public_key,
+        }))
+        response.raise_for_status()
+        response = await self.recorder.timed("login", self.http.post("/login", json={
+            "username": self.username, "password": "benchmark-password",
+        }))
+        response.raise_for_status()
+        self.token = response.json()["token"]
+        self.headers = {"Authorization": f"Bearer {self.token}"}
+
+    async def lookup_keys(self):
+        request = self.http.get(f"/get_public_key/{self.peer}", headers=self.headers)
+        response = await self.recorder.timed("get_public_key", request)
+        response.raise_for_status()
+
+    async def connect(self, ws_url, sent_at):
+        self.sent_at = sent_at
+        start = time.perf_counter()
+        self.websocket = await websockets.connect(f"{ws_url}/ws/{self.username}", max_size=None,
+                                                  subprotocols=["bearer", self.token])
+        self.recorder.add("ws_connect", time.perf_counter() - start)
+        self._reader = asyncio.create_task(self._read())
+
+    async def _read(self):
+        async for frame in self.websocket:
+            if isinstance(frame, bytes):
+                await self._download_chunk(frame)
+                continue
+            data = json.loads(frame)
+            message_type = data.get("type")
+            if message_type == "message_ack":
+                future = self._acks.pop(data.get("timestamp"), None)
+                if future and not future.done():
+                    future.set_result(data)
+            elif message_type == "encrypted_message":
+                sent = self.sent_at.pop((data.get("sender"), data.get("timestamp")), None)
+                if sent is not None:
+                    operation = "deliver_attachment" if data.get("fileAttachment") else "deliver"
+                    self.recorder.add(operation, time.perf_counter() - sent)
+                if (data.get("fileAttachment") or {}).get("transferId"):
+                    self.download_tasks.append(asyncio.create_task(
+                        self._download_attachment(data["fileAttachment"]["transferId"])))
+            elif message_type == "file_upload_ack":
+                upload = self._uploads.get(data.get("transferId"))
+                if upload:
+                    upload.chunk_size = data.get("chunkSize", upload.chunk_size)
+                    upload.window = data.get("window", upload.window)
+                    upload.done = data["received"]
+                    upload.resync = upload.resync or bool(data.get("resync"))
+                    upload.progress.set()
+            elif message_type == "file_download_start":
+                download = self._downloads.get(data.get("transferId"))
+                if download:
+                    download.size = data["size"]
+                    download.resync = False
+            elif message_type in ("file_upload_error", "file_download_error"):
+                pending = self._uploads if message_type == "file_upload_error" else self._downloads
+                transfer = pending.get(data.get("transferId"))
+                if transfer:
+                    transfer.error = data.get("message", "transfer failed")
+                    transfer.progress.set()
+            elif message_type == "ping":
+                await self.websocket.send(json.dumps({"type": "pong", "seq": data.get("seq")}))
+            elif message_type == "offline_messages":
+                await self.websocket.send(json.dumps({
+                    "type": "offline_messages_ack", "ids": [m["id"] for m in data.get("messages", [])]
+                }))
+
+    async def upload(self, payload):
+        """Stream a payload as binary frames, a window at a time; returns its transfer id once stored."""
+        transfer_id = str(uuid.uuid4())
+        upload = self._uploads[transfer_id] = PendingTransfer(len(payload))
+        sent = None
+        try:
+            await self.websocket.send(json.dumps({"type": "file_upload_start", "transferId": transfer_id,
+                                                  "recipient": self.peer, "encryptedSize": len(payload)}))
+            while True:
+                await upload.progress.wait()
+                upload.progress.clear()
+                if upload.error:
+                    raise RuntimeError(upload.error)
+                if upload.done >= upload.size:
+                    return transfer_id
+                # The first ack, or a resync, says exactly where the server's copy ends
+                if sent is None or upload.resync or sent < upload.done:
+                    sent = upload.done
+                    upload.resync = False
+                while sent < upload.size and sent - upload.done < upload.window:
+                    chunk = payload[sent:sent + upload.chunk_size]
+                    await self.websocket.send(FRAME_HEADER.pack(uuid.UUID(transfer_id).bytes, sent) + chunk)
+                    sent += len(chunk)
+        finally:
+            del self._uploads[transfer_id]
+
+    async def download(self, transfer_id):
+        """Fetch a transfer as binary frames, acknowledging each one; returns the bytes received."""
+        download = self._downloads[transfer_id] = PendingTransfer()
+        try:
+            await self.websocket.send(json.dumps({"type": "file_download_request", "transferId": transfer_id,
+                                                  "offset": 0}))
+            while download.size is None or download.done < download.size:
+                await download.progress.wait()
+                download.progress.clear()
+                if download.error:
+                    raise RuntimeError(download.error)
+            return download.done
+        finally:
+            del self._downloads[transfer_id]
+
+    async def _download_chunk(self, frame):
+        raw_id, offset = FRAME_HEADER.unpack_from(frame)
+        transfer_id = str(uuid.UUID(bytes=raw_id))
+        download = self._downloads.get(transfer_id)
+        if download is None or download.size is None:
+            return
+        if offset != download.done:
+            # A frame went missing: resume from what we already have
+            if offset > download.done and not download.resync:
+                download.resync = True
+                await self.websocket.send(json.dumps({"type": "file_download_request", "transferId": transfer_id,
+                                                      "offset": download.done}))
+            return
+        download.done += len(frame) - FRAME_HEADER.size
+        await self.websocket.send(json.dumps({"type": "file_download_ack", "transferId": transfer_id,
+                                              "received": download.done}))
+        if download.done >= download.size:
+            download.progress.set()
+
+    async def _download_attachment(self, transfer_id):
+        try:
+            await self.recorder.timed("download", asyncio.wait_for(self.download(transfer_id), REPLY_TIMEOUT))
+        except Exception:
+            pass
+
+    async def send_messages(self):
+        payload = os.urandom(self.args.attachment_size)
+        attachment = base64.b64encode(payload).decode()
+        for seq in range(self.args.messages):
+            timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat()
+            message = {
+                "type": "encrypted_message",
+                "sender": self.username,
+                "recipient": self.peer,
+                "encryptedContent": base64.b64encode(os.urandom(self.args.message_size)).decode(),
+                "iv": base64.b64encode(os.urandom(12)).decode(),
+                "encryptedAESKey": base64.b64encode(os.urandom(256)).decode(),
+                "timestamp": timestamp,
+            }
+            with_attachment = self.args.attachment_every and (seq + 1) % self.args.attachment_every == 0
+            if with_attachment:
+                message["fileAttachment"] = {
+                    "fileName": f"bench-{seq}.bin",
+                    "fileType": "application/octet-stream",
+                    "fileSize": self.args.attachment_size,
+                    "iv": base64.b64encode(os.urandom(12)).decode(),
+                }
+                if self.args.attachment_mode == "chunked":
+                    # As the web client does: upload first, then send a message referencing the transfer
+                    try:
+                        transfer_id = await self.recorder.timed("upload", asyncio.wait_for(
+                            self.upload(payload), REPLY_TIMEOUT))
+                    except Exception:
+                        continue
+                    message["fileAttachment"].update(transferId=transfer_id, encryptedSize=len(payload))
+                else:
+                    message["fileAttachment"]["encryptedData"] = attachment
+            operation = "send_attachment" if with_attachment else "send"
+            future = asyncio.get_running_loop().create_future()
+            self._acks[timestamp] = future
+            self.sent_at[(self.username, timestamp)] = time.perf_counter()
+            # Closed loop: each client waits for the server's ack before sending its next message
+            try:
+                await self.recorder.timed(operation, asyncio.wait_for(
+                    self._send_and_wait(message, future), REPLY_TIMEOUT))
+            except Exception:
+                self._acks.pop(timestamp, None)
+
+    async def _send_and_wait(self, message, future):
+        await self.websocket.send(json.dumps(message))
+        return await future
+
+    async def fetch_history(self):
+        before = None
+        for _ in range(self.args.history_pages):
+            params = {"limit": self.args.history_page_size}
+            if before:
+                params["before"] = before
+            response = await self.recorder.timed("history_page",
+                                                 self.http.get(f"/messages/{self.username}", params=params,
+                                                               headers=self.headers))
+            response.raise_for_status()
+            page = response.json()
+            if not page["has_more"]:
+                break
+            before = page["cursors"]["before"]
+
+    async def close(self):
+        if self.websocket:
+            await self.websocket.close()
+            self._reader.cancel()
+
+
+async def run_phase(name, clients, action, concurrency):
+    """Run one step for every client, at most ``concurrency`` at a time; returns its duration."""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited(client):
+        async with semaphore:
+            try:
+                await action(client)
+            except Exception as e:
+                print(f"  {name} failed for {client.username}: {e}")
+
+    start = time.perf_counter()
+    await asyncio.gather(*(limited(client) for client in clients))
+    elapsed = time.perf_counter() - start
+    print(f"  {name}: {len(clients)} clients in {elapsed:.2f}s")
+    return elapsed
+
+
+async def run_benchmark(args):
+    process = None
+    broker = None
+    workdir = None
+    if args.url:
+        base_url = args.url.rstrip("/")
+    else:
+        workdir = tempfile.mkdtemp(prefix="chat-bench-")
+        port = free_port()
+        broker_path = None
+        if args.workers > 1:
+            # Clients of one conversation may land on different workers
+            broker, broker_path = start_broker(workdir)
+        process = start_server(port, workdir, args.workers, broker_path)
+        base_url = f"http://127.0.0.1:{port}"
+    ws_url = "ws" + base_url[len("http"):]
+    recorder = Recorder()
+    phases = {}
+    started_at = datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+    limits = httpx.Limits(max_connections=args.concurrency)
+    try:
+        async with httpx.AsyncClient(base_url=base_url, timeout=REPLY_TIMEOUT, limits=limits) as http:
+            await wait_for_server(http, process)
+            run_id = format(int(time.time()), "x")
+            clients = [SimulatedClient(i, run_id, args, http, recorder) for i in range(args.clients)]
+            sent_at = {}
+
+            phases["register"] = await run_phase("register", clients, SimulatedClient.register, args.concurrency)
+            phases["lookup_keys"] = await run_phase("lookup_keys", clients, SimulatedClient.lookup_keys,
+                                                    args.concurrency)
+            # Everyone connects before anyone sends, so messages are relayed live rather than stored
+            phases["connect"] = await run_phase("connect", clients, lambda c: c.connect(ws_url, sent_at),
+                                                args.concurrency)
+            phases["messaging"] = await run_phase("messaging", clients, SimulatedClient.send_messages, args.clients)
+            # Give the last relayed messages a moment to arrive
+            deadline = time.monotonic() + 5
+            while sent_at and time.monotonic() < deadline:
+                await asyncio.sleep(0.05)
+            if sent_at:
+                recorder.errors["deliver"] = recorder.errors.get("deliver", 0) + len(sent_at)
+            await asyncio.gather(*(task for client in clients for task in client.download_tasks))
+            phases["history"] = await run_phase("history", clients, SimulatedClient.fetch_history,
+                                                args.concurrency)
+            await asyncio.gather(*(client.close() for client in clients), return_exceptions=True)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=10)
+        if broker is not None:
+            broker.terminate()
+            broker.wait(timeout=10)
+        if workdir is not None:
+            if args.keep_server_dir:
+                print(f"Server directory kept at {workdir}")
+            else:
+                shutil.rmtree(workdir, ignore_errors=True)
+
+    # Message operations are rated over the messaging phase, everything else over its own phase
+    phase_of = {"signup": "register", "login": "register", "get_public_key": "lookup_keys",
+                "ws_connect": "connect", "history_page": "history"}
+    operations = recorder.summary(lambda operation: phases.get(phase_of.get(operation, "messaging"), 0))
+
+    return {
+        "commit": git_commit(),
+        "started_at": started_at,
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "keep_server_dir")},
+        "phases_s": {name: round(elapsed, 3) for name, elapsed in phases.items()},
+        "operations": operations,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the chat server with simulated clients.")
+    parser.add_argument("--clients", type=int, default=50, help="simulated users (default: 50)")
+    parser.add_argument("--messages", type=int, default=20, help="messages sent per client (default: 20)")
+    parser.add_argument("--message-size", type=int, default=256, help="ciphertext bytes per message")
+    parser.add_argument("--attachment-every", type=int, default=10,
+                        help="attach a file to every Nth message, 0 for none (default: 10)")
+    parser.add_argument("--attachment-size", type=int, default=64 * 1024, help="attachment bytes")
+    parser.add_argument("--attachment-mode", choices=("chunked", "inline"), default="chunked",
+                        help="stream attachments as binary chunked transfers and download them on receipt, "
+                             "as the web client does, or inline them base64-encoded (default: chunked)")
+    parser.add_argument("--history-pages", type=int, default=3, help="history pages fetched per client")
+    parser.add_argument("--history-page-size", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=20,
+                        help="clients running REST steps at the same time (default: 20)")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers for the local server")
+    parser.add_argument("--url", help="benchmark a running server instead of starting one")
+    parser.add_argument("--output", help="results file (default: benchmark_results/benchmark_<time>.json)")
+    parser.add_argument("--keep-server-dir", action="store_true", help="keep the local server's database and log")
+    args = parser.parse_args()
+    if args.clients < 2:
+        parser.error("--clients must be at least 2")
+
+    print(f"Benchmarking with {args.clients} clients x {args.messages} messages")
+    results = asyncio.run(run_benchmark(args))
+
+    output = args.output
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        output = os.path.join(RESULTS_DIR, f"benchmark_{timestamp}.json")
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    print(f"\n{'operation':<20}{'count':>8}{'errors':>8}{'ops/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for operation, stats in results["operations"].items():
+        print(f"{operation:<20}{stats['count']:>8}{stats['errors']:>8}{stats['throughput_per_s']:>10}"
+              f"{stats['p50_ms'] if stats['p50_ms'] is not None else '-':>10}"
+              f"{stats['p99_ms'] if stats['p99_ms'] is not None else '-':>10}")
+    print(f"\nResults saved to: {output}")
+
+
+if __name__ == "__main__":
+    main()
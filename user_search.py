@@ -0,0 +1,105 @@
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+
+from storage import Database
+
+logger = logging.getLogger(__name__)
+
+# Results returned per search, and how many recent searches are kept (for how long, in seconds)
+MAX_RESULTS = 20
+MAX_CACHED_QUERIES = 1024
+SEARCH_CACHE_TTL = 30
+
+# The trigram tokenizer needs at least three characters to match anything
+MIN_TRIGRAM_QUERY = 3
+
+# Highest code point, used as the exclusive upper bound of a prefix range
+PREFIX_UPPER_BOUND = chr(0x10FFFF)
+
+PREFIX_SEARCH_SQL = """
+    SELECT username, email FROM users
+    WHERE lower(username) >= ? AND lower(username) < ?
+    ORDER BY lower(username)
+    LIMIT ?
+"""
+
+SUBSTRING_SEARCH_SQL = """
+    SELECT users.username, users.email
+    FROM users_search JOIN users ON users.id = users_search.rowid
+    WHERE users_search MATCH ?
+    ORDER BY rank
+    LIMIT ?
+"""
+
+
+def create_search_index(cursor):
+    """Create the username prefix index and the trigram index over usernames and emails."""
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_username_lower ON users (lower(username))")
+    exists = cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'users_search'"
+    ).fetchone()
+    cursor.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS users_search
+                      USING fts5(username, email, content='users', content_rowid='id', tokenize='trigram')""")
+    # Triggers keep the index in step with every change to users, starting with signup
+    cursor.execute("""CREATE TRIGGER IF NOT EXISTS users_search_insert AFTER INSERT ON users BEGIN
+                          INSERT INTO users_search (rowid, username, email) VALUES (new.id, new.username, new.email);
+                      END""")
+    cursor.execute("""CREATE TRIGGER IF NOT EXISTS users_search_delete AFTER DELETE ON users BEGIN
+                          INSERT INTO users_search (users_search, rowid, username, email)
+                          VALUES ('delete', old.id, old.username, old.email);
+                      END""")
+    cursor.execute("""CREATE TRIGGER IF NOT EXISTS users_search_update AFTER UPDATE OF username, email ON users BEGIN
+                          INSERT INTO users_search (users_search, rowid, username, email)
+                          VALUES ('delete', old.id, old.username, old.email);
+                          INSERT INTO users_search (rowid, username, email) VALUES (new.id, new.username, new.email);
+                      END""")
+    if not exists:
+        logger.info("Building user search index")
+        cursor.execute("INSERT INTO users_search (users_search) VALUES ('rebuild')")
+
+
+class UserSearch:
+    """Ranked user lookup for the search box, with a short-lived cache of hot queries.
+
+    Usernames starting with the query come first, found through an index on
+    ``lower(username)``; the rest of the page is filled with substring matches
+    on username or email from the trigram index, ranked by bm25. Cached pages
+    expire after ``SEARCH_CACHE_TTL`` and are dropped whenever a user signs up.
+    """
+
+    def __init__(self, db: Database, max_results: int = MAX_RESULTS,
+                 max_cached: int = MAX_CACHED_QUERIES, ttl: float = SEARCH_CACHE_TTL):
+        self.db = db
+        self.max_results = max_results
+        self.max_cached = max_cached
+        self.ttl = ttl
+        self._cache: "OrderedDict[str, Tuple[List[Dict[str, str]], float]]" = OrderedDict()
+
+    async def search(self, query: str) -> List[Dict[str, str]]:
+        key = query.strip().lower()
+        if not key:
+            return []
+        entry = self._cache.get(key)
+        if entry and entry[1] > time.monotonic():
+            self._cache.move_to_end(key)
+            return entry[0]
+
+        rows = await self.db.fetchall(PREFIX_SEARCH_SQL, (key, key + PREFIX_UPPER_BOUND, self.max_results))
+        if len(rows) < self.max_results and len(key) >= MIN_TRIGRAM_QUERY:
+            seen = {row[0] for row in rows}
+            phrase = '"' + key.replace('"', '""') + '"'
+            more = await self.db.fetchall(SUBSTRING_SEARCH_SQL, (phrase, self.max_results + len(rows)))
+            rows += [row for row in more if row[0] not in seen][:self.max_results - len(rows)]
+
+        users = [{"username": row[0], "email": row[1]} for row in rows]
+        self._cache[key] = (users, time.monotonic() + self.ttl)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_cached:
+            self._cache.popitem(last=False)
+        return users
+
+    def invalidate(self):
+        """Forget cached results, e.g. after a new user signed up."""
+        self._cache.clear()
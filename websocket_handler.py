@@ -1,60 +1,158 @@
-import json
-import sqlite3
+import asyncio
+import base64
+import binascii
+import functools
 import logging
+from typing import Callable, Dict, List, Optional, Set
 from fastapi import WebSocket, WebSocketDisconnect
 
+from blob_store import BlobStore
 from connection_manager import ConnectionManager
+from file_transfer import FileTransferManager, TransferError, encode_frame
+from groups import PENDING_GROUP_MESSAGES_SQL, GroupDirectory, group_recipient
+from message_writer import MESSAGE_JSON_SQL, MessageWriter
+from logging_config import Payload
+from metrics import registry
+from serialization import dumps, loads
+from storage import Database
 
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 # File attachment size limit (10MB)
 MAX_FILE_SIZE = 10 * 1024 * 1024
 
+# A download stalls and is abandoned if the client acknowledges nothing for this long (seconds)
+DOWNLOAD_ACK_TIMEOUT = 30
+
+# Messages stored while a client was offline are pushed in batches of this size on connect,
+# each waiting for the client's acknowledgement before the next is sent
+OFFLINE_BATCH_SIZE = 100
+OFFLINE_ACK_TIMEOUT = 30
+
+# Bounds on one delivered/read receipt, so a single frame cannot ask for an unbounded update
+MAX_ACK_IDS = 1000
+MAX_ACK_RANGES = 100
+MAX_ACK_RANGE_SPAN = 10000
+
+PENDING_MESSAGES_SQL = f"""
+    SELECT id, {MESSAGE_JSON_SQL}
+    FROM messages
+    WHERE recipient = ? AND status = 'sent' AND id > ?
+    ORDER BY id
+    LIMIT ?
+"""
+
+# Hot-path instrumentation: where the time goes for each incoming message, and how each one ended
+MESSAGE_PHASE_SECONDS = registry.histogram(
+    "chat_message_phase_seconds", "Time spent parsing, persisting and relaying incoming messages.", labels=("phase",))
+MESSAGES_TOTAL = registry.counter(
+    "chat_messages_total", "Encrypted messages handled, by outcome.", labels=("outcome",))
+
 class WebSocketHandler:
-    def __init__(self, websocket: WebSocket, client_id: str, manager: ConnectionManager):
+    def __init__(self, websocket: WebSocket, client_id: str, manager: ConnectionManager, db: Database,
+                 writer: MessageWriter, transfers: FileTransferManager, blob_store: BlobStore,
+                 groups: GroupDirectory, session_id: Optional[str] = None, subprotocol: Optional[str] = None):
         self.websocket = websocket
         self.client_id = client_id
+        self.session_id = session_id
+        # Accepted from those the client offered, e.g. the one that carried its session token
+        self.subprotocol = subprotocol
+        # This socket's id among the sessions the user may have open at once
+        self.connection_id: Optional[int] = None
         self.manager = manager
+        self.db = db
+        self.writer = writer
+        self.transfers = transfers
+        self.blob_store = blob_store
+        self.groups = groups
+        # Active attachment downloads: transfer id -> streaming task and acknowledged offset
+        self._downloads: Dict[str, asyncio.Task] = {}
+        self._download_acks: Dict[str, int] = {}
+        self._download_progress = asyncio.Event()
+        # Offline queue flush: the running task, the ids of the batch awaiting acknowledgement and how
+        # to acknowledge them (direct and group messages are numbered separately)
+        self._offline_task: Optional[asyncio.Task] = None
+        self._offline_pending: Set[int] = set()
+        self._offline_acknowledge: Optional[Callable[[List[int]], None]] = None
+        self._offline_acked = asyncio.Event()
     
     async def handle_websocket(self):
         logger.info(f"Handling WebSocket for {self.client_id}")
         try:
             # Connect the client
-            await self.manager.connect(self.websocket, self.client_id)
+            self.connection_id = await self.manager.connect(self.websocket, self.client_id, self.session_id,
+                                                            self.subprotocol)
             logger.info(f"Client {self.client_id} connected")
+
+            # Deliver what arrived while the client was away, alongside the receive loop below
+            self._offline_task = asyncio.create_task(self._flush_offline_messages())
             
-            # Handle incoming messages
+            # Handle incoming messages: JSON text frames and binary file chunks
             while True:
-                data = await self.websocket.receive_text()
-                message_data = json.loads(data)
-                logger.debug(f"Received from {self.client_id}: {data}")
-                await self._process_message(self.client_id, message_data)
+                message = await self.websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    raise WebSocketDisconnect(message.get("code", 1000))
+                self.manager.seen(self.connection_id)
+                if message.get("bytes") is not None:
+                    await self._handle_upload_chunk(message["bytes"])
+                    continue
+                data = message["text"]
+                with MESSAGE_PHASE_SECONDS.time(phase="parse"):
+                    message_data = loads(data)
+                # Lazy and truncated: a multi-megabyte frame must not be copied into the log
+                logger.debug("Received from %s: %s", self.client_id, Payload(data))
+                await self._process_message(self.client_id, message_data, data)
         
         except WebSocketDisconnect:
-            self.manager.disconnect(self.client_id)
-            await self.manager.broadcast_connected_clients()
+            if self.connection_id is not None and self.manager.disconnect(self.client_id, self.connection_id):
+                await self.manager.announce_departure(self.client_id)
             logger.info(f"Client {self.client_id} disconnected")
         except Exception as e:
             logger.error(f"Error in WebSocket connection for {self.client_id}: {str(e)}")
-            self.manager.disconnect(self.client_id)
-            await self.manager.broadcast_connected_clients()
+            if self.connection_id is not None and self.manager.disconnect(self.client_id, self.connection_id):
+                await self.manager.announce_departure(self.client_id)
             raise
+        finally:
+            for task in self._downloads.values():
+                task.cancel()
+            if self._offline_task:
+                self._offline_task.cancel()
+    
+    async def _send(self, payload: dict):
+        # Replies go to this session only, through its outbound queue so they stay ordered with relayed messages
+        self.manager.send_to_connection(dumps(payload), self.connection_id)
     
-    async def _process_message(self, client_id: str, message_data: dict):
+    async def _process_message(self, client_id: str, message_data: dict, raw: Optional[str] = None):
         message_type = message_data.get("type")
-        if message_type == "encrypted_message":
-            await self._handle_encrypted_message(client_id, message_data)
+        if message_type == "pong":
+            if isinstance(message_data.get("seq"), int):
+                self.manager.pong(self.connection_id, message_data["seq"])
+        elif message_type == "encrypted_message":
+            await self._handle_encrypted_message(client_id, message_data, raw)
+        elif message_type == "group_message":
+            await self._handle_group_message(client_id, message_data)
+        elif message_type == "file_upload_start":
+            await self._handle_upload_start(message_data)
+        elif message_type == "file_download_request":
+            await self._handle_download_request(message_data)
+        elif message_type == "file_download_ack":
+            self._handle_download_ack(message_data)
+        elif message_type == "offline_messages_ack":
+            self._handle_offline_ack(message_data)
+        elif message_type == "message_status":
+            await self._handle_message_status(message_data)
+        elif message_type == "presence_snapshot_request":
+            await self.manager.send_presence_snapshot(client_id, self.connection_id)
         elif message_type == "debug_info_request":
             await self._handle_debug_info_request(client_id)
         else:
-            logger.debug(f"Unknown message type: {message_type}")
-            await self.websocket.send_json({
+            logger.debug("Unknown message type: %s", message_type)
+            await self._send({
                 "type": "error",
                 "message": f"Unknown message type: {message_type}"
             })
 
-    async def _handle_encrypted_message(self, client_id: str, data: dict):
+    async def _handle_encrypted_message(self, client_id: str, data: dict, raw: Optional[str] = None):
         sender = data.get("sender")
         recipient = data.get("recipient")
         encrypted_content = data.get("encryptedContent")
@@ -63,111 +161,410 @@ class WebSocketHandler:
         timestamp = data.get("timestamp")
         file_attachment = data.get("fileAttachment")  # New field for file attachments
 
-        logger.debug(f"Processing encrypted message from {sender} to {recipient}")
+        logger.debug("Processing encrypted message from %s to %s", sender, recipient)
+
+        # The socket is authenticated as client_id; nobody may send in someone else's name
+        if sender != client_id:
+            logger.error(f"Client {client_id} tried to send a message as {sender}")
+            MESSAGES_TOTAL.inc(outcome="rejected")
+            await self._send({
+                "type": "error",
+                "message": "Sender does not match the authenticated user"
+            })
+            return
         
         # Log if there's a file attachment
         if file_attachment:
-            logger.debug(f"Message contains file attachment: {file_attachment.get('fileName')} "
-                        f"({file_attachment.get('fileSize')} bytes, {file_attachment.get('fileType')})")
+            logger.debug("Message contains file attachment: %s (%s bytes, %s)", file_attachment.get("fileName"),
+                         file_attachment.get("fileSize"), file_attachment.get("fileType"))
             
             # Validate file attachment
-            if self._validate_file_attachment(file_attachment) is False:
+            if self._validate_file_attachment(file_attachment, sender, recipient) is False:
                 logger.error(f"Invalid file attachment from {sender}")
-                await self.websocket.send_json({
+                MESSAGES_TOTAL.inc(outcome="rejected")
+                await self._send({
                     "type": "error",
                     "message": "Invalid file attachment"
                 })
                 return
 
-        # Save the message to the database
-        conn = sqlite3.connect("users.db")
-        c = conn.cursor()
+            # Payloads live in the blob store; the stored and relayed message only carries a reference
+            with MESSAGE_PHASE_SECONDS.time(phase="attachment"):
+                file_attachment = await self._store_attachment(file_attachment, sender, recipient)
+            if file_attachment is None:
+                logger.error(f"Could not store file attachment from {sender}")
+                MESSAGES_TOTAL.inc(outcome="rejected")
+                await self._send({
+                    "type": "error",
+                    "message": "Invalid file attachment"
+                })
+                return
+            data["fileAttachment"] = file_attachment
+            # The relayed frame has to carry the rewritten attachment
+            raw = None
+
+        # Determine initial status
+        status = "sent"
+        if self.manager.is_online(recipient):
+            status = "delivered"
+
+        # Convert file_attachment to JSON string if present
+        file_attachment_json = None
+        attachment_blob = None
+        if file_attachment:
+            file_attachment_json = dumps(file_attachment)
+            attachment_blob = file_attachment["blobId"]
+
+        # Save the message to the database; this resolves once its batch has committed
         try:
-            # Determine initial status
-            status = "sent"
-            if self.manager.get_connection(recipient):
-                status = "delivered"
-            
-            # First, update the schema if necessary to support file attachments
-            self._ensure_file_attachment_column(c)
-                
-            # Convert file_attachment to JSON string if present
-            file_attachment_json = None
-            if file_attachment:
-                import json
-                file_attachment_json = json.dumps(file_attachment)
-                
-            # Insert message with possible file attachment
-            c.execute("""
-                INSERT INTO messages (
-                    sender, recipient, encrypted_content, iv, 
-                    encrypted_aes_key, timestamp, status, file_attachment
+            with MESSAGE_PHASE_SECONDS.time(phase="persist"):
+                message_id = await self.writer.insert_message(
+                    sender, recipient, encrypted_content, iv,
+                    encrypted_aes_key, timestamp, status, file_attachment_json, attachment_blob
                 )
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                sender, recipient, encrypted_content, iv, 
-                encrypted_aes_key, timestamp, status, file_attachment_json
-            ))
-            
-            conn.commit()
-            logger.debug(f"Message from {sender} to {recipient} saved to database with status {status}")
+            logger.debug("Message %s from %s to %s saved to database with status %s",
+                         message_id, sender, recipient, status)
         except Exception as e:
             logger.error(f"Error saving message to database: {str(e)}")
-            await self.websocket.send_json({
+            MESSAGES_TOTAL.inc(outcome="failed")
+            await self._send({
                 "type": "error",
                 "message": f"Failed to save message: {str(e)}"
             })
             return
-        finally:
-            conn.close()
-
-        # Relay the encrypted message to the recipient
-        recipient_websocket = self.manager.get_connection(recipient)
-        if recipient_websocket:
-            await recipient_websocket.send_json(data)
-            # Update status to "delivered" if the recipient is online
-            conn = sqlite3.connect("users.db")
-            c = conn.cursor()
-            try:
-                c.execute("""
-                    UPDATE messages 
-                    SET status = 'delivered' 
-                    WHERE sender = ? AND recipient = ? AND timestamp = ?
-                """, (sender, recipient, timestamp))
-                conn.commit()
-                logger.debug(f"Message status updated to 'delivered' for {recipient}")
-            except Exception as e:
-                logger.error(f"Error updating message status: {str(e)}")
-            finally:
-                conn.close()
+
+        # With contact-scoped presence, talking to someone makes them a contact
+        await self.manager.add_contact(sender, recipient)
+
+        # Acknowledge the sender now that the message is durable; the id is how both sides refer to it from now on,
+        # and the sender's own id for it tells the client which of its pending messages this is
+        await self._send({
+            "type": "message_ack",
+            "id": message_id,
+            "clientMessageId": data.get("clientMessageId"),
+            "recipient": recipient,
+            "timestamp": timestamp,
+            "status": status
+        })
+
+        # Relay the encrypted message to the recipient, reusing the sender's frame when it is unchanged.
+        # The id is appended to that frame rather than re-serialising it; a later key wins in JSON.parse.
+        data["id"] = message_id
+        if raw is not None:
+            raw = f'{raw.rstrip()[:-1]},"id":{message_id}}}'
+        with MESSAGE_PHASE_SECONDS.time(phase="relay"):
+            relayed = await self.manager.send_personal_message(data, recipient, frame=raw)
+        MESSAGES_TOTAL.inc(outcome="relayed" if relayed else "stored")
+        if relayed:
+            # Update status to "delivered" if the recipient came online after the insert
+            if status != "delivered":
+                self.writer.update_status(message_id, "delivered")
+                logger.debug("Message %s status update to 'delivered' queued", message_id)
         else:
-            logger.warning(f"Recipient {recipient} not connected, message stored for later delivery")
+            # The recipient went away before the relay; keep the message for later delivery
+            if status == "delivered":
+                self.writer.requeue(message_id)
+            logger.warning("Recipient %s not connected, message stored for later delivery", recipient)
     
+    async def _handle_group_message(self, client_id: str, data: dict):
+        """Store a group message once and fan it out, each member getting the payload with their own key.
+
+        The frame carries one ciphertext and an ``encryptedAESKeys`` map from
+        member to that member's copy of the message key.
+        """
+        group_id = data.get("groupId")
+        timestamp = data.get("timestamp")
+        keys = data.get("encryptedAESKeys")
+        file_attachment = data.get("fileAttachment")
+        members = await self.groups.members(group_id) if isinstance(group_id, int) else ()
+
+        error = None
+        if data.get("sender") != client_id or client_id not in members:
+            error = "Not a member of this group"
+        elif not isinstance(keys, dict) or not all(isinstance(k, str) for k in keys.values()):
+            error = "Missing message keys"
+        elif not set(keys) <= set(members) or not set(members) - {client_id} <= set(keys):
+            # The sender's own key is optional; it only lets them read their history elsewhere
+            error = "Message keys do not match the group members"
+        elif not isinstance(data.get("encryptedContent"), str) or not isinstance(data.get("iv"), str):
+            error = "Missing message content"
+        if error:
+            logger.error(f"Rejected group message from {client_id} to group {group_id}: {error}")
+            MESSAGES_TOTAL.inc(outcome="rejected")
+            await self._send({"type": "error", "message": error})
+            return
+
+        # The attachment is uploaded once for the whole group
+        file_attachment_json = None
+        attachment_blob = None
+        if file_attachment:
+            recipient = group_recipient(group_id)
+            if self._validate_file_attachment(file_attachment, client_id, recipient) is not False:
+                with MESSAGE_PHASE_SECONDS.time(phase="attachment"):
+                    file_attachment = await self._store_attachment(file_attachment, client_id, recipient)
+            else:
+                file_attachment = None
+            if file_attachment is None:
+                logger.error(f"Invalid file attachment from {client_id} to group {group_id}")
+                MESSAGES_TOTAL.inc(outcome="rejected")
+                await self._send({"type": "error", "message": "Invalid file attachment"})
+                return
+            file_attachment_json = dumps(file_attachment)
+            attachment_blob = file_attachment["blobId"]
+
+        online = {member for member in keys if member != client_id and self.manager.is_online(member)}
+        key_rows = [(member, key, "delivered" if member in online or member == client_id else "sent")
+                    for member, key in keys.items()]
+        try:
+            with MESSAGE_PHASE_SECONDS.time(phase="persist"):
+                message_id = await self.writer.insert_group_message(
+                    group_id, client_id, data["encryptedContent"], data["iv"], timestamp,
+                    file_attachment_json, attachment_blob, key_rows
+                )
+        except Exception as e:
+            logger.error(f"Error saving group message to database: {str(e)}")
+            MESSAGES_TOTAL.inc(outcome="failed")
+            await self._send({"type": "error", "message": f"Failed to save message: {str(e)}"})
+            return
+
+        await self._send({
+            "type": "group_message_ack",
+            "id": message_id,
+            "clientMessageId": data.get("clientMessageId"),
+            "groupId": group_id,
+            "timestamp": timestamp,
+            "delivered": len(online)
+        })
+
+        # The shared part is serialised once; each member's frame only appends their key to it
+        shared = dumps({
+            "type": "group_message",
+            "id": message_id,
+            "groupId": group_id,
+            "sender": client_id,
+            "encryptedContent": data["encryptedContent"],
+            "iv": data["iv"],
+            "timestamp": timestamp,
+            "fileAttachment": file_attachment
+        })[:-1]
+        frames = {member: f'{shared},"encryptedAESKey":{dumps(key)}}}'
+                  for member, key in keys.items() if member != client_id}
+        with MESSAGE_PHASE_SECONDS.time(phase="relay"):
+            relayed = set(self.manager.fan_out(frames, {"id": message_id, "group": True}))
+        MESSAGES_TOTAL.inc(len(relayed), outcome="relayed")
+        MESSAGES_TOTAL.inc(len(frames) - len(relayed), outcome="stored")
+
+        # Reconcile with who was online at insert time, as for direct messages
+        if relayed - online:
+            self.writer.update_group_status(message_id, sorted(relayed - online), "delivered")
+        if online - relayed:
+            self.writer.requeue_group(message_id, sorted(online - relayed))
+        logger.debug("Group message %s fanned out to %d of %d members", message_id, len(relayed), len(frames))
+
+    async def _flush_offline_messages(self):
+        """Stream the client's pending ('sent') direct and then group messages, one acknowledged batch at a time."""
+        try:
+            await self._flush_offline_batches(
+                PENDING_MESSAGES_SQL,
+                lambda ids: self.writer.acknowledge(self.client_id, "delivered", ids))
+            await self._flush_offline_batches(
+                PENDING_GROUP_MESSAGES_SQL,
+                lambda ids: self.writer.acknowledge_group(self.client_id, ids))
+        except asyncio.TimeoutError:
+            # Unacknowledged messages stay pending and are sent again on the next connect
+            logger.warning(f"Client {self.client_id} did not acknowledge pending messages")
+        except Exception as e:
+            logger.error(f"Error delivering pending messages to {self.client_id}: {str(e)}")
+
+    async def _flush_offline_batches(self, sql: str, acknowledge: Callable[[List[int]], None]):
+        last_id = 0
+        self._offline_acknowledge = acknowledge
+        while True:
+            rows = await self.db.fetchall(sql, (self.client_id, last_id, OFFLINE_BATCH_SIZE))
+            if not rows:
+                return
+            last_id = rows[-1][0]
+            self._offline_pending = {row[0] for row in rows}
+            self._offline_acked.clear()
+            # Rows arrive as serialised messages and are joined into the batch frame as-is
+            more = "true" if len(rows) == OFFLINE_BATCH_SIZE else "false"
+            frame = '{"type":"offline_messages","messages":[' + ",".join(row[1] for row in rows) + '],"more":' + more + "}"
+            self.manager.send_to_connection(frame, self.connection_id)
+            logger.debug("Sent %d pending messages to %s", len(rows), self.client_id)
+            await asyncio.wait_for(self._offline_acked.wait(), OFFLINE_ACK_TIMEOUT)
+
+    def _handle_offline_ack(self, data: dict):
+        # Only ids from the batch in flight can be acknowledged
+        message_ids = [i for i in data.get("ids") or () if isinstance(i, int) and i in self._offline_pending]
+        if message_ids and self._offline_acknowledge:
+            self._offline_acknowledge(message_ids)
+            logger.debug("Client %s acknowledged %d pending messages", self.client_id, len(message_ids))
+        self._offline_pending = set()
+        self._offline_acked.set()
+
+    async def _handle_message_status(self, data: dict):
+        """Apply a recipient's delivered/read receipt, given as ids and inclusive id ranges, and tell the senders."""
+        status = data.get("status")
+        if status not in ("delivered", "read"):
+            await self._send({"type": "error", "message": f"Invalid message status: {status}"})
+            return
+        message_ids = [i for i in data.get("ids") or () if isinstance(i, int)][:MAX_ACK_IDS]
+        ranges = []
+        for item in (data.get("ranges") or ())[:MAX_ACK_RANGES]:
+            if (isinstance(item, list) and len(item) == 2 and all(isinstance(i, int) for i in item)
+                    and 0 <= item[1] - item[0] < MAX_ACK_RANGE_SPAN):
+                ranges.append((item[0], item[1]))
+        if not message_ids and not ranges:
+            return
+        try:
+            changed = await self.writer.acknowledge(self.client_id, status, message_ids, ranges)
+        except Exception:
+            # Already logged by the writer; the client repeats receipts it cares about
+            return
+        logger.debug("Client %s marked %d messages %s", self.client_id, len(changed), status)
+
+        by_sender: Dict[str, list] = {}
+        for message_id, sender in changed:
+            by_sender.setdefault(sender, []).append(message_id)
+        for sender, ids in by_sender.items():
+            await self.manager.send_personal_message({
+                "type": "message_status",
+                "recipient": self.client_id,
+                "status": status,
+                "ids": ids
+            }, sender)
+
+    async def _store_attachment(self, file_attachment: dict, sender: str, recipient: str) -> Optional[dict]:
+        """Replace an attachment's payload with a blob reference; returns None if it cannot be stored."""
+        stored = {k: v for k, v in file_attachment.items() if k != "encryptedData"}
+        if "transferId" in file_attachment:
+            transfer = await self.transfers.get_complete(file_attachment["transferId"], sender)
+            if not transfer:
+                logger.error(f"Unknown or incomplete transfer: {file_attachment['transferId']}")
+                return None
+            blob_id = await self.transfers.store_blob(transfer)
+            await self.transfers.grant(transfer, recipient)
+            size = transfer.size
+        else:
+            # Older clients inline the ciphertext as base64
+            loop = asyncio.get_running_loop()
+            try:
+                payload = await loop.run_in_executor(
+                    None, functools.partial(base64.b64decode, file_attachment["encryptedData"], validate=True)
+                )
+            except (binascii.Error, TypeError, ValueError) as e:
+                logger.error(f"Invalid inline attachment data from {sender}: {str(e)}")
+                return None
+            blob_id, size = await self.blob_store.put_bytes(payload)
+        stored["blobId"] = blob_id
+        stored["encryptedSize"] = size
+        return stored
+
+    async def _handle_upload_start(self, data: dict):
+        """Start or resume a chunked upload and tell the client where to continue from."""
+        transfer_id = data.get("transferId")
+        try:
+            transfer = await self.transfers.start_upload(
+                self.client_id, transfer_id, data.get("recipient"), data.get("encryptedSize")
+            )
+        except TransferError as e:
+            logger.error(f"Rejected upload {transfer_id} from {self.client_id}: {str(e)}")
+            await self._send({"type": "file_upload_error", "transferId": transfer_id, "message": str(e)})
+            return
+        await self._send({
+            "type": "file_upload_ack",
+            "transferId": transfer.transfer_id,
+            "received": transfer.received,
+            "chunkSize": self.transfers.chunk_size,
+            "window": self.transfers.window_size
+        })
+
+    async def _handle_upload_chunk(self, frame: bytes):
+        try:
+            transfer, in_sequence = await self.transfers.write_chunk(self.client_id, frame)
+        except TransferError as e:
+            logger.error(f"Rejected upload chunk from {self.client_id}: {str(e)}")
+            await self._send({"type": "error", "message": f"File upload failed: {str(e)}"})
+            return
+        ack = {"type": "file_upload_ack", "transferId": transfer.transfer_id, "received": transfer.received}
+        if not in_sequence:
+            # Tell the client to rewind to the last byte we actually stored
+            ack["resync"] = True
+        await self._send(ack)
+
+    async def _handle_download_request(self, data: dict):
+        transfer_id = data.get("transferId")
+        transfer = await self.transfers.get(transfer_id)
+        if not transfer or not transfer.complete or not await self.transfers.can_read(transfer, self.client_id):
+            await self._send({"type": "file_download_error", "transferId": transfer_id, "message": "File not found"})
+            return
+        offset = data.get("offset", 0)
+        if not isinstance(offset, int) or offset < 0 or offset > transfer.size:
+            offset = 0
+
+        # A new request for the same transfer (e.g. after a gap) replaces the running stream
+        previous = self._downloads.pop(transfer.transfer_id, None)
+        if previous:
+            previous.cancel()
+        self._download_acks[transfer.transfer_id] = offset
+        self._downloads[transfer.transfer_id] = asyncio.create_task(self._stream_download(transfer, offset))
+
+    def _handle_download_ack(self, data: dict):
+        transfer_id = data.get("transferId")
+        if transfer_id in self._download_acks and isinstance(data.get("received"), int):
+            self._download_acks[transfer_id] = max(self._download_acks[transfer_id], data["received"])
+            self._download_progress.set()
+
+    async def _stream_download(self, transfer, offset: int):
+        """Send a transfer as binary frames, keeping at most one window unacknowledged."""
+        transfer_id = transfer.transfer_id
+        sent = offset
+        try:
+            await self._send({"type": "file_download_start", "transferId": transfer_id,
+                              "offset": offset, "size": transfer.size})
+            while sent < transfer.size:
+                while sent - self._download_acks[transfer_id] >= self.transfers.window_size:
+                    self._download_progress.clear()
+                    await asyncio.wait_for(self._download_progress.wait(), DOWNLOAD_ACK_TIMEOUT)
+                chunk = await self.transfers.read_chunk(transfer, sent)
+                if not chunk or not self.manager.send_to_connection(encode_frame(transfer_id, sent, chunk), self.connection_id):
+                    break
+                sent += len(chunk)
+        except asyncio.TimeoutError:
+            logger.warning(f"Download {transfer_id} to {self.client_id} stalled at {sent} bytes")
+        except OSError as e:
+            # e.g. the blob was removed by retention after the download was requested
+            logger.error(f"Download {transfer_id} to {self.client_id} failed at {sent} bytes: {str(e)}")
+            await self._send({"type": "file_download_error", "transferId": transfer_id, "message": "File not found"})
+        except asyncio.CancelledError:
+            pass
+        finally:
+            if self._downloads.get(transfer_id) is asyncio.current_task():
+                del self._downloads[transfer_id]
+                del self._download_acks[transfer_id]
+
     async def _handle_debug_info_request(self, client_id: str):
         debug_info = {
             "type": "debug_info",
             "client_id": client_id,
-            "active_connections": list(self.manager.active_connections.keys())
+            "connection_id": self.connection_id,
+            # Scoped presence must not be sidestepped through the debug view
+            "active_connections": self.manager.presence.visible(client_id, self.manager.router.online()),
+            "sessions": len(self.manager.active_connections.get(client_id, ())),
+            "outbound_queue": self.manager.queue_stats().get(client_id, {}).get(self.connection_id)
         }
-        await self.websocket.send_json(debug_info)
+        await self._send(debug_info)
         
-    def _ensure_file_attachment_column(self, cursor):
-        """Ensure the file_attachment column exists in the messages table."""
-        # Check if the column already exists
-        cursor.execute("PRAGMA table_info(messages)")
-        columns = [column[1] for column in cursor.fetchall()]
-        
-        if "file_attachment" not in columns:
-            logger.info("Adding file_attachment column to messages table")
-            cursor.execute("ALTER TABLE messages ADD COLUMN file_attachment TEXT")
-            
-    def _validate_file_attachment(self, file_attachment):
+    def _validate_file_attachment(self, file_attachment, sender=None, recipient=None):
         """Validate file attachment data."""
         if not file_attachment:
             return False
             
-        # Check required fields
-        required_fields = ['fileName', 'fileType', 'fileSize', 'iv', 'encryptedData']
+        # Check required fields; streamed attachments reference an uploaded transfer instead of inlining data,
+        # which is looked up when the attachment is stored
+        required_fields = ['fileName', 'fileType', 'fileSize', 'iv']
+        if 'transferId' not in file_attachment:
+            required_fields.append('encryptedData')
         for field in required_fields:
             if field not in file_attachment:
                 logger.error(f"Missing required field in file attachment: {field}")
@@ -192,7 +589,7 @@ class WebSocketHandler:
             return False
             
         # Check that encrypted data and IV are present
-        encrypted_data = file_attachment.get('encryptedData', '')
+        encrypted_data = file_attachment.get('encryptedData') or file_attachment.get('transferId')
         iv = file_attachment.get('iv', '')
         if not encrypted_data or not iv:
             logger.error("Missing encrypted data or IV")